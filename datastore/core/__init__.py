@@ -15,6 +15,7 @@ throughout its lifetime.
 import key
 from key import Key
 from key import Namespace
+from key import KeyPool
 
 import basic
 from basic import Datastore
@@ -24,6 +25,7 @@ from basic import InterfaceMappingDatastore
 
 from basic import ShimDatastore
 from basic import CacheShimDatastore
+from basic import SingleFlightDatastore
 from basic import LoggingDatastore
 from basic import KeyTransformDatastore
 from basic import LowercaseKeyDatastore
@@ -41,9 +43,34 @@ import query
 from query import Query
 from query import Cursor
 
+import bloom
+from bloom import BloomFilterDatastore
+from bloom import CountingBloomFilter
+
+import cache
+from cache import CacheDatastore
+from cache import LRUPolicy
+from cache import LFUPolicy
+
+import index
+from index import HashIndex
+from index import SortedIndex
+
+import promotion
+from promotion import AlwaysPromote
+from promotion import NeverPromote
+from promotion import PromoteAfterHits
+from promotion import ProbabilisticPromote
+from promotion import SizeLimitedPromote
+
 import serialize
 from serialize import SerializerShimDatastore
 
+import sharding
+from sharding import ConsistentHashRing
+from sharding import RendezvousHash
+from sharding import ShardMigrator
+
 
 # patch datastore with core variables
 import datastore
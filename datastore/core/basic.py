@@ -1,6 +1,17 @@
 
+import sys
+import time
+import Queue
+import threading
+from collections import OrderedDict
+
 from key import Key
+from promotion import AlwaysPromote
+from index import HashIndex
+from index import SortedIndex
 from query import Cursor
+from query import ordered_merge_gen
+from query import parallel_chain_gen
 
 class Datastore(object):
   '''A Datastore represents storage for any key-value pair.
@@ -86,6 +97,46 @@ class Datastore(object):
     '''
     return self.get(key) is not None
 
+  # Batch API. The default implementations loop over the single-key methods.
+  # Datastores SHOULD override these when they can push a batch down.
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.
+
+    The default implementation calls ``get`` once per key. Datastores that
+    can fetch several objects at once (or stack other datastores) should
+    override this to push the whole batch down.
+
+    Args:
+      keys: iterable of Keys naming the objects to retrieve
+
+    Returns:
+      list of objects (or None), one per key
+    '''
+    return [self.get(key) for key in keys]
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+
+    The default implementation calls ``put`` once per pair.
+
+    Args:
+      items: iterable of (key, value) pairs to store.
+    '''
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.
+
+    The default implementation calls ``delete`` once per key.
+
+    Args:
+      keys: iterable of Keys naming the objects to remove.
+    '''
+    for key in keys:
+      self.delete(key)
+
 
 
 
@@ -113,17 +164,45 @@ class NullDatastore(Datastore):
 
 
 class DictDatastore(Datastore):
-  '''Simple straw-man in-memory datastore backed by nested dicts.'''
+  '''Simple straw-man in-memory datastore backed by nested dicts.
+
+  Collections may have secondary indexes on fields (see ``addIndex`` and
+  :py:mod:`datastore.index`), which queries use to avoid full scans.
+  '''
 
   def __init__(self):
     self._items = dict()
+    self._indexes = dict()  # collection name -> {field: Index}
+
+    # serializes writes, so a collection dropped once empty cannot take a
+    # concurrent put with it. Reads need no lock.
+    self._write_lock = threading.Lock()
 
   def _collection(self, key):
-    '''Returns the namespace collection for `key`.'''
-    collection = str(key.path)
-    if not collection in self._items:
-      self._items[collection] = dict()
-    return self._items[collection]
+    '''Returns the namespace collection for `key`, creating it if missing.
+    Call with the write lock held.
+    '''
+    name = str(key.path)
+    try:
+      return self._items[name]
+    except KeyError:
+      collection = self._items[name] = dict()
+      return collection
+
+  def _remove(self, key):
+    '''Removes the object named by `key`, and its collection once empty.
+    Call with the write lock held.
+    '''
+    name = str(key.path)
+    collection = self._items.get(name)
+    if collection is None:
+      return
+
+    if self._indexes:
+      self._unindex(key)
+    collection.pop(key, None)
+    if not collection:
+      del self._items[name]
 
   def get(self, key):
     '''Return the object named by `key` or None.
@@ -136,10 +215,7 @@ class DictDatastore(Datastore):
     Returns:
       object or None
     '''
-    try:
-      return self._collection(key)[key]
-    except KeyError, e:
-      return None
+    return self._items.get(str(key.path), {}).get(key)
 
   def put(self, key, value):
     '''Stores the object `value` named by `key`.
@@ -152,8 +228,13 @@ class DictDatastore(Datastore):
     '''
     if value is None:
       self.delete(key)
-    else:
-      self._collection(key)[key] = value
+      return
+
+    with self._write_lock:
+      if self._indexes:
+        self._indexed_put(key, value)
+      else:
+        self._collection(key)[key] = value
 
   def delete(self, key):
     '''Removes the object named by `key`.
@@ -163,13 +244,8 @@ class DictDatastore(Datastore):
     Args:
       key: Key naming the object to remove.
     '''
-    try:
-      del self._collection(key)[key]
-
-      if len(self._collection(key)) == 0:
-        del self._items[str(key.path)]
-    except KeyError, e:
-      pass
+    with self._write_lock:
+      self._remove(key)
 
   def contains(self, key):
     '''Returns whether the object named by `key` exists.
@@ -183,7 +259,64 @@ class DictDatastore(Datastore):
       boalean whether the object exists
     '''
 
-    return key in self._collection(key)
+    return key in self._items.get(str(key.path), {})
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.
+
+    Looks up each collection once per run of keys sharing a ``key.path``, and
+    does not create empty collections for missing keys.
+
+    Args:
+      keys: iterable of Keys naming the objects to retrieve.
+
+    Returns:
+      list of objects (or None), one per key
+    '''
+    values = []
+    collection_name = collection = None
+    for key in keys:
+      name = str(key.path)
+      if name != collection_name:
+        collection_name = name
+        collection = self._items.get(name, {})
+      values.append(collection.get(key))
+    return values
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+
+    Args:
+      items: iterable of (key, value) pairs to store.
+    '''
+    if self._indexes:
+      for key, value in items:
+        self.put(key, value)
+      return
+
+    with self._write_lock:
+      collection_name = collection = None
+      for key, value in items:
+        if value is None:
+          self._remove(key)
+          collection_name = None  # the collection may have been dropped
+          continue
+
+        name = str(key.path)
+        if name != collection_name:
+          collection_name = name
+          collection = self._collection(key)
+        collection[key] = value
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.
+
+    Args:
+      keys: iterable of Keys naming the objects to remove.
+    '''
+    with self._write_lock:
+      for key in keys:
+        self._remove(key)
 
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
@@ -200,7 +333,11 @@ class DictDatastore(Datastore):
 
     # entire dataset already in memory, so ok to apply query naively
     if str(query.key) in self._items:
-      return query(self._items[str(query.key)].values())
+      collection = self._items[str(query.key)]
+      indexes = self._indexes.get(str(query.key))
+      if indexes:
+        return self._indexed_query(query, collection, indexes)
+      return query(collection.values())
     else:
       return query([])
 
@@ -208,6 +345,108 @@ class DictDatastore(Datastore):
     return sum(map(len, self._items.values()))
 
 
+  # secondary indexes
+
+  def addIndex(self, collection, field, index_class=None):
+    '''Adds a secondary index on `field` to `collection`, indexing the objects
+    already in it. Queries on `collection` use the index from then on.
+
+    Args:
+      collection: Key of the collection (as queried, i.e. a ``key.path``).
+      field: the attribute name (string) to index.
+      index_class: an :py:class:`Index <datastore.index.Index>` subclass.
+          HashIndex (the default) serves '=' and '!=' filters; SortedIndex
+          serves every filter operator and orders.
+
+    Returns:
+      the new index
+    '''
+    if index_class is None:
+      index_class = HashIndex
+
+    name = str(collection)
+    new_index = index_class(field)
+    with self._write_lock:
+      for key, value in self._items.get(name, {}).iteritems():
+        new_index.add(key, value)
+      self._indexes.setdefault(name, {})[field] = new_index
+    return new_index
+
+  def removeIndex(self, collection, field):
+    '''Removes the secondary index on `field` from `collection`.'''
+    name = str(collection)
+    indexes = self._indexes.get(name, {})
+    indexes.pop(field, None)
+    if not indexes:
+      self._indexes.pop(name, None)
+
+  def _indexed_put(self, key, value):
+    '''Stores `value` as put does, keeping the collection indexes current.'''
+    collection = self._collection(key)
+    indexes = self._indexes.get(str(key.path))
+    if indexes:
+      old = collection.get(key)
+      for field_index in indexes.itervalues():
+        if old is not None:
+          field_index.remove(key, old)
+        field_index.add(key, value)
+    collection[key] = value
+
+  def _unindex(self, key):
+    '''Removes the object named by `key` from its collection indexes.'''
+    indexes = self._indexes.get(str(key.path))
+    if indexes:
+      old = self._items.get(str(key.path), {}).get(key)
+      if old is not None:
+        for field_index in indexes.itervalues():
+          field_index.remove(key, old)
+
+  def _objects(self, collection, keys):
+    '''Generates the objects named by `keys` still in `collection`.'''
+    for key in keys:
+      value = collection.get(key)
+      if value is not None:
+        yield value
+
+  def _indexed_query(self, query, collection, indexes):
+    '''Applies `query` to the objects `indexes` narrow it down to.
+
+    Uses the first filter an index can serve (preferring equality filters).
+    When the query has a single order that a SortedIndex serves, reads the
+    objects in that order, so the cursor need not sort them at all.
+    '''
+    usable = [(f, indexes[f.field]) for f in query.filters
+      if f.field in indexes and indexes[f.field].usableFor(f)]
+    usable.sort(key=lambda (filter, _): filter.op != '=')
+
+    order = query.orders[0] if len(query.orders) == 1 else None
+    order_index = indexes.get(order.field) if order else None
+    if not isinstance(order_index, SortedIndex) or \
+        not order_index.usableForOrder(order):
+      order_index = None
+
+    # the keys are copied, as writes change the index during iteration, and
+    # keys deleted meanwhile are skipped.
+    if usable:
+      filter, field_index = usable[0]
+      keys = list(field_index.candidates(filter))
+      if field_index is not order_index:
+        return query(self._objects(collection, keys))
+      if order.isDescending():
+        keys.reverse()
+    elif order_index is not None:
+      keys = list(order_index.keys(order.isDescending()))
+    else:
+      return query(collection.values())
+
+    # candidates already in order: filter, offset, and limit them lazily.
+    cursor = Cursor(query, self._objects(collection, keys))
+    cursor.apply_filter()
+    cursor.apply_offset()
+    cursor.apply_limit()
+    return cursor
+
+
 
 
 class InterfaceMappingDatastore(Datastore):
@@ -339,6 +578,33 @@ class ShimDatastore(Datastore):
     '''
     self.child_datastore.delete(key)
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.
+
+    Default shim implementation simply returns
+    ``child_datastore.get_many(keys)``. Shims that override ``get`` should
+    override this too.
+    '''
+    return self.child_datastore.get_many(keys)
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+
+    Default shim implementation simply calls
+    ``child_datastore.put_many(items)``. Shims that override ``put`` should
+    override this too.
+    '''
+    self.child_datastore.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.
+
+    Default shim implementation simply calls
+    ``child_datastore.delete_many(keys)``. Shims that override ``delete``
+    should override this too.
+    '''
+    self.child_datastore.delete_many(keys)
+
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`.
 
@@ -361,17 +627,86 @@ class ShimDatastore(Datastore):
 
 
 
+class _Tombstones(object):
+  '''Tombstones of keys found missing, kept in a `negative_cache` datastore.
+
+  The datastore must expire its entries (have a `ttl`, as CacheDatastore
+  does), or tombstones of keys never looked up again would pile up.
+
+  A read that finds keys missing only adds their tombstones if no key was
+  written since the read began (see ``version``): otherwise the tombstone of
+  a put racing with the read could hide the new value.
+  '''
+
+  def __init__(self, negative_cache):
+    if not isinstance(negative_cache, Datastore):
+      raise TypeError('negative_cache must be of type %s' % Datastore)
+    if getattr(negative_cache, 'ttl', None) is None:
+      raise ValueError('negative_cache must expire its entries, e.g. '
+          'CacheDatastore(ttl=5)')
+
+    self.datastore = negative_cache
+    self._lock = threading.Lock()
+    self._version = 0
+
+  def version(self):
+    '''Returns the number of writes so far, to pass to ``add``.'''
+    return self._version
+
+  def contains(self, key):
+    '''Returns whether `key` has a tombstone.'''
+    return self.datastore.contains(key)
+
+  def missing(self, keys):
+    '''Returns whether each of `keys` has a tombstone.'''
+    return [tomb is not None for tomb in self.datastore.get_many(keys)]
+
+  def add(self, keys, version):
+    '''Adds tombstones for `keys`, found missing by a read that began at
+    `version`, unless a key was written since.
+    '''
+    with self._lock:
+      if version == self._version:
+        self.datastore.put_many([(key, True) for key in keys])
+
+  def deleted(self, keys):
+    '''Adds tombstones for the deleted `keys`.'''
+    with self._lock:
+      self._version += 1
+      self.datastore.put_many([(key, True) for key in keys])
+
+  def written(self, keys):
+    '''Removes the tombstones of the written `keys`.'''
+    with self._lock:
+      self._version += 1
+      self.datastore.delete_many(keys)
+
+
+
 class CacheShimDatastore(ShimDatastore):
-  '''Wraps a datastore with a caching shim optimizes some calls.'''
+  '''Wraps a datastore with a caching shim optimizes some calls.
+
+  Given a `negative_cache` datastore, keys found missing from the child are
+  remembered there (as tombstones), so repeated lookups of missing keys do
+  not reach the child. Tombstones are removed when the key is ``put``. The
+  negative cache must expire entries, e.g. ``CacheDatastore(ttl=5,
+  sweep_interval=5)``, which also bounds how long keys written around this
+  shim may go unseen.
+  '''
 
   def __init__(self, *args, **kwargs):
 
     self.cache_datastore = kwargs.pop('cache')
+    self.negative_cache = kwargs.pop('negative_cache', None)
 
     if not isinstance(self.cache_datastore, Datastore):
       errstr = 'datastore must be of type %s. Got %s.'
       raise TypeError(errstr % (Datastore, self.cache_datastore))
 
+    self._tombstones = None
+    if self.negative_cache is not None:
+      self._tombstones = _Tombstones(self.negative_cache)
+
     super(CacheShimDatastore, self).__init__(*args, **kwargs)
 
   def get(self, key):
@@ -379,7 +714,20 @@ class CacheShimDatastore(ShimDatastore):
        CacheShimDatastore first checks its ``cache_datastore``.
     '''
     value = self.cache_datastore.get(key)
-    return value if value is not None else self.child_datastore.get(key)
+    if value is not None:
+      return value
+
+    if self._tombstones is None:
+      return self.child_datastore.get(key)
+
+    if self._tombstones.contains(key):
+      return None
+
+    version = self._tombstones.version()
+    value = self.child_datastore.get(key)
+    if value is None:
+      self._tombstones.add([key], version)
+    return value
 
   def put(self, key, value):
     '''Stores the object `value` named by `key`self.
@@ -387,6 +735,8 @@ class CacheShimDatastore(ShimDatastore):
     '''
     self.cache_datastore.put(key, value)
     self.child_datastore.put(key, value)
+    if self._tombstones is not None:
+      self._tombstones.written([key])
 
   def delete(self, key):
     '''Removes the object named by `key`.
@@ -394,13 +744,179 @@ class CacheShimDatastore(ShimDatastore):
     '''
     self.cache_datastore.delete(key)
     self.child_datastore.delete(key)
+    if self._tombstones is not None:
+      self._tombstones.deleted([key])
 
   def contains(self, key):
     '''Returns whether the object named by `key` exists.
        First checks ``cache_datastore``.
     '''
-    return self.cache_datastore.contains(key) \
-        or self.child_datastore.contains(key)
+    if self.cache_datastore.contains(key):
+      return True
+
+    if self._tombstones is None:
+      return self.child_datastore.contains(key)
+
+    if self._tombstones.contains(key):
+      return False
+
+    version = self._tombstones.version()
+    if self.child_datastore.contains(key):
+      return True
+    self._tombstones.add([key], version)
+    return False
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.
+       Only the keys missing from ``cache_datastore`` go to the child.
+    '''
+    keys = list(keys)
+    values = self.cache_datastore.get_many(keys)
+
+    missing = [i for i, value in enumerate(values) if value is None]
+    if missing and self._tombstones is not None:
+      tombs = self._tombstones.missing([keys[i] for i in missing])
+      missing = [i for i, tomb in zip(missing, tombs) if not tomb]
+      version = self._tombstones.version()
+
+    if missing:
+      found = self.child_datastore.get_many([keys[i] for i in missing])
+      for i, value in zip(missing, found):
+        values[i] = value
+
+      if self._tombstones is not None:
+        self._tombstones.add([keys[i] for i in missing if values[i] is None],
+            version)
+    return values
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+       Writes to both ``cache_datastore`` and ``child_datastore``.
+    '''
+    items = list(items)
+    self.cache_datastore.put_many(items)
+    self.child_datastore.put_many(items)
+    if self._tombstones is not None:
+      self._tombstones.written([key for key, _ in items])
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.
+       Writes to both ``cache_datastore`` and ``child_datastore``.
+    '''
+    keys = list(keys)
+    self.cache_datastore.delete_many(keys)
+    self.child_datastore.delete_many(keys)
+    if self._tombstones is not None:
+      self._tombstones.deleted(keys)
+
+
+
+class SingleFlightDatastore(ShimDatastore):
+  '''Wraps a datastore, coalescing concurrent lookups of the same key.
+
+  While a ``get`` (or ``contains``) of a key is in flight, other threads
+  asking for the same key wait for it and share its result (or exception)
+  instead of calling the child themselves. This avoids thundering herds of
+  identical backend calls on hot keys, e.g. right after a cache flush.
+
+  Wrap a whole cache arrangement to also coalesce the write-backs of the
+  fetched value into the upper tiers::
+
+      >>> ds = SingleFlightDatastore(TieredDatastore([cache, database]))
+
+  A ``put`` or ``delete`` of a key detaches the lookups in flight for it, so
+  lookups that start afterwards reach the child again. Batch lookups are
+  passed through to the child as they are.
+  '''
+
+  def __init__(self, datastore):
+    super(SingleFlightDatastore, self).__init__(datastore)
+    self._flights = {}  # (method name, key) -> _Flight
+    self._flights_lock = threading.Lock()
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist,
+       sharing the lookup with concurrent ``get`` calls for `key`.
+    '''
+    return self._single_flight('get', key, self.child_datastore.get)
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists, sharing the lookup
+       with concurrent ``contains`` calls for `key`.
+    '''
+    return self._single_flight('contains', key, self.child_datastore.contains)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`, detaching lookups in flight.'''
+    self.child_datastore.put(key, value)
+    self.forget(key)
+
+  def delete(self, key):
+    '''Removes the object named by `key`, detaching lookups in flight.'''
+    self.child_datastore.delete(key)
+    self.forget(key)
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair, detaching lookups in flight.'''
+    items = list(items)
+    self.child_datastore.put_many(items)
+    for key, _ in items:
+      self.forget(key)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`, detaching lookups in flight.'''
+    keys = list(keys)
+    self.child_datastore.delete_many(keys)
+    for key in keys:
+      self.forget(key)
+
+  def forget(self, key):
+    '''Detaches the lookups of `key` in flight: later lookups do not wait
+    for them.
+    '''
+    with self._flights_lock:
+      self._flights.pop(('get', key), None)
+      self._flights.pop(('contains', key), None)
+
+  def _single_flight(self, name, key, function):
+    '''Returns `function(key)`, called once for concurrent callers.'''
+    with self._flights_lock:
+      flight = self._flights.get((name, key))
+      leader = flight is None
+      if leader:
+        flight = self._flights[(name, key)] = _Flight()
+
+    if not leader:
+      return flight.wait()
+
+    try:
+      flight.value = function(key)
+    except Exception:
+      flight.error = sys.exc_info()
+    finally:
+      with self._flights_lock:
+        if self._flights.get((name, key)) is flight:
+          del self._flights[(name, key)]
+      flight.done.set()
+
+    return flight.wait()
+
+
+
+class _Flight(object):
+  '''The result of a lookup in flight, shared by SingleFlightDatastore.'''
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+  def wait(self):
+    '''Waits for the lookup, returning its value or raising its exception.'''
+    self.done.wait()
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+    return self.value
 
 
 
@@ -448,6 +964,32 @@ class LoggingDatastore(ShimDatastore):
     self.logger.info('%s: contains %s' % (self, key))
     return super(LoggingDatastore, self).contains(key)
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`.
+       LoggingDatastore logs the access.
+    '''
+    keys = list(keys)
+    self.logger.info('%s: get_many %d keys' % (self, len(keys)))
+    values = super(LoggingDatastore, self).get_many(keys)
+    self.logger.debug('%s: %s' % (self, values))
+    return values
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+       LoggingDatastore logs the access.
+    '''
+    items = list(items)
+    self.logger.info('%s: put_many %d keys' % (self, len(items)))
+    super(LoggingDatastore, self).put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.
+       LoggingDatastore logs the access.
+    '''
+    keys = list(keys)
+    self.logger.info('%s: delete_many %d keys' % (self, len(keys)))
+    super(LoggingDatastore, self).delete_many(keys)
+
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`.
        LoggingDatastore logs the access.
@@ -502,6 +1044,20 @@ class KeyTransformDatastore(ShimDatastore):
     '''Returns whether the object named by key is in this datastore.'''
     return self.child_datastore.contains(self._transform(key))
 
+  def get_many(self, keys):
+    '''Return the objects named by keytransform(key) for each key.'''
+    return self.child_datastore.get_many(map(self._transform, keys))
+
+  def put_many(self, items):
+    '''Stores each value named by keytransform(key).'''
+    transform = self._transform
+    items = [(transform(key), value) for key, value in items]
+    self.child_datastore.put_many(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by keytransform(key) for each key.'''
+    self.child_datastore.delete_many(map(self._transform, keys))
+
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
     query = query.copy()
@@ -785,6 +1341,17 @@ class SymlinkDatastore(ShimDatastore):
     else:
       super(SymlinkDatastore, self).put(key, value)
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`. Follows links.'''
+    values = super(SymlinkDatastore, self).get_many(keys)
+    return map(self._follow_link, values)
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`. Follows links.'''
+    # each put may need to follow a link, so they cannot be batched.
+    for key, value in items:
+      self.put(key, value)
+
   def query(self, query):
     '''Returns objects matching criteria expressed in `query`. Follows links.'''
     results = super(SymlinkDatastore, self).query(query)
@@ -953,6 +1520,20 @@ class DirectoryTreeDatastore(ShimDatastore):
       else:
         super(DirectoryTreeDatastore, self).delete(dir_key)
 
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+       DirectoryTreeDatastore stores a directory entry for each.
+    '''
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.
+       DirectoryTreeDatastore removes the directory entry for each.
+    '''
+    for key in keys:
+      self.delete(key)
+
 
   def query(self, query):
     '''Returns objects matching criteria expressed in `query`.
@@ -1018,6 +1599,10 @@ class DatastoreCollection(ShimDatastore):
 
 
 
+# marks queued deletes in TieredDatastore write-behind mode
+_deleted = object()
+
+
 class TieredDatastore(DatastoreCollection):
   '''Represents a hierarchical collection of datastores.
 
@@ -1034,51 +1619,583 @@ class TieredDatastore(DatastoreCollection):
     * contains : returns first found value
     * query    : queries bottom (most complete) datastore
 
+  Given a `negative_cache` datastore, keys found missing from every tier are
+  remembered there (as tombstones), so repeated lookups of missing keys do
+  not reach the slowest tier. Tombstones are removed when the key is ``put``.
+  The negative cache must expire entries, e.g. ``CacheDatastore(ttl=5,
+  sweep_interval=5)``, which also bounds how long keys written around the
+  tiers may go unseen.
+
+  In write-behind mode, ``put`` and ``delete`` only write the first (fastest)
+  tier before returning. The writes are queued for the lower tiers, where a
+  background thread applies them in batches (through ``put_many`` and
+  ``delete_many``). Repeated writes to a queued key are coalesced into the
+  latest one. At most `max_pending` keys are queued; further writes block
+  until the flusher catches up. Reads see queued writes, queries run after
+  the queue is flushed, and ``flush`` waits for the queue to drain (e.g. at
+  durability points). Call ``close`` to flush and stop the flusher.
+
+  Which values found in lower tiers get copied to the upper ones is up to
+  the `promotion` policy (see :py:mod:`datastore.promotion`). With
+  `async_promotion` (implied by `hedge_delay`), the copies are made by a
+  background thread, off the read path. Promotions that cannot be queued
+  right away are dropped, as are those of keys written in the meantime.
+
+  With a `hedge_delay`, ``get`` and ``contains`` do not wait on a slow tier:
+  if a tier has not answered within `hedge_delay` seconds, the next tier is
+  asked too (right away, with a delay of 0), and the first value found by
+  any tier is returned (a miss in the last tier is final). A stalled tier
+  then costs `hedge_delay` per read, rather than its full latency. Each tier
+  is read by a pool of `hedge_threads` threads of its own; reads of stalled
+  tiers keep their thread busy until they return. Once every thread of a
+  tier is busy, reads skip it (but for the last tier), rather than queue
+  behind the stalled ones. Values are promoted asynchronously, as the upper
+  tiers may be the stalled ones.
+
   '''
 
+  def __init__(self, stores=[], negative_cache=None, write_behind=False,
+      max_pending=10000, flush_batch=500, flush_interval=0.1, promotion=None,
+      async_promotion=False, hedge_delay=None, hedge_threads=8):
+    '''Initialize the datastore with any provided datastores.
+
+    Args:
+      stores: the tiers, fastest first.
+      negative_cache: datastore remembering missing keys, which expires its
+          entries (optional).
+      write_behind: whether to write lower tiers in the background.
+      max_pending: maximum number of keys queued for the lower tiers.
+      flush_batch: maximum number of keys written per batch.
+      flush_interval: seconds the flusher waits for writes to queue up.
+      promotion: PromotionPolicy deciding which values found in lower tiers
+          to copy upwards (AlwaysPromote by default).
+      async_promotion: whether to copy values upwards in the background
+          (always the case with a `hedge_delay`).
+      hedge_delay: seconds to wait on a tier before also asking the next one
+          (None, the default, asks tiers one after another).
+      hedge_threads: number of threads reading each tier, with a
+          `hedge_delay`.
+    '''
+    super(TieredDatastore, self).__init__(stores)
+
+    self.promotion = promotion or AlwaysPromote()
+    self._promotions = None
+    if async_promotion or hedge_delay is not None:
+      self._promotions = Queue.Queue(max_pending)
+      self._promotion_lock = threading.Lock()
+      self._copy_lock = threading.Lock()  # held by writes and copies
+      self._written = {}  # key -> write count of its last write
+      self._write_count = 0
+      self._snapshots = {}  # write count -> reads and promotions using it
+      self._prune_at = self._promotions.maxsize
+      self._promoter = threading.Thread(target=self._promotion_loop,
+          name='TieredDatastore promoter')
+      self._promoter.daemon = True
+      self._promoter.start()
+
+    self.negative_cache = negative_cache
+    self._tombstones = None
+    if negative_cache is not None:
+      self._tombstones = _Tombstones(negative_cache)
+
+    self.write_behind = write_behind
+    self.max_pending = max(1, int(max_pending))
+    self.flush_batch = max(1, int(flush_batch))
+    self.flush_interval = flush_interval
+
+    self._pending = OrderedDict()  # key -> value (or _deleted), in order
+    self._flushing = {}  # key -> value (or _deleted), being written
+    self._flush_error = None
+    self._pending_changed = threading.Condition(threading.Lock())
+    self._closed = False
+    self._flusher = None
+    if write_behind:
+      self._flusher = threading.Thread(target=self._flush_loop,
+          name='TieredDatastore flusher')
+      self._flusher.daemon = True
+      self._flusher.start()
+
+    self.hedge_delay = hedge_delay
+    self.hedge_threads = int(hedge_threads)
+    self._hedge_pools = None
+    if hedge_delay is not None:
+      self._hedge_pools = {}  # id(tier) -> [ThreadPool, reads in flight]
+      self._hedge_lock = threading.Lock()
+
   def get(self, key):
     '''Return the object named by key. Checks each datastore in order.'''
-    value = None
-    for store in self._stores:
-      value = store.get(key)
-      if value is not None:
-        break
+    if self.write_behind:
+      queued = self._queued(key)
+      if queued is not None:
+        return None if queued is _deleted else queued
 
-    # add model to lower stores only
-    if value is not None:
-      for store2 in self._stores:
-        if store == store2:
-          break
-        store2.put(key, value)
+    if self._tombstones is not None:
+      if self._tombstones.contains(key):
+        return None
+      version = self._tombstones.version()
+
+    snapshot = self._snapshot()
+    try:
+      if self._hedge_pools is not None:
+        depth, value = self._hedged_read('get', key)
+      else:
+        value = None
+        for depth, store in enumerate(self._stores):
+          value = store.get(key)
+          if value is not None:
+            break
+
+      # add model to lower stores only
+      if value is not None and depth > 0:
+        self._promote([(key, value)], depth, snapshot)
+    finally:
+      self._release(snapshot)
+
+    if value is None and self._tombstones is not None:
+      self._tombstones.add([key], version)
 
     return value
 
   def put(self, key, value):
     '''Stores the object in all underlying datastores.'''
-    for store in self._stores:
-      store.put(key, value)
+    self._note_writes([key])
+    if self.write_behind:
+      self._stores[0].put(key, value)
+      self._enqueue([(key, _deleted if value is None else value)])
+    else:
+      for store in self._stores:
+        store.put(key, value)
+
+    if self._tombstones is not None:
+      self._tombstones.written([key])
 
   def delete(self, key):
     '''Removes the object from all underlying datastores.'''
-    for store in self._stores:
-      store.delete(key)
+    self._note_writes([key])
+    if self.write_behind:
+      self._stores[0].delete(key)
+      self._enqueue([(key, _deleted)])
+    else:
+      for store in self._stores:
+        store.delete(key)
+
+    if self._tombstones is not None:
+      self._tombstones.deleted([key])
 
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`.
     The last datastore will handle all query calls, as it has a (if not
     the only) complete record of all objects.
     '''
+    if self.write_behind:
+      self.flush()
+
     # queries hit the last (most complete) datastore
     return self._stores[-1].query(query)
 
   def contains(self, key):
     '''Returns whether the object is in this datastore.'''
-    for store in self._stores:
-      if store.contains(key):
+    if self.write_behind:
+      queued = self._queued(key)
+      if queued is not None:
+        return queued is not _deleted
+
+    if self._tombstones is not None:
+      if self._tombstones.contains(key):
+        return False
+      version = self._tombstones.version()
+
+    if self._hedge_pools is not None:
+      if self._hedged_read('contains', key)[1]:
         return True
+
+    else:
+      for store in self._stores:
+        if store.contains(key):
+          return True
+
+    if self._tombstones is not None:
+      self._tombstones.add([key], version)
     return False
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`. Checks each datastore in order,
+    asking each one only for the keys still missing. Found values are added
+    to the stores above the one that had them, one batch per store.
+    '''
+    keys = list(keys)
+    values = [None] * len(keys)
+    missing = range(len(keys))
+
+    if self.write_behind:
+      still_missing = []
+      for i in missing:
+        queued = self._queued(keys[i])
+        if queued is None:
+          still_missing.append(i)
+        elif queued is not _deleted:
+          values[i] = queued
+      missing = still_missing
+
+    if self._tombstones is not None:
+      tombs = self._tombstones.missing([keys[i] for i in missing])
+      missing = [i for i, tomb in zip(missing, tombs) if not tomb]
+      version = self._tombstones.version()
+
+    snapshot = self._snapshot()
+    try:
+      for depth, store in enumerate(self._stores):
+        if not missing:
+          break
+
+        found = store.get_many([keys[i] for i in missing])
+        still_missing = []
+        hits = []
+        for i, value in zip(missing, found):
+          if value is None:
+            still_missing.append(i)
+          else:
+            values[i] = value
+            hits.append((keys[i], value))
+
+        # add values to upper stores only
+        if hits and depth > 0:
+          self._promote(hits, depth, snapshot)
+
+        missing = still_missing
+    finally:
+      self._release(snapshot)
+
+    if missing and self._tombstones is not None:
+      self._tombstones.add([keys[i] for i in missing], version)
+
+    return values
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in all underlying datastores.'''
+    items = list(items)
+    self._note_writes([key for key, _ in items])
+    if self.write_behind:
+      self._stores[0].put_many(items)
+      self._enqueue([(key, _deleted if value is None else value)
+        for key, value in items])
+    else:
+      for store in self._stores:
+        store.put_many(items)
+
+    if self._tombstones is not None:
+      self._tombstones.written([key for key, _ in items])
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys` from all underlying datastores.'''
+    keys = list(keys)
+    self._note_writes(keys)
+    if self.write_behind:
+      self._stores[0].delete_many(keys)
+      self._enqueue([(key, _deleted) for key in keys])
+    else:
+      for store in self._stores:
+        store.delete_many(keys)
+
+    if self._tombstones is not None:
+      self._tombstones.deleted(keys)
+
+
+  # hedged reads
+
+  def _hedged_read(self, method, key):
+    '''Calls `method` (``get`` or ``contains``) with `key` on the tiers, in
+    order, moving on to the next tier whenever the last one asked has not
+    answered within `hedge_delay` seconds, or found nothing. Misses in the
+    last (most complete) tier are final, even if other tiers have not
+    answered yet.
+
+    Returns:
+      (depth, result) for the first tier to find `key`, or (None, None).
+    '''
+    stores = self._stores
+    results = Queue.Queue()
+
+    def read(depth, tier):
+      try:
+        results.put((depth, getattr(stores[depth], method)(key), None))
+      except Exception:
+        results.put((depth, None, sys.exc_info()))
+      finally:
+        with self._hedge_lock:
+          tier[1] -= 1
+
+    asked = 0
+    answered = 0
+    error = None
+    while answered < len(stores):
+      if asked == answered or (asked < len(stores) and self.hedge_delay <= 0):
+        if not self._hedge(read, stores, asked):
+          answered += 1  # every thread of the tier is busy: skip it
+        asked += 1
+        continue
+
+      try:
+        timeout = self.hedge_delay if asked < len(stores) else None
+        depth, result, result_error = results.get(timeout=timeout)
+      except Queue.Empty:
+        if not self._hedge(read, stores, asked):  # hedge: ask next tier
+          answered += 1
+        asked += 1
+        continue
+
+      answered += 1
+      if result_error is not None:
+        error = error or result_error
+      elif result is not None and result is not False:
+        return depth, result
+      elif depth == len(stores) - 1:
+        return None, None  # the most complete tier does not have it either
+
+    # not found; report an error rather than a miss if a tier failed.
+    if error is not None:
+      raise error[0], error[1], error[2]
+    return None, None
+
+  def _hedge(self, read, stores, depth):
+    '''Starts `read` of tier `depth` in the tier's pool. Returns False,
+    without starting it, if every thread of the pool is busy (unless it is
+    the last tier, which is always read).
+    '''
+    with self._hedge_lock:
+      tier = self._hedge_pools.get(id(stores[depth]))
+      if tier is None:
+        from multiprocessing.pool import ThreadPool
+        tier = [ThreadPool(self.hedge_threads), 0]
+        self._hedge_pools[id(stores[depth])] = tier
+      if tier[1] >= self.hedge_threads and depth < len(stores) - 1:
+        return False
+      tier[1] += 1
+
+    tier[0].apply_async(read, (depth, tier))
+    return True
+
+
+  # promotion
+
+  def _promote(self, items, depth, snapshot):
+    '''Copies the (key, value) `items` found in tier `depth` to the tiers
+    above it, as the promotion policy allows. `snapshot` is the write count
+    taken before they were read (see _snapshot).
+    '''
+    items = [(key, value) for key, value in items
+      if self.promotion.shouldPromote(key, value)]
+    if not items:
+      return
+
+    if self._promotions is None:
+      for store in self._stores[:depth]:
+        store.put_many(items)
+      return
+
+    with self._promotion_lock:
+      try:
+        self._promotions.put_nowait((items, depth, snapshot))
+        self._snapshots[snapshot] += 1
+      except Queue.Full:
+        pass  # promoting is an optimization; drop it rather than wait
+
+  def _snapshot(self):
+    '''Returns the current write count, to be taken before reading values
+    that may be promoted asynchronously, and released with _release. Keys
+    written after it are not promoted. Returns None without async promotion.
+    '''
+    if self._promotions is None:
+      return None
+
+    with self._promotion_lock:
+      snapshot = self._write_count
+      self._snapshots[snapshot] = self._snapshots.get(snapshot, 0) + 1
+      return snapshot
+
+  def _release(self, snapshot):
+    '''Releases a write count returned by _snapshot (or queued with a
+    promotion), forgetting the writes no snapshot in use predates.
+    '''
+    if snapshot is None:
+      return
+
+    with self._promotion_lock:
+      self._snapshots[snapshot] -= 1
+      if self._snapshots[snapshot] == 0:
+        del self._snapshots[snapshot]
+
+      if not self._snapshots:
+        self._written.clear()
+      elif len(self._written) >= self._prune_at:
+        oldest = min(self._snapshots)
+        for key, count in self._written.items():
+          if count <= oldest:
+            del self._written[key]
+        self._prune_at = max(self._promotions.maxsize, 2 * len(self._written))
+
+  def _note_writes(self, keys):
+    '''Records writes to `keys`, so promotions of values read before them
+    are dropped.
+    '''
+    if self._promotions is None:
+      return
+
+    with self._copy_lock:  # wait for a copy in progress
+      with self._promotion_lock:
+        self._write_count += 1
+        # later snapshots start after this write, so only those in use care.
+        if self._snapshots:
+          for key in keys:
+            self._written[key] = self._write_count
+
+  def _promotion_loop(self):
+    '''Copies queued promotions to the upper tiers, until it gets None.'''
+    while True:
+      promotion = self._promotions.get()
+      if promotion is None:
+        return
+      items, depth, snapshot = promotion
+
+      # skip the keys written since the value was read. Writes wait for the
+      # copy, so they are not overwritten by it. Reads only wait for the
+      # bookkeeping, not for a copy into a stalled tier.
+      with self._copy_lock:
+        with self._promotion_lock:
+          items = [(key, value) for key, value in items
+            if self._written.get(key, 0) <= snapshot]
+
+        try:
+          for store in self._stores[:depth]:
+            store.put_many(items)
+        except Exception:
+          pass  # promoting is an optimization; the next read tries again
+
+      self._release(snapshot)
+
+
+  # write-behind
+
+  def flush(self):
+    '''Waits until every queued write has reached the lower tiers. Raises
+    the last error the flusher ran into since the previous flush, if any
+    (failed writes stay queued, and are retried).
+    '''
+    with self._pending_changed:
+      self._pending_changed.notify_all()
+      while self._pending or self._flushing:
+        if self._flush_error is not None:
+          break
+        self._pending_changed.wait(self.flush_interval)
+
+      error, self._flush_error = self._flush_error, None
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+  def close(self):
+    '''Flushes queued writes, and stops the flusher, promoter and hedging
+    threads.
+    '''
+    if self._hedge_pools is not None:
+      with self._hedge_lock:
+        pools, self._hedge_pools = self._hedge_pools, None
+      for pool, _ in pools.values():
+        pool.close()
+
+    if self._promotions is not None:
+      self._promotions.put(None)
+      self._promoter.join()
+      self._promotions = None
+
+    if self._flusher is None:
+      return
 
+    try:
+      self.flush()
+    finally:
+      with self._pending_changed:
+        self._closed = True
+        self._pending_changed.notify_all()
+      self._flusher.join()
+      self._flusher = None
+      self.write_behind = False
+
+  def _queued(self, key):
+    '''Returns the queued value for `key`, _deleted, or None if not queued.'''
+    with self._pending_changed:
+      value = self._pending.get(key)
+      return value if value is not None else self._flushing.get(key)
+
+  def _enqueue(self, entries):
+    '''Queues (key, value or _deleted) entries for the lower tiers, blocking
+    while the queue is full.
+    '''
+    with self._pending_changed:
+      for key, value in entries:
+        while len(self._pending) >= self.max_pending \
+            and key not in self._pending:
+          self._pending_changed.notify_all()
+          self._pending_changed.wait(self.flush_interval)
+        self._pending[key] = value
+      self._pending_changed.notify_all()
+
+  def _flush_loop(self):
+    '''Writes queued entries to the lower tiers in batches, until closed.'''
+    while True:
+      with self._pending_changed:
+        while not self._pending and not self._closed:
+          self._pending_changed.wait()
+        if not self._pending:
+          return  # closed, and nothing left to write
+
+        if len(self._pending) < self.flush_batch and not self._closed:
+          self._pending_changed.wait(self.flush_interval)  # let writes queue
+
+        batch = []
+        while self._pending and len(batch) < self.flush_batch:
+          batch.append(self._pending.popitem(last=False))
+        self._flushing.update(batch)
+
+      try:
+        self._write_lower_tiers(batch)
+        error = None
+      except Exception:
+        error = sys.exc_info()
+
+      with self._pending_changed:
+        for key, value in batch:
+          del self._flushing[key]
+          if error is not None and key not in self._pending:
+            self._pending[key] = value  # retry, unless since overwritten
+        if error is not None:
+          self._flush_error = error  # reported by the next flush
+        self._pending_changed.notify_all()
+
+      if error is not None:
+        if self._closed:
+          return  # closing after a failed flush: the writes are dropped
+        time.sleep(self.flush_interval)
+
+  def _write_lower_tiers(self, batch):
+    '''Applies a batch of (key, value or _deleted) entries to lower tiers.'''
+    puts = [(key, value) for key, value in batch if value is not _deleted]
+    deletes = [key for key, value in batch if value is _deleted]
+    for store in self._stores[1:]:
+      if puts:
+        store.put_many(puts)
+      if deletes:
+        store.delete_many(deletes)
+
+
+
+
+
+def _digest_hash(key):
+  '''Default sharding function: the builtin hash of the Key's ``digest``,
+  which keys have always been placed by (it is what ``hash(key)`` returned
+  before Keys cached a faster hash).
+  '''
+  return hash(key.digest)
 
 
 
@@ -1086,23 +2203,65 @@ class ShardedDatastore(DatastoreCollection):
   '''Represents a collection of datastore shards.
 
   A datastore is selected based on a sharding function.
-  Sharding functions should take a Key and return an integer.
+  Sharding functions should take a Key and return an integer. By default, the
+  builtin hash of the Key's ``digest`` is used, which depends on the platform's
+  word size. For placement that agrees across all platforms, pass
+  ``shardingfn=attrgetter('digest')`` (moving existing keys; see resharding).
 
   WARNING: adding or removing datastores while mid-use may severely affect
            consistency. Also ensure the order is correct upon initialization.
            While this is not as important for caches, it is crucial for
            persistent datastores.
 
+  The default sharding function remaps nearly every key when the number of
+  stores changes. See :py:mod:`datastore.sharding` for consistent-hash ring
+  and rendezvous sharding functions that only move about 1/N of the keys.
+
+  Queries visit the shards in sequence by default. Given `query_threads`, a
+  thread pool of that width fans each query out to all shards concurrently,
+  streaming results back as they arrive. Call ``close`` to stop its threads.
+
+  Resharding happens online, in migration mode. ``beginMigration`` installs a
+  new routing table (stores and sharding function) while keeping the old one:
+
+    * get      : reads the new shard, falling back to the old one (and then
+                 the new one again, in case the key just moved)
+    * put      : writes the new shard, removing the key from the old one
+    * delete   : deletes from both
+    * contains : checks the new shard, then the old one (and the new again)
+    * query    : queries every distinct store of both tables, returning each
+                 key once
+
+  Meanwhile, ``migrateKey`` (or a :py:class:`ShardMigrator
+  <datastore.ShardMigrator>` in the background) moves keys over, and
+  ``finishMigration`` drops the old table once every key has moved.
+
   '''
 
-  def __init__(self, stores=[], shardingfn=hash):
-    '''Initialize the datastore with any provided datastore.'''
+  def __init__(self, stores=[], shardingfn=_digest_hash, query_threads=0):
+    '''Initialize the datastore with any provided datastore.
+
+    Args:
+      stores: the shards.
+      shardingfn: function taking a Key and returning an integer.
+      query_threads: number of shards to query concurrently. 0 (the default)
+          queries shards one after another in the calling thread.
+    '''
     if not callable(shardingfn):
       raise TypeError('shardingfn (type %s) is not callable' % type(shardingfn))
 
     super(ShardedDatastore, self).__init__(stores)
     self._shardingfn = shardingfn
 
+    # (old stores, old shardingfn) while migrating to a new routing table.
+    self._migration = None
+    self._migration_lock = threading.RLock()
+
+    self._query_pool = None
+    if query_threads:
+      from multiprocessing.pool import ThreadPool
+      self._query_pool = ThreadPool(int(query_threads))
+
 
   def shard(self, key):
     '''Returns the shard index to handle `key`, according to sharding fn.'''
@@ -1113,33 +2272,280 @@ class ShardedDatastore(DatastoreCollection):
     return self.datastore(self.shard(key))
 
 
+  def previousShardDatastore(self, key):
+    '''Returns the shard that handled `key` under the old routing table, if
+    migrating and it differs from the current one. Otherwise, None.
+    '''
+    migration = self._migration
+    if migration is None:
+      return None
+
+    old_stores, old_shardingfn = migration
+    old_store = old_stores[old_shardingfn(key) % len(old_stores)]
+    if old_store is self.shardDatastore(key):
+      return None
+    return old_store
+
+
   def get(self, key):
     '''Return the object named by key from the corresponding datastore.'''
-    return self.shardDatastore(key).get(key)
+    store = self.shardDatastore(key)
+    value = store.get(key)
+    if value is None and self._migration is not None:
+      old_store = self.previousShardDatastore(key)
+      if old_store is not None:
+        value = old_store.get(key)
+        if value is None:
+          value = store.get(key)  # moved by migrateKey between the reads?
+    return value
 
   def put(self, key, value):
     '''Stores the object to the corresponding datastore.'''
-    self.shardDatastore(key).put(key, value)
+    if self._migration is None:
+      self.shardDatastore(key).put(key, value)
+      return
+
+    with self._migration_lock:
+      self.shardDatastore(key).put(key, value)
+      old_store = self.previousShardDatastore(key)
+      if old_store is not None:
+        old_store.delete(key)
 
   def delete(self, key):
     '''Removes the object from the corresponding datastore.'''
-    self.shardDatastore(key).delete(key)
+    if self._migration is None:
+      self.shardDatastore(key).delete(key)
+      return
+
+    with self._migration_lock:
+      self.shardDatastore(key).delete(key)
+      old_store = self.previousShardDatastore(key)
+      if old_store is not None:
+        old_store.delete(key)
 
   def contains(self, key):
     '''Returns whether the object is in this datastore.'''
-    return self.shardDatastore(key).contains(key)
+    store = self.shardDatastore(key)
+    if store.contains(key):
+      return True
+
+    old_store = self.previousShardDatastore(key)
+    if old_store is None:
+      return False
+    # the key may have moved between the two checks.
+    return old_store.contains(key) or store.contains(key)
+
+  def _group_by_shard(self, entries, keyfn):
+    '''Returns a dict of shard index -> [(position, entry)] for `entries`.'''
+    groups = {}
+    for position, entry in enumerate(entries):
+      index = self.shard(keyfn(entry))
+      groups.setdefault(index, []).append((position, entry))
+    return groups
+
+  def _group_by_previous_shard(self, entries, keyfn):
+    '''Returns a list of (old shard, [(position, entry)]) for the `entries`
+    whose old shard differs from the current one.
+    '''
+    groups = {}
+    for position, entry in enumerate(entries):
+      old_store = self.previousShardDatastore(keyfn(entry))
+      if old_store is not None:
+        group = groups.setdefault(id(old_store), (old_store, []))
+        group[1].append((position, entry))
+    return groups.values()
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, making one batch call per shard.'''
+    keys = list(keys)
+    values = [None] * len(keys)
+    self._get_many(keys, values, range(len(keys)))
+
+    if self._migration is not None:
+      missing = [(i, keys[i]) for i, value in enumerate(values) if value is None]
+      groups = self._group_by_previous_shard(missing, lambda entry: entry[1])
+      recheck = []
+      for old_store, group in groups:
+        found = old_store.get_many([key for _, (_, key) in group])
+        for (_, (position, _)), value in zip(group, found):
+          if value is None:
+            recheck.append(position)
+          values[position] = value
+
+      # the keys missing from both may have moved between the two reads.
+      if recheck:
+        self._get_many(keys, values, recheck)
+
+    return values
+
+  def _get_many(self, keys, values, positions):
+    '''Reads the `keys` at `positions` from their shards into `values`.'''
+    groups = self._group_by_shard(positions, lambda position: keys[position])
+    for index, group in groups.items():
+      found = self.datastore(index).get_many([keys[p] for _, p in group])
+      for (_, position), value in zip(group, found):
+        values[position] = value
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair, making one batch call per shard.'''
+    if self._migration is None:
+      self._put_many(items)
+      return
+
+    with self._migration_lock:
+      items = list(items)
+      self._put_many(items)
+      self._delete_previous_many([key for key, _ in items])
+
+  def _put_many(self, items):
+    groups = self._group_by_shard(items, lambda item: item[0])
+    for index, group in groups.items():
+      self.datastore(index).put_many([item for _, item in group])
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`, making one batch call per shard.'''
+    if self._migration is None:
+      self._delete_many(keys)
+      return
+
+    with self._migration_lock:
+      keys = list(keys)
+      self._delete_many(keys)
+      self._delete_previous_many(keys)
+
+  def _delete_many(self, keys):
+    groups = self._group_by_shard(keys, lambda key: key)
+    for index, group in groups.items():
+      self.datastore(index).delete_many([key for _, key in group])
+
+  def _delete_previous_many(self, keys):
+    '''Removes `keys` from their old shards, if migrating.'''
+    for old_store, group in self._group_by_previous_shard(keys, lambda k: k):
+      old_store.delete_many([key for _, key in group])
+
+  def close(self):
+    '''Stops the query threads, once the queries they serve are done (query
+    cursors must be exhausted or collected first). Later queries visit the
+    shards in sequence.
+    '''
+    if self._query_pool is not None:
+      pool, self._query_pool = self._query_pool, None
+      pool.close()
+      pool.join()
+
+
+  # resharding
+
+  def isMigrating(self):
+    '''Returns whether this datastore is migrating to a new routing table.'''
+    return self._migration is not None
+
+  def beginMigration(self, stores, shardingfn=None):
+    '''Starts migrating to a new routing table: `stores`, sharded by
+    `shardingfn` (by default, the current sharding function).
+
+    The old routing table is kept until ``finishMigration``. Pass a new
+    sharding function object rather than mutating the current one, as both
+    tables must keep routing the way they did.
+    '''
+    stores = list(stores)
+    for store in stores:
+      if not isinstance(store, Datastore):
+        raise TypeError("all stores must be of type %s" % Datastore)
+
+    shardingfn = shardingfn or self._shardingfn
+    if not callable(shardingfn):
+      raise TypeError('shardingfn (type %s) is not callable' % type(shardingfn))
+
+    with self._migration_lock:
+      if self._migration is not None:
+        raise RuntimeError('%s is already migrating' % self)
+
+      self._migration = (self._stores, self._shardingfn)
+      self._stores = stores
+      self._shardingfn = shardingfn
+
+  def finishMigration(self):
+    '''Drops the old routing table. Call once every key has been moved.'''
+    with self._migration_lock:
+      self._migration = None
+
+  def migrateKey(self, key):
+    '''Moves the object named by `key` from its old shard to its new one.
+    A value already written to the new shard is kept. Returns whether an
+    object was moved.
+    '''
+    if self._migration is None:
+      return False
+
+    with self._migration_lock:
+      old_store = self.previousShardDatastore(key)
+      if old_store is None:
+        return False
+
+      value = old_store.get(key)
+      if value is None:
+        return False
+
+      store = self.shardDatastore(key)
+      if not store.contains(key):
+        store.put(key, value)
+      old_store.delete(key)
+      return True
+
+  def _query_stores(self):
+    '''Returns the distinct stores of the current and old routing tables.'''
+    migration = self._migration
+    if migration is None:
+      return self._stores
+
+    stores = list(self._stores)
+    for store in migration[0]:
+      if not any(store is other for other in stores):
+        stores.append(store)
+    return stores
 
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
-    cursor = Cursor(query, self.shard_query_generator(query))
-    cursor.apply_order()  # ordering sharded queries is expensive (no generator)
+    migrating = self._migration is not None
+    if query.orders:
+      iterable = self.shard_query_merge_generator(query)
+    elif self._query_pool is not None:
+      iterable = self.shard_query_parallel_generator(query)
+    elif migrating:
+      iterable = self.shard_query_unpaged_generator(query)
+    else:
+      return Cursor(query, self.shard_query_generator(query))
+
+    # a key being migrated may be in both its old and new shard.
+    if migrating:
+      iterable = self._unique_keys_generator(query, iterable)
+
+    # shards are queried without offset, so it is applied here.
+    cursor = Cursor(query, iterable)
+    cursor.apply_offset()
+    cursor.apply_limit()
     return cursor
 
+  def _unpaged_shard_query(self, query):
+    '''Returns a copy of `query` to send to every shard when results are
+    combined here. Which shard's results fall within the offset is unknown
+    until they are combined, so each shard is asked for (at most)
+    ``offset + limit`` results from the start, and the caller's cursor applies
+    `offset` and `limit` to the combined stream. Its ``skipped`` and
+    ``returned`` counters thus account for the query as a whole.
+    '''
+    shard_query = query.copy()
+    shard_query.offset = 0
+    if query.limit is not None:
+      shard_query.limit = query.offset + query.limit
+    return shard_query
+
   def shard_query_generator(self, query):
     '''A generator that queries each shard in sequence.'''
     shard_query = query.copy()
 
-    for shard in self._stores:
+    for shard in self._query_stores():
       # yield all items matching within this shard
       cursor = shard.query(shard_query)
       for item in cursor:
@@ -1153,6 +2559,66 @@ class ShardedDatastore(DatastoreCollection):
         if shard_query.limit <= 0:
           break  # we're already done!
 
+  def shard_query_unpaged_generator(self, query):
+    '''A generator that queries each shard in sequence, without offset.
+    The caller applies `offset` and `limit` (see ``_unpaged_shard_query``).
+    '''
+    shard_query = self._unpaged_shard_query(query)
+    for shard in self._query_stores():
+      for item in shard.query(shard_query):
+        yield item
+
+  def _unique_keys_generator(self, query, iterable):
+    '''A generator that skips the objects of `iterable` whose key was seen
+    already (objects without a key are all returned).
+    '''
+    seen = set()
+    for item in iterable:
+      try:
+        key = query.object_getattr(item, 'key')
+      except (AttributeError, KeyError, IndexError, TypeError):
+        key = None  # e.g., plain string values
+      if key is not None:
+        if key in seen:
+          continue
+        seen.add(key)
+      yield item
+
+  def shard_query_parallel_generator(self, query):
+    '''A generator that queries all shards concurrently in the query pool.
+    The caller applies `offset` and `limit` (see ``_unpaged_shard_query``).
+    '''
+    shard_query = self._unpaged_shard_query(query)
+
+    def shard_results(shard):
+      # runs in the pool: the shard query itself happens off this thread.
+      for item in shard.query(shard_query):
+        yield item
+
+    iterables = [shard_results(shard) for shard in self._query_stores()]
+    return parallel_chain_gen(iterables, self._query_pool)
+
+  def shard_query_merge_generator(self, query):
+    '''A generator that merges the ordered results of every shard.
+
+    Each shard returns its results sorted by ``query.orders``, so a k-way
+    merge streams the global order holding one result per shard, and stops
+    pulling from shards as soon as the caller stops iterating. The caller
+    applies `offset` and `limit` (see ``_unpaged_shard_query``). With a query
+    pool, the shard queries are issued concurrently.
+    '''
+    shard_query = self._unpaged_shard_query(query)
+
+    stores = self._query_stores()
+    if self._query_pool is not None:
+      query_shard = lambda shard: shard.query(shard_query)
+      cursors = self._query_pool.map(query_shard, stores)
+    else:
+      cursors = [shard.query(shard_query) for shard in stores]
+
+    for item in ordered_merge_gen(query.orders, cursors):
+      yield item
+
 
 '''
 
@@ -0,0 +1,312 @@
+'''
+Bloom filter membership shim.
+
+A :py:class:`BloomFilterDatastore` keeps a counting Bloom filter of the keys
+stored in its child datastore. Keys the filter has never seen are certainly
+absent, so ``get`` and ``contains`` for them return at once, without reaching
+the child (e.g. without the stat calls of a filesystem datastore). Keys the
+filter reports as present are looked up in the child as usual; the share of
+absent keys that still reach the child is the filter's `error_rate`, as long
+as it holds at most `capacity` keys.
+
+The filter is built from the keys in the child when the shim is created,
+and kept up to date by ``put`` and ``delete``. It can be saved to a file on
+``close``, and loaded from it on the next start instead of scanning keys::
+
+    >>> ds = BloomFilterDatastore(fs, capacity=1000000, path='/data/keys.bloom',
+    ...     keys=lambda: all_keys(fs))
+    >>> ...
+    >>> ds.close()  # saves the filter
+
+'''
+
+import array
+import math
+import os
+import struct
+import tempfile
+import threading
+
+from basic import ShimDatastore
+from key import Key
+from util import fasthash
+
+
+class CountingBloomFilter(object):
+  '''Bloom filter with a small counter per position, so items can be removed.
+
+  Sized for `capacity` items at a false positive rate of `error_rate`.
+  Counters saturate at 255, and are never decremented past that point (the
+  positions stay set), so removals cannot cause false negatives.
+
+  Args:
+    capacity: number of items the filter is sized for.
+    error_rate: false positive rate at `capacity` items.
+  '''
+
+  _header = struct.Struct('>4sQQQ')
+  _magic = 'CBF1'
+  _saturated = 255
+
+  def __init__(self, capacity=100000, error_rate=0.01):
+    if capacity <= 0:
+      raise ValueError('capacity must be positive')
+    if not 0 < error_rate < 1:
+      raise ValueError('error_rate must be between 0 and 1')
+
+    self.capacity = capacity
+    self.error_rate = error_rate
+    size = -capacity * math.log(error_rate) / math.log(2) ** 2
+    self._size = max(1, int(math.ceil(size)))
+    self._hashes = max(1, int(round(self._size * math.log(2) / capacity)))
+    self._counters = array.array('B', [0]) * self._size
+    self._count = 0
+
+  def __len__(self):
+    '''Returns the number of items added (and not removed).'''
+    return self._count
+
+  def _positions(self, item):
+    '''Returns the counter positions of `item` (by double hashing).'''
+    digest = item.digest if isinstance(item, Key) else fasthash.digest(item)
+    h1 = digest & 0xffffffffffffffff
+    h2 = (digest >> 64) & 0xffffffffffffffff | 1
+    return [(h1 + i * h2) % self._size for i in xrange(0, self._hashes)]
+
+  def __contains__(self, item):
+    counters = self._counters
+    for position in self._positions(item):
+      if not counters[position]:
+        return False
+    return True
+
+  def add(self, item):
+    '''Adds `item` to the filter.'''
+    counters = self._counters
+    for position in self._positions(item):
+      if counters[position] < self._saturated:
+        counters[position] += 1
+    self._count += 1
+
+  def remove(self, item):
+    '''Removes `item`, which must have been added, from the filter.'''
+    counters = self._counters
+    for position in self._positions(item):
+      if 0 < counters[position] < self._saturated:
+        counters[position] -= 1
+    self._count = max(0, self._count - 1)
+
+  def clear(self):
+    '''Removes every item.'''
+    self._counters = array.array('B', [0]) * self._size
+    self._count = 0
+
+  def save(self, path):
+    '''Writes the filter to the file at `path` (replacing it atomically).'''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.bloom-')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(self._header.pack(self._magic, self.capacity,
+            self._hashes, self._count))
+        f.write(struct.pack('>d', self.error_rate))
+        f.write(self._counters.tostring())
+      os.rename(tmp, path)
+    except:
+      os.remove(tmp)
+      raise
+
+  @classmethod
+  def load(cls, path):
+    '''Returns the filter saved in the file at `path`.
+
+    Raises:
+      ValueError: if the file does not hold a saved filter.
+    '''
+    with open(path, 'rb') as f:
+      header = f.read(cls._header.size + 8)
+      if len(header) != cls._header.size + 8:
+        raise ValueError('%s is not a saved bloom filter' % path)
+
+      magic, capacity, hashes, count = cls._header.unpack(
+          header[:cls._header.size])
+      error_rate, = struct.unpack('>d', header[cls._header.size:])
+      if magic != cls._magic:
+        raise ValueError('%s is not a saved bloom filter' % path)
+
+      bloom = cls(capacity, error_rate)
+      counters = array.array('B', f.read())
+      if len(counters) != bloom._size or hashes != bloom._hashes:
+        raise ValueError('%s holds a corrupt bloom filter' % path)
+
+    bloom._counters = counters
+    bloom._count = count
+    return bloom
+
+
+
+class BloomFilterDatastore(ShimDatastore):
+  '''Shim keeping a counting Bloom filter of the keys in its child datastore,
+  to answer ``get`` and ``contains`` for absent keys without the child.
+
+  The filter is loaded from `path`, if given and the file exists, or else
+  built from `keys`, an iterable (or function returning one) of every key in
+  the child. All writes to the child must go through this shim; keys written
+  around it may be reported missing.
+
+  A loaded filter file is removed right away, and saved again by ``close``:
+  after a crash, writes may be missing from the last saved filter, so it is
+  rebuilt from `keys` instead.
+
+  Writes to the same key are serialized by one of `stripes` locks, picked by
+  key hash; writes to other keys mostly proceed concurrently. Overwrites of
+  keys in the filter cost an extra ``contains`` on the child, as a false
+  positive must still be added, and a true one must not be counted twice.
+
+  Args:
+    datastore: the child datastore.
+    capacity: number of keys the filter is sized for.
+    error_rate: share of lookups for absent keys that reach the child, at
+        `capacity` keys.
+    path: file to save the filter to on ``close`` (optional).
+    keys: keys in the child, to build the filter from (when not loaded).
+    stripes: number of locks serializing writes to the keys hashed to them.
+
+  Raises:
+    ValueError: if the filter can neither be loaded nor built.
+  '''
+
+  def __init__(self, datastore, capacity=100000, error_rate=0.01, path=None,
+      keys=None, stripes=64):
+    super(BloomFilterDatastore, self).__init__(datastore)
+    self.path = path
+    self._stripes = [threading.Lock() for _ in range(int(stripes))]
+    self._lock = threading.Lock()  # guards the filter's counters
+
+    self.bloom = None
+    if path is not None and os.path.exists(path):
+      try:
+        self.bloom = CountingBloomFilter.load(path)
+      except ValueError:
+        pass  # rebuild it from keys
+      os.remove(path)
+
+    if self.bloom is None:
+      if keys is None:
+        raise ValueError('keys are required to build the filter')
+      self.bloom = CountingBloomFilter(capacity, error_rate)
+      self.rebuild(keys)
+
+  def rebuild(self, keys):
+    '''Rebuilds the filter from `keys`, every key in the child datastore
+    (an iterable, or function returning one).
+    '''
+    if callable(keys):
+      keys = keys()
+
+    self._acquire_stripes()
+    try:
+      with self._lock:
+        self.bloom.clear()
+        for key in keys:
+          self.bloom.add(key)
+    finally:
+      self._release_stripes()
+
+  def _stripe(self, key):
+    '''Returns the lock serializing writes to `key`.'''
+    return self._stripes[hash(key) % len(self._stripes)]
+
+  def _acquire_stripes(self):
+    '''Blocks every write, taking the stripe locks in order.'''
+    for lock in self._stripes:
+      lock.acquire()
+
+  def _release_stripes(self):
+    for lock in reversed(self._stripes):
+      lock.release()
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+    Absent keys are not looked up in the child datastore.
+    '''
+    if key not in self.bloom:
+      return None
+    return self.child_datastore.get(key)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`, adding `key` to the filter.'''
+    if value is None:
+      self.delete(key)
+      return
+
+    with self._stripe(key):
+      added = key not in self.bloom or not self.child_datastore.contains(key)
+      self.child_datastore.put(key, value)
+      if added:
+        with self._lock:
+          self.bloom.add(key)
+
+  def delete(self, key):
+    '''Removes the object named by `key`, and `key` from the filter.'''
+    with self._stripe(key):
+      if key not in self.bloom:
+        return
+
+      # only remove keys actually added, or other keys may go missing.
+      if self.child_datastore.contains(key):
+        self.child_datastore.delete(key)
+        with self._lock:
+          self.bloom.remove(key)
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists.
+    Absent keys are not looked up in the child datastore.
+    '''
+    return key in self.bloom and self.child_datastore.contains(key)
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, asking the child datastore only
+    for the keys that may exist.
+    '''
+    keys = list(keys)
+    values = [None] * len(keys)
+    maybe = [i for i, key in enumerate(keys) if key in self.bloom]
+    if maybe:
+      found = self.child_datastore.get_many([keys[i] for i in maybe])
+      for i, value in zip(maybe, found):
+        values[i] = value
+    return values
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.'''
+    for key, value in items:
+      self.put(key, value)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    for key in keys:
+      self.delete(key)
+
+  def save(self):
+    '''Saves the filter to `path`.
+
+    Raises:
+      ValueError: if the shim has no `path`.
+    '''
+    if self.path is None:
+      raise ValueError('BloomFilterDatastore has no path to save to.')
+
+    self._acquire_stripes()
+    try:
+      with self._lock:
+        self.bloom.save(self.path)
+    finally:
+      self._release_stripes()
+
+  def close(self):
+    '''Saves the filter to `path`, if given. The shim is not to be used
+    afterwards, as later writes would be missing from the saved filter.
+    '''
+    if self.path is not None:
+      self.save()
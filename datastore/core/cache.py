@@ -0,0 +1,399 @@
+'''
+Bounded in-memory datastores, for use as caches.
+
+:py:class:`CacheDatastore` is a :py:class:`DictDatastore
+<datastore.DictDatastore>` with a capacity, by number of entries and/or by
+estimated size in bytes. Once over capacity, it evicts entries chosen by an
+eviction policy:
+
+  * LRUPolicy evicts the least recently used entry.
+  * LFUPolicy evicts the least frequently used entry (least recently used
+    among equally frequent ones).
+
+Both run in O(1) per operation. Entries may also expire, after a default
+`ttl` for the datastore or one given per ``put``. Expired entries are
+dropped lazily when read, and by ``sweep``, which a background thread can
+run every `sweep_interval` seconds. Deadlines are kept in a TimerWheel, so
+a sweep only visits the entries due since the previous one.
+
+A CacheDatastore fits as the first tier of a TieredDatastore, or as the
+cache of a CacheShimDatastore::
+
+    >>> cache = CacheDatastore(max_entries=10000, policy=LFUPolicy, ttl=60,
+    ...     sweep_interval=5)
+    >>> ds = CacheShimDatastore(database, cache=cache)
+    >>> ...
+    >>> cache.put(session_key, session, ttl=900)
+    >>> ...
+    >>> cache.hits, cache.misses, cache.evictions, cache.expirations
+    (8812, 1203, 412, 77)
+
+'''
+
+import sys
+import time
+import threading
+
+from collections import OrderedDict
+
+from basic import DictDatastore
+
+
+class EvictionPolicy(object):
+  '''Tracks the keys of a CacheDatastore to choose which to evict.'''
+
+  def __len__(self):
+    raise NotImplementedError
+
+  def insert(self, key):
+    '''Notes that `key` was added.'''
+    raise NotImplementedError
+
+  def access(self, key):
+    '''Notes that `key` was read or overwritten.'''
+    raise NotImplementedError
+
+  def remove(self, key):
+    '''Notes that `key` was removed.'''
+    raise NotImplementedError
+
+  def victim(self, keep=None):
+    '''Returns the key to evict next, other than `keep`.'''
+    raise NotImplementedError
+
+
+
+class LRUPolicy(EvictionPolicy):
+  '''Least recently used eviction, keeping keys in recency order.'''
+
+  def __init__(self):
+    self._keys = OrderedDict()
+
+  def __len__(self):
+    return len(self._keys)
+
+  def insert(self, key):
+    self._keys[key] = None
+
+  def access(self, key):
+    del self._keys[key]
+    self._keys[key] = None
+
+  def remove(self, key):
+    del self._keys[key]
+
+  def victim(self, keep=None):
+    for key in self._keys:
+      if key != keep:
+        return key
+
+
+
+class LFUPolicy(EvictionPolicy):
+  '''Least frequently used eviction, with keys bucketed by access count.
+  Among keys with the same count, the least recently used one is evicted.
+  '''
+
+  def __init__(self):
+    self._counts = {}  # key -> access count
+    self._buckets = {}  # access count -> OrderedDict of keys
+    self._min = 0
+
+  def __len__(self):
+    return len(self._counts)
+
+  def _bucket_add(self, key, count):
+    self._counts[key] = count
+    if count not in self._buckets:
+      self._buckets[count] = OrderedDict()
+    self._buckets[count][key] = None
+
+  def _bucket_remove(self, key):
+    count = self._counts.pop(key)
+    bucket = self._buckets[count]
+    del bucket[key]
+    if not bucket:
+      del self._buckets[count]
+    return count
+
+  def insert(self, key):
+    self._bucket_add(key, 1)
+    self._min = 1
+
+  def access(self, key):
+    count = self._bucket_remove(key)
+    if count == self._min and count not in self._buckets:
+      self._min = count + 1
+    self._bucket_add(key, count + 1)
+
+  def remove(self, key):
+    self._bucket_remove(key)
+
+  def victim(self, keep=None):
+    if self._min not in self._buckets:
+      self._min = min(self._buckets)  # only after removals
+    for key in self._buckets[self._min]:
+      if key != keep:
+        return key
+
+    # `keep` alone is the least frequently used.
+    count = min(count for count in self._buckets if count != self._min)
+    return next(iter(self._buckets[count]))
+
+
+
+class TimerWheel(object):
+  '''Hashed timer wheel, tracking the deadlines of items.
+
+  Time is divided in ticks of `resolution` seconds, and each tick maps to
+  one of `slots` buckets (wrapping around). Scheduling is O(1), and
+  collecting expired items only visits the buckets of the ticks elapsed
+  since the previous collection (items due in later rotations stay put).
+
+  Args:
+    resolution: length of a tick, in seconds.
+    slots: number of buckets in the wheel.
+  '''
+
+  def __init__(self, resolution=1.0, slots=512):
+    self.resolution = float(resolution)
+    self._slots = [dict() for _ in xrange(0, slots)]
+    self._tick = int(time.time() / self.resolution)
+
+  def __len__(self):
+    return sum(map(len, self._slots))
+
+  def _slot(self, deadline):
+    return self._slots[int(deadline / self.resolution) % len(self._slots)]
+
+  def schedule(self, item, deadline):
+    '''Schedules `item` to expire at `deadline` (a time.time() value).'''
+    self._slot(deadline)[item] = deadline
+
+  def unschedule(self, item, deadline):
+    '''Removes `item`, scheduled at `deadline`, from the wheel.'''
+    slot = self._slot(deadline)
+    if slot.get(item) == deadline:
+      del slot[item]
+
+  def expired(self, now=None):
+    '''Removes and returns the (item, deadline) pairs due by `now`.'''
+    now = time.time() if now is None else now
+    tick = int(now / self.resolution)
+
+    # visit each elapsed tick (at most one rotation), and the current one.
+    first = max(self._tick, tick - len(self._slots) + 1)
+    expired = []
+    for visited in xrange(first, tick + 1):
+      slot = self._slots[visited % len(self._slots)]
+      due = [(item, deadline) for item, deadline in slot.iteritems()
+        if deadline <= now]
+      for item, _ in due:
+        del slot[item]
+      expired.extend(due)
+
+    self._tick = tick
+    return expired
+
+
+
+class CacheDatastore(DictDatastore):
+  '''In-memory datastore bounded by entry count and/or estimated byte size.
+
+  When a ``put`` brings the datastore over capacity, entries chosen by the
+  eviction policy are removed until it fits again. Values larger than
+  `max_bytes` on their own are not stored at all. Counts of ``get`` hits and
+  misses, evictions and expirations are kept in `hits`, `misses`,
+  `evictions` and `expirations`.
+
+  Args:
+    max_entries: maximum number of entries (None for no limit).
+    max_bytes: maximum total size of the values (None for no limit).
+    policy: EvictionPolicy subclass (LRUPolicy by default).
+    sizeof: function estimating the size of a value in bytes. The default,
+        ``sys.getsizeof``, does not follow references (e.g. it does not count
+        the items of a dict), so pass a better estimate for nested values.
+    ttl: default number of seconds entries live for (None for no expiry).
+    sweep_interval: seconds between background sweeps of expired entries
+        (None to only expire entries lazily, or through ``sweep`` calls).
+  '''
+
+  def __init__(self, max_entries=None, max_bytes=None, policy=None,
+      sizeof=sys.getsizeof, ttl=None, sweep_interval=None):
+    super(CacheDatastore, self).__init__()
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof
+    self.ttl = ttl
+
+    self._policy = (policy or LRUPolicy)()
+    self._sizes = {}
+    self._bytes = 0
+    self._lock = threading.RLock()
+
+    self._deadlines = {}
+    self._wheel = TimerWheel(resolution=min(1.0, sweep_interval or 1.0))
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+    self._closed = threading.Event()
+    self._sweeper = None
+    if sweep_interval:
+      self._sweeper = threading.Thread(target=self._sweep_loop,
+          args=(sweep_interval,), name='CacheDatastore sweeper')
+      self._sweeper.daemon = True
+      self._sweeper.start()
+
+  @property
+  def size(self):
+    '''Returns the estimated size of the stored values, in bytes.'''
+    return self._bytes
+
+  def get(self, key):
+    '''Return the object named by `key` or None, noting a hit or a miss.'''
+    with self._lock:
+      self._expire(key)
+      value = super(CacheDatastore, self).get(key)
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self._policy.access(key)
+      return value
+
+  def put(self, key, value, ttl=None):
+    '''Stores the object `value` named by `key`, evicting other entries if
+    the datastore goes over capacity.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+      ttl: seconds the entry lives for (defaults to the datastore's `ttl`).
+    '''
+    if value is None:
+      self.delete(key)
+      return
+
+    ttl = self.ttl if ttl is None else ttl
+    size = self.sizeof(value)
+    with self._lock:
+      if self.max_bytes is not None and size > self.max_bytes:
+        self.delete(key)  # would evict everything else, and still not fit
+        return
+
+      if ttl is not None and ttl <= 0:
+        self.delete(key)  # already expired
+        return
+
+      self._unschedule(key)
+      if ttl is not None:
+        deadline = time.time() + ttl
+        self._deadlines[key] = deadline
+        self._wheel.schedule(key, deadline)
+
+      if key in self._sizes:
+        self._bytes -= self._sizes[key]
+        self._policy.access(key)
+      else:
+        self._policy.insert(key)
+      self._sizes[key] = size
+      self._bytes += size
+
+      super(CacheDatastore, self).put(key, value)
+      self._evict(key)
+
+  def delete(self, key):
+    '''Removes the object named by `key`.'''
+    with self._lock:
+      if key in self._sizes:
+        self._bytes -= self._sizes.pop(key)
+        self._policy.remove(key)
+        self._unschedule(key)
+      super(CacheDatastore, self).delete(key)
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists (not a hit or miss).'''
+    with self._lock:
+      self._expire(key)
+      return key in self._sizes
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, noting hits and misses.'''
+    return [self.get(key) for key in keys]
+
+  def put_many(self, items, ttl=None):
+    '''Stores every `(key, value)` pair in `items`.'''
+    for key, value in items:
+      self.put(key, value, ttl=ttl)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`.'''
+    for key in keys:
+      self.delete(key)
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+    (without affecting eviction order).
+    '''
+    with self._lock:
+      self.sweep()
+      cursor = super(CacheDatastore, self).query(query)
+      cursor._iterable = list(cursor._iterable)  # evictions may follow
+      return cursor
+
+  def clear(self):
+    '''Removes every entry (counters are kept).'''
+    with self._lock:
+      for key in list(self._sizes):
+        self.delete(key)
+
+  def sweep(self):
+    '''Removes every expired entry. Returns the number removed.'''
+    with self._lock:
+      expired = 0
+      for key, deadline in self._wheel.expired():
+        if self._deadlines.get(key) == deadline:
+          self.delete(key)
+          expired += 1
+      self.expirations += expired
+      return expired
+
+  def close(self):
+    '''Stops the background sweeper, if any.'''
+    self._closed.set()
+    if self._sweeper is not None:
+      self._sweeper.join()
+
+  def _sweep_loop(self, interval):
+    while not self._closed.wait(interval):
+      self.sweep()
+
+  def _expire(self, key):
+    '''Removes the entry named by `key` if it has expired.'''
+    deadline = self._deadlines.get(key)
+    if deadline is not None and deadline <= time.time():
+      self.delete(key)
+      self.expirations += 1
+
+  def _unschedule(self, key):
+    deadline = self._deadlines.pop(key, None)
+    if deadline is not None:
+      self._wheel.unschedule(key, deadline)
+
+  def _evict(self, keep):
+    '''Evicts entries until within capacity, sparing the entry `keep`.'''
+    while self._over_capacity() and len(self._policy) > 1:
+      key = self._policy.victim(keep)
+      self.delete(key)
+      self.evictions += 1
+
+  def _over_capacity(self):
+    if self.max_entries is not None and len(self._sizes) > self.max_entries:
+      return True
+    return self.max_bytes is not None and self._bytes > self.max_bytes
+
+  def __len__(self):
+    return len(self._sizes)
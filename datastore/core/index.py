@@ -0,0 +1,226 @@
+'''
+Secondary indexes for :py:class:`DictDatastore <datastore.DictDatastore>`.
+
+An index maps the values of one field of the objects in a collection to the
+keys of those objects, and is kept up to date as objects are ``put`` and
+``delete``d. Queries on the collection use an index to find the candidate
+objects for a filter (or to read objects in order) instead of scanning the
+whole collection::
+
+    >>> ds = DictDatastore()
+    >>> ds.addIndex(Key('/users/user'), 'email', HashIndex)
+    >>> ds.addIndex(Key('/users/user'), 'age', SortedIndex)
+    >>>
+    >>> q = Query(Key('/users/user')).filter('email', '=', 'ann@example.com')
+    >>> ds.query(q)  # one dict lookup
+    >>>
+    >>> q = Query(Key('/users/user'), limit=10).order('-age')
+    >>> ds.query(q)  # reads the 10 oldest users, in order
+
+Indexes only narrow down the candidates; the full query still runs on them,
+so results are the same as without the index. An index is not used when its
+stored values and the filter value differ in type (queries coerce values to
+the filter value's type, which an index cannot follow), or when the query
+uses a custom ``object_getattr``.
+
+'''
+
+import bisect
+
+from query import _object_getattr
+from query import _field_getter
+
+
+_integral = (int, long)
+_numeric = (int, long, float)
+
+
+class Index(object):
+  '''Base class for secondary indexes on a `field` of a collection.
+
+  Args:
+    field: the attribute name (string) of the objects to index.
+    object_getattr: function to extract `field` from objects (must match the
+        one used by queries for the index to be used).
+  '''
+
+  operators = []
+  '''Filter operators this index can find candidates for.'''
+
+  def __init__(self, field, object_getattr=_object_getattr):
+    self.field = field
+    self.object_getattr = object_getattr
+    self._getter = _field_getter(object_getattr, field)
+    self._classes = {}  # class -> count of indexed values of that class
+
+  def __len__(self):
+    raise NotImplementedError
+
+  def add(self, key, obj):
+    '''Indexes object `obj` named by `key`.'''
+    value = self._getter(obj)
+    cls = value.__class__
+    self._classes[cls] = self._classes.get(cls, 0) + 1
+    self._add(key, value)
+
+  def remove(self, key, obj):
+    '''Removes object `obj` named by `key` from the index.'''
+    value = self._getter(obj)
+    cls = value.__class__
+    self._classes[cls] -= 1
+    if self._classes[cls] == 0:
+      del self._classes[cls]
+    self._remove(key, value)
+
+  def usableFor(self, filter):
+    '''Returns whether this index can find the candidates for `filter`.'''
+    if filter.field != self.field or filter.op not in self.operators:
+      return False
+    if filter.object_getattr is not self.object_getattr:
+      return False
+    return self._comparable(filter.value)
+
+  def _comparable(self, target):
+    '''Returns whether indexed values compare with `target` as they would in
+    a query, that is, no indexed value would be coerced to another type,
+    other than without loss (integers to float or long).
+    '''
+    if target is None:
+      return False
+
+    target_class = target.__class__
+    for cls in self._classes:
+      if cls is type(None) or issubclass(cls, target_class):
+        continue
+      if issubclass(target_class, float) and issubclass(cls, _numeric):
+        continue
+      if target_class in _integral and issubclass(cls, _integral):
+        continue
+      return False
+    return True
+
+  def candidates(self, filter):
+    '''Returns the keys of the objects that may pass `filter`.'''
+    raise NotImplementedError
+
+  def _add(self, key, value):
+    raise NotImplementedError
+
+  def _remove(self, key, value):
+    raise NotImplementedError
+
+
+
+class HashIndex(Index):
+  '''Index mapping each field value to the set of keys with that value.
+  Finds the candidates for equality filters ('=' and '!=').
+  '''
+
+  operators = ['=', '!=']
+
+  def __init__(self, field, object_getattr=_object_getattr):
+    super(HashIndex, self).__init__(field, object_getattr)
+    self._keys = {}
+    self._unhashable = set()
+
+  def __len__(self):
+    return sum(map(len, self._keys.values())) + len(self._unhashable)
+
+  def _add(self, key, value):
+    try:
+      self._keys.setdefault(value, set()).add(key)
+    except TypeError:
+      self._unhashable.add(key)
+
+  def _remove(self, key, value):
+    try:
+      keys = self._keys[value]
+    except TypeError:
+      self._unhashable.discard(key)
+      return
+    except KeyError:
+      return
+
+    keys.discard(key)
+    if not keys:
+      del self._keys[value]
+
+  def _comparable(self, target):
+    try:
+      hash(target)
+    except TypeError:
+      return False
+    return super(HashIndex, self)._comparable(target)
+
+  def candidates(self, filter):
+    '''Returns the keys of the objects that may pass `filter`.'''
+    if filter.op == '=':
+      return self._keys.get(filter.value, ())
+
+    keys = []
+    for value, value_keys in self._keys.iteritems():
+      if not value == filter.value:
+        keys.extend(value_keys)
+    keys.extend(self._unhashable)
+    return keys
+
+
+
+class SortedIndex(Index):
+  '''Index keeping field values (and their keys) sorted, using bisection.
+  Finds the candidates for every filter operator, in field order, and can
+  read a whole collection in field order.
+  '''
+
+  operators = ['<', '<=', '=', '!=', '>=', '>']
+
+  def __init__(self, field, object_getattr=_object_getattr):
+    super(SortedIndex, self).__init__(field, object_getattr)
+    self._values = []
+    self._keys = []
+
+  def __len__(self):
+    return len(self._keys)
+
+  def _add(self, key, value):
+    position = bisect.bisect_right(self._values, value)
+    self._values.insert(position, value)
+    self._keys.insert(position, key)
+
+  def _remove(self, key, value):
+    start = bisect.bisect_left(self._values, value)
+    end = bisect.bisect_right(self._values, value)
+    for position in xrange(start, end):
+      if self._keys[position] == key:
+        del self._values[position]
+        del self._keys[position]
+        return
+
+  def usableForOrder(self, order):
+    '''Returns whether this index can read objects sorted by `order`.'''
+    return order.field == self.field and \
+      order.object_getattr is self.object_getattr
+
+  def keys(self, descending=False):
+    '''Returns all keys, sorted by field value.'''
+    return reversed(self._keys) if descending else iter(self._keys)
+
+  def candidates(self, filter):
+    '''Returns the keys of the objects that may pass `filter`, sorted by
+    field value.
+    '''
+    start = bisect.bisect_left(self._values, filter.value)
+    end = bisect.bisect_right(self._values, filter.value)
+    ranges = {
+      '<'  : [(0, start)],
+      '<=' : [(0, end)],
+      '='  : [(start, end)],
+      '!=' : [(0, start), (end, len(self._keys))],
+      '>=' : [(start, len(self._keys))],
+      '>'  : [(end, len(self._keys))],
+    }[filter.op]
+
+    keys = []
+    for start, end in ranges:
+      keys.extend(self._keys[start:end])
+    return keys
@@ -34,6 +34,58 @@ class Namespace(str):
 
 
 
+class KeyPool(object):
+  '''A bounded pool of canonical Key instances, by string.
+
+  When installed as ``Key.pool``, constructing a Key from a string already in
+  the pool returns the pooled instance, skipping normalization and sharing
+  its cached list, parent, path, name and hash::
+
+      >>> Key.pool = KeyPool(100000)
+      >>> Key('/Comedy/MontyPython') is Key('/Comedy/MontyPython')
+      True
+
+  The pool keeps two generations of (at most `max_size` / 2) entries each.
+  When the young generation fills up, it replaces the old one, and lookups
+  that hit the old generation move the entry back into the young one. So
+  the pool holds at most `max_size` entries, keeping the recently used ones.
+
+  Args:
+    max_size: maximum number of strings to keep Key instances for.
+  '''
+
+  def __init__(self, max_size=100000):
+    self.max_size = max(2, int(max_size))
+    self._young = {}
+    self._old = {}
+
+  def __len__(self):
+    return len(self._young) + len(self._old)
+
+  def get(self, string):
+    '''Returns the pooled Key for `string`, or None.'''
+    instance = self._young.get(string)
+    if instance is None:
+      instance = self._old.get(string)
+      if instance is not None:
+        self.add(string, instance)
+    return instance
+
+  def add(self, string, instance):
+    '''Pools Key `instance` under `string`.'''
+    young = self._young
+    if len(young) >= self.max_size / 2:
+      self._old = young
+      young = self._young = {}
+    young[string] = instance
+
+  def clear(self):
+    '''Removes every Key from the pool.'''
+    self._young = {}
+    self._old = {}
+
+
+
 class Key(object):
   '''
   A Key represents the unique identifier of an object.
@@ -58,14 +110,60 @@ class Key(object):
 
   '''
 
-  __slots__ = ('_string', '_list')
+  __slots__ = ('_string', '_list', '_hash', '_digest', '_parent', '_path',
+      '_name')
+
+  # optional KeyPool interning canonical Key instances by string (see KeyPool)
+  pool = None
+
+  def __new__(cls, key):
+    if key.__class__ is cls:
+      return key  # keys are immutable
+
+    pool = cls.pool
+    if pool is not None and key.__class__ is str:
+      instance = pool.get(key)
+      if instance is not None and instance.__class__ is cls:
+        return instance
+
+    string = '/'.join(key) if isinstance(key, list) else str(key)
+    instance = cls.fromCanonical(cls.removeDuplicateSlashes(string))
+    if pool is not None and key.__class__ is str:
+      pool.add(key, instance)
+    return instance
+
+  def __reduce__(self):
+    # pickle only the string: cached slots (parents, and hashes that differ
+    # with xxhash installed or not) are rebuilt on the unpickling host.
+    return (self.__class__, (self._string,))
 
-  def __init__(self, key):
-    if isinstance(key, list):
-      key = '/'.join(key)
+  @classmethod
+  def fromCanonical(cls, string):
+    '''Returns the Key for `string`, which must already be canonical (as
+    returned by ``str(key)``): duplicate slashes are not removed.
+
+        >>> Key.fromCanonical('/Comedy/MontyPython')
+        Key('/Comedy/MontyPython')
 
-    self._string = self.removeDuplicateSlashes(str(key))
-    self._list = None
+    '''
+    pool = cls.pool
+    if pool is not None:
+      instance = pool.get(string)
+      if instance is not None and instance.__class__ is cls:
+        return instance
+
+    instance = object.__new__(cls)
+    instance._string = string
+    instance._list = None
+    instance._hash = None
+    instance._digest = None
+    instance._parent = None
+    instance._path = None
+    instance._name = None
+
+    if pool is not None:
+      pool.add(string, instance)
+    return instance
 
 
   def __str__(self):
@@ -105,7 +203,9 @@ class Key(object):
   @property
   def name(self):
     '''Returns the name of this Key, the value of the last namespace.'''
-    return Namespace(self.list[-1]).value
+    if self._name is None:
+      self._name = Namespace(self.list[-1]).value
+    return self._name
 
   @property
   def type(self):
@@ -120,7 +220,9 @@ class Key(object):
   @property
   def path(self):
     '''Returns the path of this Key, the parent and the type.'''
-    return Key(str(self.parent) + '/' + self.type)
+    if self._path is None:
+      self._path = Key(str(self.parent) + '/' + self.type)
+    return self._path
 
   @property
   def parent(self):
@@ -130,9 +232,12 @@ class Key(object):
         Key('/Comedy/MontyPython')
 
     '''
-    if '/' in self._string:
-      return Key(self.list[:-1])
-    raise ValueError('%s is base key (it has no parent)' % repr(self))
+    if self._parent is None:
+      if '/' not in self._string:
+        raise ValueError('%s is base key (it has no parent)' % repr(self))
+      parent = self._string[:self._string.rindex('/')] or '/'
+      self._parent = Key.fromCanonical(parent)
+    return self._parent
 
   def child(self, other):
     '''Returns the child Key by appending namespace `other`.
@@ -176,15 +281,23 @@ class Key(object):
   def __hash__(self):
     '''Returns the hash of this Key.
 
-    Note that for the purposes of this Key (that is, to use it and its hash
-    values as unique identifiers across systems and platforms), the hash(.)
-    builtin is not adequate (as it is not guaranteed to return the same hash
-    value for two different interpreter runs, let alone different machines).
+    Keys are hashed on every dict and set lookup, so this is a fast 64-bit
+    hash, computed once and cached on the Key. It is deterministic across
+    runs, but not guaranteed to match across installations. Use `digest` to
+    identify keys across systems and platforms (e.g. to pick shards).
+    '''
+    if self._hash is None:
+      self._hash = fasthash.hash(self._string)
+    return self._hash
 
-    For our purposes, then, we are using a perhaps more expensive hash function
-    that guarantees equal hash values given the same input.
+  @property
+  def digest(self):
+    '''Returns the stable digest of this Key, an integer guaranteed equal
+    given the same key across interpreter runs, machines and installations.
     '''
-    return fasthash.hash(self)
+    if self._digest is None:
+      self._digest = fasthash.digest(self._string)
+    return self._digest
 
 
   def __iter__(self):
@@ -0,0 +1,107 @@
+'''
+Promotion policies for :py:class:`TieredDatastore <datastore.TieredDatastore>`.
+
+When a ``get`` finds a value in a lower tier, TieredDatastore copies it into
+the tiers above (promotes it). Copying every value found pollutes the upper
+tiers with values read only once, e.g. by scans, and adds a write per read.
+A promotion policy decides which values are worth copying::
+
+    >>> ds = TieredDatastore([cache, database],
+    ...     promotion=PromoteAfterHits(2), async_promotion=True)
+
+Policies:
+
+  * AlwaysPromote: promotes every value found (the default).
+  * NeverPromote: never promotes; upper tiers only get values written.
+  * PromoteAfterHits: promotes keys read from lower tiers `hits` times.
+  * ProbabilisticPromote: promotes each value found with `probability`.
+  * SizeLimitedPromote: promotes values up to `max_size` bytes.
+
+'''
+
+import random
+import sys
+
+
+class PromotionPolicy(object):
+  '''Decides whether values found in lower tiers are copied upwards.'''
+
+  def shouldPromote(self, key, value):
+    '''Returns whether to copy `value`, named by `key`, to the upper tiers.'''
+    raise NotImplementedError
+
+
+
+class AlwaysPromote(PromotionPolicy):
+  '''Promotes every value found.'''
+
+  def shouldPromote(self, key, value):
+    return True
+
+
+
+class NeverPromote(PromotionPolicy):
+  '''Never promotes values.'''
+
+  def shouldPromote(self, key, value):
+    return False
+
+
+
+class PromoteAfterHits(PromotionPolicy):
+  '''Promotes a key once it has been read from lower tiers `hits` times.
+
+  Hit counts are kept for at most `max_tracked` keys; past that, counting
+  starts over, so keys must be read again `hits` times to be promoted.
+
+  Args:
+    hits: number of reads from lower tiers before promoting a key.
+    max_tracked: maximum number of keys to count hits for.
+  '''
+
+  def __init__(self, hits=2, max_tracked=100000):
+    self.hits = hits
+    self.max_tracked = max_tracked
+    self._counts = {}
+
+  def shouldPromote(self, key, value):
+    count = self._counts.get(key, 0) + 1
+    if count >= self.hits:
+      self._counts.pop(key, None)
+      return True
+
+    if len(self._counts) >= self.max_tracked:
+      self._counts.clear()
+    self._counts[key] = count
+    return False
+
+
+
+class ProbabilisticPromote(PromotionPolicy):
+  '''Promotes each value found with a given `probability`, so frequently read
+  keys are likely to be promoted early, and rarely read ones unlikely to be.
+  '''
+
+  def __init__(self, probability=0.1):
+    self.probability = probability
+
+  def shouldPromote(self, key, value):
+    return random.random() < self.probability
+
+
+
+class SizeLimitedPromote(PromotionPolicy):
+  '''Promotes values whose estimated size is at most `max_size` bytes.
+
+  Args:
+    max_size: maximum size of the values to promote.
+    sizeof: function estimating the size of a value (``sys.getsizeof`` by
+        default).
+  '''
+
+  def __init__(self, max_size, sizeof=sys.getsizeof):
+    self.max_size = max_size
+    self.sizeof = sizeof
+
+  def shouldPromote(self, key, value):
+    return self.sizeof(value) <= self.max_size
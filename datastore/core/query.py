@@ -1,4 +1,12 @@
 
+import sys
+import heapq
+import collections
+import Queue
+import operator
+import itertools
+import threading
+
 from key import Key
 
 
@@ -52,6 +60,22 @@ def _object_getattr(obj, field):
   return value
 
 
+def _field_getter(object_getattr, field):
+  '''Returns a function of one object that gets `field` as `object_getattr`
+  would. For the default `_object_getattr`, plain dicts are read with a
+  single ``dict.get``, unless `field` names a dict attribute.
+  '''
+  if object_getattr is not _object_getattr or \
+      not isinstance(field, basestring) or hasattr(dict, field):
+    return lambda obj: object_getattr(obj, field)
+
+  def getter(obj):
+    if obj.__class__ is dict:
+      return obj.get(field)
+    return _object_getattr(obj, field)
+  return getter
+
+
 
 
 def limit_gen(limit, iterable):
@@ -59,11 +83,15 @@ def limit_gen(limit, iterable):
   limit = int(limit)
   assert limit >= 0, 'negative limit'
 
+  if limit <= 0:
+    return
+
+  # stop right after the last item, without pulling another from iterable.
   for item in iterable:
-    if limit <= 0:
-      break
     yield item
     limit -= 1
+    if limit <= 0:
+      break
 
 
 def offset_gen(offset, iterable, skip_signal=None):
@@ -90,6 +118,110 @@ def chain_gen(iterables):
       yield item
 
 
+def ordered_merge_gen(orders, iterables):
+  '''A generator that merges `iterables`, each already sorted by `orders`,
+  into a single stream sorted by `orders`.
+
+  Only the next item of each iterable is held (in a heap), so memory is
+  O(len(iterables)) and consumers that stop early never pull the rest.
+  Items that compare equal are yielded in the order of their iterables.
+  '''
+  keyfn = Order.multipleOrderKey(orders)
+
+  heap = []
+  for index, iterable in enumerate(iterables):
+    iterator = iter(iterable)
+    try:
+      item = iterator.next()
+    except StopIteration:
+      continue
+    heap.append((keyfn(item), index, item, iterator))
+  heapq.heapify(heap)
+
+  while heap:
+    _, index, item, iterator = heap[0]
+    yield item
+
+    try:
+      item = iterator.next()
+    except StopIteration:
+      heapq.heappop(heap)
+    else:
+      heapq.heapreplace(heap, (keyfn(item), index, item, iterator))
+
+
+def parallel_chain_gen(iterables, pool, buffer_size=256):
+  '''A generator that chains `iterables`, iterating them concurrently.
+
+  Each iterable is drained by a task in `pool` (a thread pool responding to
+  ``apply_async``, e.g. ``multiprocessing.pool.ThreadPool``), so at most as
+  many iterables as the pool has threads are in flight at once. Items are
+  yielded as they arrive, so the order across iterables is not preserved.
+  At most `buffer_size` items are buffered before the tasks block. Exceptions
+  raised while iterating are re-raised in the consumer. Closing the generator
+  (or letting it be collected) stops the remaining tasks.
+  '''
+  done = object()
+  stopped = threading.Event()
+  results = Queue.Queue(buffer_size)
+
+  def deliver(entry):
+    # block while the buffer is full, but give up once the consumer is gone.
+    while not stopped.is_set():
+      try:
+        results.put(entry, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def drain(iterable):
+    try:
+      if stopped.is_set():
+        return
+      for item in iterable:
+        if not deliver((None, item)):
+          return
+    except Exception:
+      deliver((sys.exc_info(), None))
+    finally:
+      deliver((None, done))
+
+  iterables = list(iterables)
+  for iterable in iterables:
+    pool.apply_async(drain, (iterable,))
+
+  remaining = len(iterables)
+  try:
+    while remaining > 0:
+      error, item = results.get()
+      if error is not None:
+        raise error[0], error[1], error[2]
+      if item is done:
+        remaining -= 1
+      else:
+        yield item
+  finally:
+    stopped.set()
+
+
+def prefetch_gen(function, iterable, pool, window=16):
+  '''A generator that yields ``function(item)`` for each item in `iterable`,
+  in order, computing up to `window` results ahead in `pool` (a thread pool
+  responding to ``apply_async``). Exceptions raised by `function` are
+  re-raised in the consumer, when their result is reached.
+  '''
+  window = max(1, int(window))
+  pending = collections.deque()
+  for item in iterable:
+    pending.append(pool.apply_async(function, (item,)))
+    if len(pending) >= window:
+      yield pending.popleft().get()
+
+  while pending:
+    yield pending.popleft().get()
+
+
 
 
 class Filter(object):
@@ -116,12 +248,12 @@ class Filter(object):
   '''Conditional operators that Filters support.'''
 
   _conditional_cmp = {
-    "<"  : lambda a, b: a < b,
-    "<=" : lambda a, b: a <= b,
-    "="  : lambda a, b: a == b,
-    "!=" : lambda a, b: a != b,
-    ">=" : lambda a, b: a >= b,
-    ">"  : lambda a, b: a > b
+    "<"  : operator.lt,
+    "<=" : operator.le,
+    "="  : operator.eq,
+    "!=" : operator.ne,
+    ">=" : operator.ge,
+    ">"  : operator.gt
   }
 
 
@@ -155,6 +287,29 @@ class Filter(object):
     '''Returns whether this value passes this filter'''
     return self._conditional_cmp[self.op](value, self.value)
 
+  def compiled(self):
+    '''Returns a function of one object equivalent to calling this filter,
+    with the field getter, comparison and coercion chosen once up front.
+    '''
+    cls = self.__class__
+    if cls.__call__ != Filter.__call__ or cls.valuePasses != Filter.valuePasses:
+      return self  # customized filters keep their own semantics
+
+    getter = _field_getter(self.object_getattr, self.field)
+    compare = self._conditional_cmp[self.op]
+    target = self.value
+
+    if target is None:
+      return lambda obj: compare(getter(obj), target)
+
+    target_class = target.__class__
+    def passes(obj):
+      value = getter(obj)
+      if value is not None and not isinstance(value, target_class):
+        value = target_class(value)
+      return compare(value, target)
+    return passes
+
 
   def __str__(self):
     return '%s %s %s' % (self.field, self.op, self.value)
@@ -179,15 +334,28 @@ class Filter(object):
         yield item
 
   @classmethod
-  def filter(cls, filters, iterable):
-    '''Returns the elements in `iterable` that pass given `filters`'''
+  def predicate(cls, filters):
+    '''Returns a single function of one object that returns whether the
+    object passes all given `filters`, compiled once (see ``compiled``).
+    '''
     if isinstance(filters, Filter):
       filters = [filters]
 
-    for filter in filters:
-      iterable = filter.generator(iterable)
+    predicates = [filter.compiled() for filter in filters]
+    if len(predicates) == 1:
+      return predicates[0]
+
+    def passes(obj):
+      for predicate in predicates:
+        if not predicate(obj):
+          return False
+      return True
+    return passes
 
-    return iterable
+  @classmethod
+  def filter(cls, filters, iterable):
+    '''Returns the elements in `iterable` that pass given `filters`'''
+    return itertools.ifilter(cls.predicate(filters), iterable)
 
 
 
@@ -277,10 +445,50 @@ class Order(object):
 
     return cmpfn
 
+  @classmethod
+  def multipleOrderKey(cls, orders):
+    '''Returns a key function that sorts items according to `orders`.
+    Keys compare like ``multipleOrderComparison``, field by field, with
+    descending fields reversed.
+    '''
+    getters = []
+    for order in orders:
+      if order.__class__.keyfn != Order.keyfn:
+        getter = order.keyfn  # customized orders keep their own key
+      else:
+        getter = _field_getter(order.object_getattr, order.field)
+      if order.isDescending():
+        getter = (lambda get: lambda obj: _Descending(get(obj)))(getter)
+      getters.append(getter)
+
+    if len(getters) == 1:
+      return getters[0]
+    return lambda obj: tuple([getter(obj) for getter in getters])
+
   @classmethod
   def sorted(cls, items, orders):
     '''Returns the elements in `items` sorted according to `orders`'''
-    return sorted(items, cmp=cls.multipleOrderComparison(orders))
+    return sorted(items, key=cls.multipleOrderKey(orders))
+
+  @classmethod
+  def smallest(cls, count, items, orders):
+    '''Returns the first `count` elements of `items` sorted according to
+    `orders`, keeping only `count` elements in memory (a bounded heap).
+    '''
+    return heapq.nsmallest(count, items, key=cls.multipleOrderKey(orders))
+
+
+
+class _Descending(object):
+  '''Wraps a sort key value, reversing its order (see multipleOrderKey).'''
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __cmp__(self, other):
+    return cmp(other.value, self.value)
 
 
 
@@ -533,11 +741,18 @@ class Cursor(object):
       self._iterable = Filter.filter(self.query.filters, self._iterable)
 
   def apply_order(self):
-    '''Naively apply query orders.'''
+    '''Naively apply query orders. With a limit, only the first offset + limit
+    results are kept (in a bounded heap) rather than sorting them all.
+    '''
     self._ensure_modification_is_safe()
 
     if len(self.query.orders) > 0:
-      self._iterable = Order.sorted(self._iterable, self.query.orders)
+      if self.query.limit is not None:
+        count = self.query.offset + self.query.limit
+        self._iterable = \
+          Order.smallest(count, self._iterable, self.query.orders)
+      else:
+        self._iterable = Order.sorted(self._iterable, self.query.orders)
       # not a generator :(
 
   def apply_offset(self):
@@ -1,14 +1,23 @@
 
 
+import itertools
 import json
+import mmap
 from basic import Datastore, ShimDatastore
 
 default_serializer = json
 
+# zero-copy buffers some datastores return values as (e.g. large files).
+buffer_types = (buffer, memoryview, mmap.mmap)
+
 
 
 class Serializer(object):
   '''Serializing protocol. Serialized data must be a string.'''
+
+  accepts_buffers = False
+  '''Whether ``loads`` also accepts buffers (see `buffer_types`).'''
+
   @classmethod
   def loads(cls, value):
     '''returns deserialized `value`.'''
@@ -30,6 +39,9 @@ class NonSerializer(Serializer):
   '''Implements serializing protocol but does not serialize at all.
   If only storing strings (or already-serialized values).
   '''
+
+  accepts_buffers = True
+
   @classmethod
   def loads(cls, value):
     '''returns `value`.'''
@@ -61,6 +73,11 @@ class prettyjson(Serializer):
 class Stack(Serializer, list):
   '''represents a stack of serializers, applying each serializer in sequence.'''
 
+  @property
+  def accepts_buffers(self):
+    '''Whether the first serializer to load values accepts buffers.'''
+    return bool(self) and getattr(self[-1], 'accepts_buffers', False)
+
   def loads(self, value):
     '''Returns deserialized `value`.'''
     for serializer in reversed(self):
@@ -97,6 +114,15 @@ class map_serializer(Serializer):
 
 
 
+def buffer_to_string(value):
+  '''Returns a string with the contents of `value`, if it is a buffer.'''
+  if isinstance(value, memoryview):
+    return value.tobytes()
+  if isinstance(value, buffer_types):
+    return value[:]
+  return value
+
+
 def deserialized_gen(serializer, iterable):
   '''Generator that yields deserialized objects from `iterable`.'''
   for item in iterable:
@@ -130,6 +156,10 @@ class SerializerShimDatastore(ShimDatastore):
   ``get`` or ``query``) the data is retrieved from the ``child_datastore`` and
   deserialized.
 
+  Child datastores may return values as buffers, e.g. memory-mapped files
+  (see `buffer_types`). They are passed as they are to serializers that
+  accept buffers (like NonSerializer), and copied into strings for others.
+
   Args:
     datastore: a child datastore for the ShimDatastore superclass.
 
@@ -166,7 +196,12 @@ class SerializerShimDatastore(ShimDatastore):
 
   def deserializedValue(self, value):
     '''Returns deserialized `value` or None.'''
-    return self.serializer.loads(value) if value is not None else None
+    if value is None:
+      return None
+    if isinstance(value, buffer_types) and \
+        not getattr(self.serializer, 'accepts_buffers', False):
+      value = buffer_to_string(value)
+    return self.serializer.loads(value)
 
 
   def get(self, key):
@@ -198,6 +233,31 @@ class SerializerShimDatastore(ShimDatastore):
     value = self.serializedValue(value)
     self.child_datastore.put(key, value)
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.
+    Retrieves the values from the ``child_datastore`` in one batch, and
+    de-serializes them on the way out.
+
+    Args:
+      keys: iterable of Keys naming the objects to retrieve
+
+    Returns:
+      list of objects (or None), one per key
+    '''
+    values = self.child_datastore.get_many(keys)
+    return map(self.deserializedValue, values)
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`.
+    Serializes values on the way in, and stores the serialized data into the
+    ``child_datastore`` in one batch.
+
+    Args:
+      items: iterable of (key, value) pairs to store.
+    '''
+    items = [(key, self.serializedValue(value)) for key, value in items]
+    self.child_datastore.put_many(items)
+
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
     De-serializes values on the way out, using a :ref:`deserialized_gen` to
@@ -216,7 +276,10 @@ class SerializerShimDatastore(ShimDatastore):
     cursor = self.child_datastore.query(query)
 
     # chain the deserializing generator to the cursor's result set iterable
-    cursor._iterable = deserialized_gen(self.serializer, cursor._iterable)
+    iterable = cursor._iterable
+    if not getattr(self.serializer, 'accepts_buffers', False):
+      iterable = itertools.imap(buffer_to_string, iterable)
+    cursor._iterable = deserialized_gen(self.serializer, iterable)
 
     return cursor
 
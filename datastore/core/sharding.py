@@ -0,0 +1,322 @@
+'''
+Sharding functions for :py:class:`ShardedDatastore
+<datastore.ShardedDatastore>`.
+
+The default sharding function (``hash(key) % len(stores)``) remaps nearly
+every key when a shard is added or removed. The functions here only move the
+keys that must move (about 1/N of them when growing to N shards):
+
+  * ConsistentHashRing places each shard on a hash ring many times (virtual
+    nodes) and routes a key to the first shard point after the key's hash.
+  * RendezvousHash (highest random weight) scores every shard for each key and
+    routes the key to the highest scoring shard.
+
+Both identify shards by node names given in the same order as the stores, and
+return the index of the chosen store. Nodes may be weighted::
+
+    >>> ring = ConsistentHashRing(['a', 'b', ('c', 2)])
+    >>> ds = ShardedDatastore([store_a, store_b, store_c], shardingfn=ring)
+    >>>
+    >>> ds.appendDatastore(store_d)
+    >>> ring.addNode('d')
+
+Growing a ring in place moves keys at once. To reshard a live cluster, put
+the datastore in migration mode and let a ShardMigrator move the keys::
+
+    >>> new_ring = ConsistentHashRing(['a', 'b', ('c', 2), 'd'])
+    >>> ds.beginMigration([store_a, store_b, store_c, store_d], new_ring)
+    >>> migrator = ShardMigrator(ds, all_keys, rate=1000,
+    ...     checkpoint_store=meta, checkpoint_key=Key('/migrations/grow-d'))
+    >>> migrator.start()
+    >>> migrator.join()
+    >>> ds.finishMigration()
+
+'''
+
+import bisect
+import hashlib
+import itertools
+import math
+import threading
+import time
+
+
+def stable_hash(string):
+  '''Returns a stable 64-bit integer hash of `string`.'''
+  return int(hashlib.md5(string).hexdigest()[:16], 16)
+
+
+def _parse_nodes(nodes):
+  '''Returns a list of (name, weight) pairs from `nodes`, which may be a number
+  of nodes (named by index), or a list of names or (name, weight) pairs.
+  '''
+  if isinstance(nodes, (int, long)):
+    nodes = range(0, nodes)
+
+  parsed = []
+  for node in nodes:
+    name, weight = node if isinstance(node, tuple) else (node, 1)
+    if weight <= 0:
+      raise ValueError('node %s weight must be positive' % repr(name))
+    parsed.append((name, weight))
+
+  names = [name for name, _ in parsed]
+  if len(set(names)) != len(names):
+    raise ValueError('node names must be unique: %s' % names)
+  return parsed
+
+
+
+class ShardingFunction(object):
+  '''Base class for sharding functions over a list of weighted nodes.
+
+  Calling a sharding function with a Key returns the index of the node (and
+  thus the store) that handles it. Nodes are kept in the same order as the
+  stores of the ShardedDatastore using it.
+  '''
+
+  def __init__(self, nodes):
+    self._nodes = _parse_nodes(nodes)
+    self._reindex()
+
+  def __call__(self, key):
+    '''Returns the node index to handle `key`.'''
+    raise NotImplementedError
+
+  def __len__(self):
+    return len(self._nodes)
+
+  @property
+  def nodes(self):
+    '''Returns the list of node names, in order.'''
+    return [name for name, _ in self._nodes]
+
+  def weight(self, name):
+    '''Returns the weight of node `name`.'''
+    return self._nodes[self._index[name]][1]
+
+  def addNode(self, name, weight=1):
+    '''Appends node `name` (mirrors ``ShardedDatastore.appendDatastore``).'''
+    self.insertNode(len(self._nodes), name, weight)
+
+  def insertNode(self, index, name, weight=1):
+    '''Inserts node `name` at `index` (mirrors ``insertDatastore``).'''
+    nodes = list(self._nodes)
+    nodes.insert(index, (name, weight))
+    self._nodes = _parse_nodes(nodes)
+    self._reindex()
+
+  def removeNode(self, name):
+    '''Removes node `name` (mirrors ``ShardedDatastore.removeDatastore``).'''
+    del self._nodes[self._index[name]]
+    self._reindex()
+
+  def _reindex(self):
+    '''Rebuilds lookup structures after the nodes change.'''
+    self._index = dict((name, i) for i, (name, _) in enumerate(self._nodes))
+
+
+
+class ConsistentHashRing(ShardingFunction):
+  '''Consistent-hash ring with virtual nodes.
+
+  Each node is placed on the ring ``replicas * weight`` times. A key is routed
+  to the node owning the first point at or after the key's hash. Adding or
+  removing a node only moves the keys between its points and their
+  predecessors.
+
+  Args:
+    nodes: number of nodes, or list of node names or (name, weight) pairs,
+        in the same order as the stores.
+    replicas: number of virtual nodes per unit of weight.
+  '''
+
+  def __init__(self, nodes, replicas=128):
+    self.replicas = int(replicas)
+    super(ConsistentHashRing, self).__init__(nodes)
+
+  def __call__(self, key):
+    '''Returns the node index to handle `key`.'''
+    if not self._points:
+      raise ValueError('%s has no nodes' % self)
+
+    position = bisect.bisect_left(self._points, stable_hash(str(key)))
+    if position == len(self._points):
+      position = 0  # wrap around the ring
+    return self._index[self._owners[position]]
+
+  def _reindex(self):
+    '''Rebuilds the ring after the nodes change.'''
+    super(ConsistentHashRing, self)._reindex()
+
+    ring = []
+    for name, weight in self._nodes:
+      for replica in xrange(0, int(math.ceil(self.replicas * weight))):
+        ring.append((stable_hash('%s-%d' % (name, replica)), name))
+    ring.sort()
+
+    self._points = [point for point, _ in ring]
+    self._owners = [name for _, name in ring]
+
+
+
+class RendezvousHash(ShardingFunction):
+  '''Rendezvous (highest random weight) hashing.
+
+  Every node gets a pseudo-random score for each key, and the key is routed
+  to the highest scoring node. Removing a node only moves its own keys, and
+  adding one only takes the keys it now wins. Weighted scores follow
+  ``-weight / ln(u)``, where ``u`` is the node's hash mapped into (0, 1).
+  Routing costs one hash per node, so prefer ConsistentHashRing for many
+  shards.
+
+  Args:
+    nodes: number of nodes, or list of node names or (name, weight) pairs,
+        in the same order as the stores.
+  '''
+
+  def __call__(self, key):
+    '''Returns the node index to handle `key`.'''
+    if not self._nodes:
+      raise ValueError('%s has no nodes' % self)
+
+    key = str(key)
+    best_index, best_score = None, None
+    for index, (name, weight) in enumerate(self._nodes):
+      score = stable_hash('%s-%s' % (name, key))
+      if self._weighted:
+        unit = (score + 1.0) / (2.0 ** 64 + 1.0)
+        score = -weight / math.log(unit)
+      if best_score is None or score > best_score:
+        best_index, best_score = index, score
+    return best_index
+
+  def _reindex(self):
+    '''Notes whether any node is weighted after the nodes change.'''
+    super(RendezvousHash, self)._reindex()
+    self._weighted = any(weight != 1 for _, weight in self._nodes)
+
+
+
+class ShardMigrator(object):
+  '''Moves keys of a migrating ShardedDatastore to their new shards.
+
+  Keys are moved one at a time through ``ShardedDatastore.migrateKey``, so
+  the datastore keeps serving reads and writes throughout. The migrator is
+  resumable: every `checkpoint_every` keys, its progress is stored in
+  `checkpoint_store` as a dict::
+
+      {'position': 12000, 'moved': 3981, 'done': False}
+
+  A new migrator built with the same checkpoint skips the first `position`
+  keys, so `keys` must yield the same sequence across runs (for example, a
+  sorted key listing). Stopping and running the same migrator again carries
+  on where it stopped, even over an iterator.
+
+  Args:
+    datastore: the ShardedDatastore in migration mode.
+    keys: iterable of every Key that may need moving.
+    rate: maximum number of keys to process per second (None for no limit).
+    checkpoint_store: datastore to record progress in (optional).
+    checkpoint_key: Key naming the progress record in `checkpoint_store`.
+    checkpoint_every: number of keys between progress records.
+  '''
+
+  def __init__(self, datastore, keys, rate=None, checkpoint_store=None,
+      checkpoint_key=None, checkpoint_every=1000):
+    if checkpoint_store is not None and checkpoint_key is None:
+      raise ValueError('checkpoint_store requires a checkpoint_key')
+
+    self.datastore = datastore
+    self.keys = keys
+    self.rate = rate
+    self.checkpoint_store = checkpoint_store
+    self.checkpoint_key = checkpoint_key
+    self.checkpoint_every = max(1, int(checkpoint_every))
+
+    self.position = 0
+    self.moved = 0
+    self.done = False
+
+    checkpoint = None
+    if checkpoint_store is not None:
+      checkpoint = checkpoint_store.get(checkpoint_key)
+    if checkpoint:
+      self.position = checkpoint['position']
+      self.moved = checkpoint['moved']
+      self.done = checkpoint['done']
+
+    # the keys left to process, consumed across runs.
+    self._remaining = itertools.islice(iter(keys), self.position, None)
+
+    self._stop = threading.Event()
+    self._thread = None
+
+  def run(self):
+    '''Moves keys until every key is processed or ``stop`` is called.
+    Returns whether the migration is done.
+    '''
+    if self.done:
+      return True
+
+    if not self.datastore.isMigrating():
+      raise RuntimeError('%s is not migrating' % self.datastore)
+
+    started = time.time()
+    processed = 0
+
+    try:
+      # check for a stop before taking a key, so no key is skipped.
+      while not self._stop.is_set():
+        try:
+          key = next(self._remaining)
+        except StopIteration:
+          self.done = True
+          return True
+
+        if self.datastore.migrateKey(key):
+          self.moved += 1
+        self.position += 1
+        processed += 1
+
+        if self.position % self.checkpoint_every == 0:
+          self.checkpoint()
+
+        if self.rate:
+          ahead = processed / float(self.rate) - (time.time() - started)
+          if ahead > 0:
+            self._stop.wait(ahead)
+
+      return False
+
+    finally:
+      self.checkpoint()
+
+  def checkpoint(self):
+    '''Records progress in the checkpoint store, if any.'''
+    if self.checkpoint_store is None:
+      return
+
+    progress = {'position': self.position, 'moved': self.moved,
+        'done': self.done}
+    self.checkpoint_store.put(self.checkpoint_key, progress)
+
+  def start(self):
+    '''Runs the migrator in a background (daemon) thread.'''
+    if self._thread is not None and self._thread.is_alive():
+      raise RuntimeError('%s is already running' % self)
+
+    self._stop.clear()
+    self._thread = threading.Thread(target=self.run, name='ShardMigrator')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout=None):
+    '''Stops the background thread after the key being moved.'''
+    self._stop.set()
+    self.join(timeout)
+
+  def join(self, timeout=None):
+    '''Waits for the background thread to finish.'''
+    if self._thread is not None:
+      self._thread.join(timeout)
@@ -3,10 +3,55 @@ import unittest
 import logging
 
 from ..basic import DictDatastore
+from ..cache import CacheDatastore
 from ..key import Key
 from ..query import Query
 
 
+class RacingDatastore(DictDatastore):
+  '''DictDatastore calling `race` once, after a lookup misses.'''
+
+  race = None
+
+  def _raced(self, found):
+    race, self.race = self.race, None
+    if race is not None and not found:
+      race()
+    return found
+
+  def get(self, key):
+    return self._raced(super(RacingDatastore, self).get(key))
+
+  def contains(self, key):
+    return self._raced(super(RacingDatastore, self).contains(key))
+
+  def get_many(self, keys):
+    values = super(RacingDatastore, self).get_many(keys)
+    self._raced(any(value is not None for value in values))
+    return values
+
+
+class LookupCountingDatastore(DictDatastore):
+  '''DictDatastore counting the keys looked up through it.'''
+
+  def __init__(self):
+    super(LookupCountingDatastore, self).__init__()
+    self.lookups = 0
+
+  def get(self, key):
+    self.lookups += 1
+    return super(LookupCountingDatastore, self).get(key)
+
+  def contains(self, key):
+    self.lookups += 1
+    return super(LookupCountingDatastore, self).contains(key)
+
+  def get_many(self, keys):
+    keys = list(keys)
+    self.lookups += len(keys)
+    return super(LookupCountingDatastore, self).get_many(keys)
+
+
 class TestDatastore(unittest.TestCase):
   pkey = Key('/dfadasfdsafdas/')
   stores = []
@@ -124,6 +169,29 @@ class TestDatastore(unittest.TestCase):
 
     self.check_length(0)
 
+  def subtest_batch(self):
+    keys = [self.pkey.child(value) for value in range(0, self.numelems)]
+    items = [(key, value) for value, key in enumerate(keys)]
+
+    for sn in self.stores:
+      self.assertEqual(sn.get_many(keys), [None] * len(keys))
+
+      sn.put_many(items)
+      self.assertEqual(sn.get_many(keys), range(0, self.numelems))
+      self.assertEqual(sn.get_many(reversed(keys)),
+                       list(reversed(range(0, self.numelems))))
+      for key, value in items:
+        self.assertEqual(sn.get(key), value)
+
+      sn.delete_many(keys[::2])
+      expected = [None if v % 2 == 0 else v for v in range(0, self.numelems)]
+      self.assertEqual(sn.get_many(keys), expected)
+
+      sn.delete_many(keys)
+      self.assertEqual(sn.get_many(keys), [None] * len(keys))
+
+    self.check_length(0)
+
 
   def subtest_simple(self, stores, numelems=1000):
     self.stores = stores
@@ -134,6 +202,7 @@ class TestDatastore(unittest.TestCase):
     self.subtest_queries()
     self.subtest_update()
     self.subtest_remove()
+    self.subtest_batch()
 
 
 class TestNullDatastore(unittest.TestCase):
@@ -167,6 +236,35 @@ class TestDictionaryDatastore(TestDatastore):
 
     self.subtest_simple(stores)
 
+  def test_collections(self):
+    ds = DictDatastore()
+    key = self.pkey.child('a')
+
+    # reads and deletes of missing keys create no collections.
+    self.assertEqual(ds.get(key), None)
+    self.assertFalse(ds.contains(key))
+    ds.delete(key)
+    ds.delete_many([key])
+    self.assertEqual(ds._items, {})
+
+    # emptied collections are dropped, without losing concurrent puts.
+    import threading
+    ds.put(key, 'a')
+    ds.delete(key)
+    self.assertEqual(ds._items, {})
+
+    others = [self.pkey.child('b%d' % i) for i in range(0, 2000)]
+    def churn():
+      for i in range(0, 2000):
+        ds.put(key, i)
+        ds.delete(key)
+    churner = threading.Thread(target=churn)
+    churner.start()
+    for other in others:
+      ds.put(other, 'b')
+    churner.join()
+    self.assertEqual(ds.get_many(others), ['b'] * len(others))
+
 
 
 class TestCacheShimDatastore(TestDatastore):
@@ -190,6 +288,112 @@ class TestCacheShimDatastore(TestDatastore):
 
     self.subtest_simple([s1, s2, s3])
 
+    # with negative caching
+    s4 = CacheShimDatastore(DictDatastore(), cache=DictDatastore(),
+        negative_cache=CacheDatastore(ttl=60))
+    self.subtest_simple([s4])
+
+    # tombstones must expire.
+    self.assertRaises(ValueError, CacheShimDatastore, DictDatastore(),
+        cache=DictDatastore(), negative_cache=DictDatastore())
+
+  def test_negative_cache(self):
+    from ..basic import CacheShimDatastore
+
+    child = LookupCountingDatastore()
+    negative = CacheDatastore(ttl=60)
+    ds = CacheShimDatastore(child, cache=DictDatastore(),
+        negative_cache=negative)
+    missing = [self.pkey.child('missing%d' % i) for i in range(0, 3)]
+
+    for i in range(0, 5):
+      self.assertEqual(ds.get(missing[0]), None)
+      self.assertFalse(ds.contains(missing[1]))
+      self.assertEqual(ds.get_many(missing), [None, None, None])
+    self.assertEqual(child.lookups, 3)
+
+    # puts clear tombstones, deletes set them.
+    ds.put(missing[0], 'found')
+    self.assertEqual(ds.get(missing[0]), 'found')
+    ds.put_many([(missing[1], 'found')])
+    self.assertEqual(ds.get_many(missing[:2]), ['found', 'found'])
+    ds.delete(missing[0])
+    ds.delete_many(missing[1:])
+    lookups = child.lookups
+    self.assertEqual(ds.get_many(missing), [None, None, None])
+    self.assertEqual(child.lookups, lookups)
+
+    # a put racing with a miss is not hidden by its tombstone.
+    child = RacingDatastore()
+    ds = CacheShimDatastore(child, cache=DictDatastore(),
+        negative_cache=CacheDatastore(ttl=60))
+    key = self.pkey.child('raced')
+    for read in [ds.get, ds.contains, lambda key: ds.get_many([key])]:
+      ds.delete(key)
+      ds.negative_cache.delete(key)
+      child.race = lambda: ds.put(key, 'raced')
+      read(key)
+      self.assertFalse(ds.negative_cache.contains(key))
+
+
+class TestSingleFlightDatastore(TestDatastore):
+
+  def test_simple(self):
+    from ..basic import SingleFlightDatastore
+    self.subtest_simple([SingleFlightDatastore(DictDatastore())])
+
+  def test_coalescing(self):
+    import threading
+    import time
+    from ..basic import SingleFlightDatastore
+
+    release = threading.Event()
+    class SlowDatastore(LookupCountingDatastore):
+      def get(self, key):
+        release.wait()
+        if key.name == 'error':
+          self.lookups += 1
+          raise ValueError(key)
+        return super(SlowDatastore, self).get(key)
+
+    child = SlowDatastore()
+    ds = SingleFlightDatastore(child)
+    hot = self.pkey.child('hot')
+    child.put(hot, 'value')
+
+    results = []
+    def lookup(key):
+      try:
+        results.append(ds.get(key))
+      except ValueError:
+        results.append('error')
+
+    for key in [hot, self.pkey.child('error')]:
+      del results[:]
+      threads = [threading.Thread(target=lookup, args=(key,))
+          for i in range(0, 10)]
+      for thread in threads:
+        thread.start()
+      time.sleep(0.2)  # let every thread join the flight
+      release.set()
+      for thread in threads:
+        thread.join()
+      release.clear()
+      self.assertEqual(child.lookups, 1)
+      self.assertEqual(len(set(results)), 1)
+      self.assertEqual(len(results), 10)
+      self.assertEqual(ds._flights, {})
+      child.lookups = 0
+
+    self.assertEqual(results[0], 'error')
+
+    # writes detach lookups in flight.
+    release.set()
+    ds._flights[('get', hot)] = object()
+    ds.put(hot, 'new')
+    self.assertEqual(ds._flights, {})
+    self.assertEqual(ds.get(hot), 'new')
+
 
 class TestLoggingDatastore(TestDatastore):
 
@@ -988,8 +1192,325 @@ class TestDatastoreCollection(TestDatastore):
     self.assertFalse(ts.contains(k2))
     self.assertFalse(ts.contains(k3))
 
+    s1.put(k1, '1')
+    s2.put(k2, '2')
+    s3.put(k3, '3')
+
+    self.assertEqual(ts.get_many([k3, k1, k2]), ['3', '1', '2'])
+    self.assertEqual(s1.get_many([k1, k2, k3]), ['1', '2', '3'])
+    self.assertEqual(s2.get_many([k1, k2, k3]), [None, '2', '3'])
+    self.assertEqual(s3.get_many([k1, k2, k3]), [None, None, '3'])
+
+    ts.delete_many([k1, k2, k3])
+    self.assertEqual(ts.get_many([k1, k2, k3]), [None, None, None])
+
     self.subtest_simple([ts])
 
+  def test_tiered_negative_cache(self):
+    from ..basic import TieredDatastore
+
+    top = DictDatastore()
+    bottom = LookupCountingDatastore()
+    ts = TieredDatastore([top, bottom], negative_cache=CacheDatastore(ttl=60))
+    missing = [self.pkey.child('missing%d' % i) for i in range(0, 3)]
+
+    for i in range(0, 5):
+      self.assertEqual(ts.get(missing[0]), None)
+      self.assertFalse(ts.contains(missing[1]))
+      self.assertEqual(ts.get_many(missing), [None, None, None])
+    self.assertEqual(bottom.lookups, 3)
+
+    # values written around the tiers stay hidden until put through them.
+    bottom.put(missing[0], 'around')
+    self.assertEqual(ts.get(missing[0]), None)
+    ts.put(missing[0], 'through')
+    self.assertEqual(ts.get(missing[0]), 'through')
+    ts.put_many([(missing[1], 'through')])
+    self.assertTrue(ts.contains(missing[1]))
+
+    ts.delete_many(missing[:2])
+    lookups = bottom.lookups
+    self.assertEqual(ts.get_many(missing), [None, None, None])
+    self.assertEqual(bottom.lookups, lookups)
+
+    ts = TieredDatastore([DictDatastore(), DictDatastore()],
+        negative_cache=CacheDatastore(ttl=60))
+    self.subtest_simple([ts])
+
+    # tombstones must expire.
+    self.assertRaises(ValueError, TieredDatastore, [DictDatastore()],
+        negative_cache=DictDatastore())
+
+    # a put racing with a miss is not hidden by its tombstone.
+    bottom = RacingDatastore()
+    ts = TieredDatastore([DictDatastore(), bottom],
+        negative_cache=CacheDatastore(ttl=60))
+    key = self.pkey.child('raced')
+    for read in [ts.get, ts.contains, lambda key: ts.get_many([key])]:
+      ts.delete(key)
+      ts.negative_cache.delete(key)
+      bottom.race = lambda: ts.put(key, 'raced')
+      read(key)
+      self.assertFalse(ts.negative_cache.contains(key))
+      self.assertEqual(ts.get(key), 'raced')
+
+  def test_tiered_write_behind(self):
+    import threading
+    import time
+    from ..basic import TieredDatastore
+
+    class BatchRecordingDatastore(DictDatastore):
+      def __init__(self):
+        super(BatchRecordingDatastore, self).__init__()
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+      def put_many(self, items):
+        self.gate.wait()
+        items = list(items)
+        self.batches.append(len(items))
+        super(BatchRecordingDatastore, self).put_many(items)
+
+    top, bottom = DictDatastore(), BatchRecordingDatastore()
+    ts = TieredDatastore([top, bottom], write_behind=True, flush_interval=0.01)
+    try:
+      bottom.gate.clear()
+      keys = [self.pkey.child(i) for i in range(0, 10)]
+      for i in range(0, 5):
+        for key in keys:
+          ts.put(key, i)  # coalesced into the latest value per key
+      ts.delete(keys[0])
+
+      # the first tier is written right away, and reads see queued writes.
+      self.assertEqual(top.get(keys[1]), 4)
+      top.delete(keys[1])
+      self.assertEqual(ts.get(keys[1]), 4)
+      self.assertEqual(ts.get(keys[0]), None)
+      self.assertFalse(ts.contains(keys[0]))
+      self.assertEqual(ts.get_many(keys[:3]), [None, 4, 4])
+      self.assertEqual(bottom.get(keys[1]), None)
+
+      bottom.gate.set()
+      ts.flush()
+      self.assertEqual(sum(bottom.batches), 9)
+      self.assertTrue(len(bottom.batches) <= 2)
+      self.assertEqual(bottom.get_many(keys[:2]), [None, 4])
+      self.assertEqual(ts._pending, {})
+
+      # queries see every write.
+      ts.put(self.pkey.child('q'), 'q')
+      self.assertEqual(len(list(ts.query(Query(self.pkey)))), 10)
+    finally:
+      ts.close()
+
+    # writes block while the queue is full.
+    top, bottom = DictDatastore(), BatchRecordingDatastore()
+    ts = TieredDatastore([top, bottom], write_behind=True, max_pending=2,
+        flush_batch=1, flush_interval=0.01)
+    try:
+      bottom.gate.clear()
+      writer = threading.Thread(target=ts.put_many,
+          args=([(key, 'v') for key in keys],))
+      writer.start()
+      time.sleep(0.2)
+      self.assertTrue(writer.is_alive())
+      self.assertTrue(len(ts._pending) <= 2)
+      bottom.gate.set()
+      writer.join()
+      ts.flush()
+      self.assertEqual(bottom.get_many(keys), ['v'] * 10)
+    finally:
+      ts.close()
+
+    # flush errors are raised, and the writes retried.
+    class FailingDatastore(DictDatastore):
+      failures = 1
+      def put_many(self, items):
+        if FailingDatastore.failures > 0:
+          FailingDatastore.failures -= 1
+          raise IOError('lower tier unavailable')
+        super(FailingDatastore, self).put_many(items)
+
+    bottom = FailingDatastore()
+    ts = TieredDatastore([DictDatastore(), bottom], write_behind=True,
+        flush_interval=0.01)
+    try:
+      ts.put(keys[0], 'retried')
+      self.assertRaises(IOError, ts.flush)
+      ts.flush()
+      self.assertEqual(bottom.get(keys[0]), 'retried')
+    finally:
+      ts.close()
+
+    # close stops the flusher even when the final flush fails.
+    FailingDatastore.failures = 1000
+    ts = TieredDatastore([DictDatastore(), FailingDatastore()],
+        write_behind=True, flush_interval=0.01)
+    flusher = ts._flusher
+    ts.put(keys[0], 'lost')
+    self.assertRaises(IOError, ts.close)
+    self.assertFalse(flusher.is_alive())
+    self.assertFalse(ts.write_behind)
+    FailingDatastore.failures = 0
+
+    ts = TieredDatastore([DictDatastore(), DictDatastore()],
+        write_behind=True, flush_interval=0.001)
+    self.subtest_simple([ts])
+    ts.close()
+
+  def test_tiered_promotion(self):
+    import time
+    from ..basic import TieredDatastore
+    from ..promotion import NeverPromote
+    from ..promotion import PromoteAfterHits
+    from ..promotion import ProbabilisticPromote
+    from ..promotion import SizeLimitedPromote
+
+    keys = [self.pkey.child(i) for i in range(0, 4)]
+    def tiers(promotion, **kwargs):
+      top, bottom = DictDatastore(), DictDatastore()
+      bottom.put_many([(key, 'v%d' % i) for i, key in enumerate(keys)])
+      bottom.put(keys[3], 'large' * 100)
+      return top, TieredDatastore([top, bottom], promotion=promotion, **kwargs)
+
+    top, ts = tiers(NeverPromote())
+    self.assertEqual(ts.get(keys[0]), 'v0')
+    self.assertEqual(ts.get_many(keys[:2]), ['v0', 'v1'])
+    self.assertEqual(len(top), 0)
+
+    top, ts = tiers(PromoteAfterHits(2))
+    ts.get(keys[0])
+    ts.get_many(keys[1:3])
+    self.assertEqual(len(top), 0)
+    ts.get_many(keys[:2])
+    self.assertEqual(top.get_many(keys[:3]), ['v0', 'v1', None])
+
+    top, ts = tiers(SizeLimitedPromote(100, sizeof=len))
+    ts.get_many(keys)
+    self.assertEqual(top.get_many(keys), ['v0', 'v1', 'v2', None])
+
+    top, ts = tiers(ProbabilisticPromote(0.0))
+    ts.get_many(keys)
+    self.assertEqual(len(top), 0)
+    top, ts = tiers(ProbabilisticPromote(1.0))
+    ts.get_many(keys)
+    self.assertEqual(len(top), 4)
+
+    # asynchronous promotion, skipping keys written in the meantime.
+    top, ts = tiers(None, async_promotion=True)
+    self.assertEqual(ts.get_many(keys[:2]), ['v0', 'v1'])
+    ts.delete(keys[1])
+    for i in range(0, 100):
+      if not ts._snapshots:
+        break
+      time.sleep(0.01)
+    self.assertEqual(top.get_many(keys[:2]), ['v0', None])
+    self.assertEqual(ts._written, {})
+
+    # writes during a read are remembered, even with no promotion queued.
+    snapshot = ts._snapshot()
+    ts.put(keys[3], 'new')
+    ts._promote([(keys[3], 'v3')], 1, snapshot)
+    ts._release(snapshot)
+
+    self.assertEqual(ts.get(keys[2]), 'v2')
+    for i in range(0, 100):
+      if top.contains(keys[2]):
+        break
+      time.sleep(0.01)
+    self.assertEqual(top.get(keys[2]), 'v2')
+
+    # close stops the promoter, after the queued promotions.
+    ts.close()
+    self.assertFalse(ts._promoter.is_alive())
+    self.assertEqual(top.get(keys[3]), 'new')
+    self.assertEqual(ts._written, {})
+
+  def test_tiered_hedged_reads(self):
+    import threading
+    import time
+    from ..basic import TieredDatastore
+
+    class StallingDatastore(DictDatastore):
+      def __init__(self, stall_writes=True):
+        super(StallingDatastore, self).__init__()
+        self.stalled = threading.Event()
+        self.stall_writes = stall_writes
+        self.failing = False
+      def get(self, key):
+        self.stalled.wait()
+        if self.failing:
+          raise IOError('tier unavailable')
+        return super(StallingDatastore, self).get(key)
+      def contains(self, key):
+        return self.get(key) is not None
+      def put_many(self, items):
+        if self.stall_writes:
+          self.stalled.wait()
+        super(StallingDatastore, self).put_many(items)
+
+    top, bottom = StallingDatastore(), DictDatastore()
+    ts = TieredDatastore([top, bottom], hedge_delay=0.01)
+    key = self.pkey.child('a')
+    bottom.put(key, 'a')
+
+    # the stalled top tier is skipped, and the value promoted once it
+    # recovers, without the read waiting on it.
+    start = time.time()
+    self.assertEqual(ts.get(key), 'a')
+    self.assertTrue(ts.contains(key))
+    self.assertFalse(ts.contains(self.pkey.child('b')))
+    self.assertTrue(time.time() - start < 1)
+    self.assertEqual(top._items, {})
+    top.stalled.set()
+    for i in range(0, 100):
+      if top.get(key) is not None:
+        break
+      time.sleep(0.01)
+    self.assertEqual(top.get(key), 'a')
+
+    # the first tier to answer with a value wins.
+    top.put(key, 'top')
+    self.assertEqual(ts.get(key), 'top')
+
+    # errors only surface when no tier has the value.
+    top.failing = True
+    self.assertEqual(ts.get(key), 'a')
+    self.assertEqual(ts.get(self.pkey.child('b')), None)
+    ts.close()
+    ts = TieredDatastore([bottom, top], hedge_delay=0.01)
+    self.assertRaises(IOError, ts.get, self.pkey.child('b'))
+    ts.close()
+
+    ts = TieredDatastore([top, bottom], hedge_delay=0)
+    top.failing = False
+    self.assertEqual(ts.get(key), 'a')
+    self.assertEqual(ts.get(self.pkey.child('b')), None)
+    ts.close()
+
+    # once every thread of the stalled tier is busy, reads skip it rather
+    # than wait behind the stalled reads.
+    top, bottom = StallingDatastore(), DictDatastore()
+    ts = TieredDatastore([top, bottom], hedge_delay=0.05, hedge_threads=2)
+    bottom.put(key, 'a')
+    start = time.time()
+    for i in range(0, 10):
+      self.assertEqual(ts.get(key), 'a')
+    self.assertTrue(time.time() - start < 1)
+    top.stalled.set()
+    ts.close()
+
+    # promotions of hedged reads do not overwrite later writes.
+    top, bottom = StallingDatastore(stall_writes=False), DictDatastore()
+    ts = TieredDatastore([top, bottom], hedge_delay=0.01)
+    bottom.put(key, 'old')
+    self.assertEqual(ts.get(key), 'old')
+    ts.put(key, 'new')
+    top.stalled.set()
+    ts.close()  # waits for queued promotions
+    self.assertEqual(top.get(key), 'new')
+    self.assertEqual(ts.get(key), 'new')
+
   def test_sharded(self, numelems=1000):
     from ..basic import ShardedDatastore
 
@@ -1108,6 +1629,114 @@ class TestDatastoreCollection(TestDatastore):
 
     self.subtest_simple([sharded])
 
+    # by default, keys stay where hash(key) used to place them (the builtin
+    # hash of the sha1 integer). Placing by the digest itself is opt-in.
+    from operator import attrgetter
+    import hashlib
+    sharded = ShardedDatastore(stores)
+    by_digest = ShardedDatastore(stores, shardingfn=attrgetter('digest'))
+    for value in range(0, 100):
+      key = Key('/fdasfdfdsafdsafdsa/%d' % value)
+      sha1 = int(hashlib.sha1(str(key)).hexdigest(), 16)
+      sharded.put(key, value)
+      self.assertEqual(stores[sha1.__hash__() % len(stores)].get(key), value)
+      self.assertEqual(sharded.get(key), value)
+      sharded.delete(key)
+      by_digest.put(key, value)
+      self.assertEqual(stores[sha1 % len(stores)].get(key), value)
+
+  def test_sharded_parallel_query(self):
+    from ..basic import ShardedDatastore
+
+    stores = [DictDatastore() for i in range(0, 5)]
+    sharded = ShardedDatastore(stores, query_threads=3)
+
+    for value in range(0, 100):
+      sharded.put(self.pkey.child(value), value)
+
+    # arrival order across shards varies, but every result comes back once.
+    results = list(sharded.query(Query(self.pkey)))
+    self.assertEqual(sorted(results), range(0, 100))
+
+    # offset and limit are accounted for across all shards.
+    cursor = sharded.query(Query(self.pkey, offset=10, limit=50))
+    results = list(cursor)
+    self.assertEqual(len(results), 50)
+    self.assertEqual(len(set(results)), 50)
+    self.assertEqual(cursor.skipped, 10)
+    self.assertEqual(cursor.returned, 50)
+
+    cursor = sharded.query(Query(self.pkey, offset=90, limit=50))
+    self.assertEqual(len(list(cursor)), 10)
+    self.assertEqual(cursor.skipped, 90)
+
+    # closing stops the query threads; queries then run in sequence.
+    threads = sharded._query_pool._pool
+    sharded.close()
+    self.assertFalse(any(thread.is_alive() for thread in threads))
+    self.assertEqual(sorted(sharded.query(Query(self.pkey))), range(0, 100))
+    sharded.close()
+
+  def test_sharded_ordered_query(self):
+    from ..basic import ShardedDatastore
+
+    class CountingDatastore(DictDatastore):
+      pulled = 0
+      def query(self, query):
+        def counted(cursor):
+          for item in cursor:
+            CountingDatastore.pulled += 1
+            yield item
+        cursor = super(CountingDatastore, self).query(query)
+        cursor._iterable = counted(cursor._iterable)
+        return cursor
+
+    stores = [CountingDatastore() for i in range(0, 4)]
+    for sharded in [ShardedDatastore(stores),
+                    ShardedDatastore(stores, query_threads=2)]:
+      for value in range(0, 200):
+        sharded.put(self.pkey.child(value), {'value': value, 'odd': value % 2})
+
+      def values(query):
+        return [item['value'] for item in sharded.query(query)]
+
+      self.assertEqual(values(Query(self.pkey).order('+value')), range(0, 200))
+      self.assertEqual(values(Query(self.pkey).order('-value')),
+                       range(199, -1, -1))
+
+      expected = sorted(range(0, 200), key=lambda v: (-(v % 2), -v))
+      query = Query(self.pkey).order('-odd').order('-value')
+      self.assertEqual(values(query), expected)
+
+      query = Query(self.pkey, offset=30, limit=20).order('+value')
+      cursor = sharded.query(query)
+      self.assertEqual([item['value'] for item in cursor], range(30, 50))
+      self.assertEqual(cursor.skipped, 30)
+      self.assertEqual(cursor.returned, 20)
+
+      # stopping early does not pull every result out of the shards.
+      CountingDatastore.pulled = 0
+      cursor = sharded.query(Query(self.pkey).order('+value'))
+      self.assertEqual([cursor.next()['value'] for i in range(0, 5)],
+                       range(0, 5))
+      self.assertTrue(CountingDatastore.pulled < 20)
+
+      sharded.delete_many([self.pkey.child(v) for v in range(0, 200)])
+      sharded.close()
+
+  def test_sharded_parallel_query_error(self):
+    from ..basic import ShardedDatastore
+    from ..basic import NullDatastore
+
+    class BrokenDatastore(NullDatastore):
+      def query(self, query):
+        raise RuntimeError('shard is down')
+
+    stores = [DictDatastore(), BrokenDatastore(), DictDatastore()]
+    sharded = ShardedDatastore(stores, query_threads=2)
+    self.assertRaises(RuntimeError, list, sharded.query(Query(self.pkey)))
+    sharded.close()
+
 
 if __name__ == '__main__':
   unittest.main()
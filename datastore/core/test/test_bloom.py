@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..basic import DictDatastore
+from ..bloom import BloomFilterDatastore
+from ..bloom import CountingBloomFilter
+from ..key import Key
+from .test_basic import LookupCountingDatastore
+from .test_basic import TestDatastore
+
+
+def key(i):
+  return Key('/bloom/%d' % i)
+
+
+class TestCountingBloomFilter(unittest.TestCase):
+
+  def test_add_remove(self):
+    bloom = CountingBloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(0, 1000):
+      bloom.add(key(i))
+
+    self.assertEqual(len(bloom), 1000)
+    for i in range(0, 1000):
+      self.assertTrue(key(i) in bloom)
+
+    false_positives = sum(1 for i in range(1000, 11000) if key(i) in bloom)
+    self.assertTrue(false_positives < 300, false_positives)
+
+    for i in range(0, 500):
+      bloom.remove(key(i))
+    self.assertEqual(len(bloom), 500)
+    for i in range(500, 1000):
+      self.assertTrue(key(i) in bloom)
+
+    self.assertTrue('some string' not in bloom)
+    bloom.add('some string')
+    self.assertTrue('some string' in bloom)
+
+    bloom.clear()
+    self.assertEqual(len(bloom), 0)
+    self.assertFalse(key(999) in bloom)
+
+  def test_save_load(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, 'keys.bloom')
+      bloom = CountingBloomFilter(capacity=100)
+      for i in range(0, 100):
+        bloom.add(key(i))
+      bloom.save(path)
+
+      loaded = CountingBloomFilter.load(path)
+      self.assertEqual(len(loaded), 100)
+      self.assertEqual(loaded.error_rate, bloom.error_rate)
+      for i in range(0, 100):
+        self.assertTrue(key(i) in loaded)
+
+      with open(path, 'wb') as f:
+        f.write('garbage')
+      self.assertRaises(ValueError, CountingBloomFilter.load, path)
+    finally:
+      shutil.rmtree(tmp)
+
+
+
+class TestBloomFilterDatastore(TestDatastore):
+
+  def test_simple(self):
+    self.subtest_simple([BloomFilterDatastore(DictDatastore(), keys=[])])
+
+  def test_short_circuit(self):
+    child = LookupCountingDatastore()
+    child.put_many([(key(i), i) for i in range(0, 10)])
+    self.assertRaises(ValueError, BloomFilterDatastore, child)
+
+    bds = BloomFilterDatastore(child, capacity=100,
+        keys=lambda: map(key, range(0, 10)))
+    self.assertEqual(bds.get(key(3)), 3)
+    self.assertEqual(child.lookups, 1)
+
+    # absent keys do not reach the child.
+    self.assertEqual(bds.get(key(20)), None)
+    self.assertFalse(bds.contains(key(21)))
+    self.assertEqual(bds.get_many(map(key, range(8, 12))), [8, 9, None, None])
+    self.assertEqual(child.lookups, 3)
+
+    bds.put(key(20), 20)
+    self.assertEqual(bds.get(key(20)), 20)
+    bds.delete(key(20))
+    bds.delete(key(22))  # never added; must not unset other keys
+    self.assertEqual(len(bds.bloom), 10)
+    self.assertEqual(bds.get_many(map(key, range(0, 10))), range(0, 10))
+
+    bds.put(key(3), 'three')  # overwrites are not counted twice
+    bds.put(key(4), None)
+    self.assertEqual(len(bds.bloom), 9)
+    self.assertFalse(bds.contains(key(4)))
+
+  def test_concurrent_writes(self):
+    import threading
+    bds = BloomFilterDatastore(DictDatastore(), capacity=1000, keys=[],
+        stripes=4)
+
+    # writers to the same and to different keys keep the counts exact.
+    def write(start):
+      for i in range(start, start + 200):
+        bds.put(key(i % 100), i)
+        if i % 3 == 0:
+          bds.delete(key(i % 100))
+    threads = [threading.Thread(target=write, args=(n * 50,))
+      for n in range(0, 8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    present = [i for i in range(0, 100) if bds.child_datastore.contains(key(i))]
+    self.assertEqual(len(bds.bloom), len(present))
+    for i in present:
+      self.assertTrue(bds.contains(key(i)))
+
+  def test_persistence(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, 'keys.bloom')
+      child = DictDatastore()
+      bds = BloomFilterDatastore(child, path=path, keys=[])
+      bds.put_many([(key(i), i) for i in range(0, 10)])
+      bds.close()
+      self.assertTrue(os.path.exists(path))
+
+      # loaded without a key scan; the file is gone until the next close.
+      bds = BloomFilterDatastore(child, path=path)
+      self.assertFalse(os.path.exists(path))
+      self.assertEqual(len(bds.bloom), 10)
+      self.assertEqual(bds.get(key(9)), 9)
+      self.assertRaises(ValueError, BloomFilterDatastore, child, path=path)
+
+      # without a path, only an explicit save is an error.
+      bds = BloomFilterDatastore(child, keys=[])
+      self.assertRaises(ValueError, bds.save)
+      bds.close()
+    finally:
+      shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,178 @@
+import time
+import unittest
+
+from ..basic import CacheShimDatastore
+from ..basic import DictDatastore
+from ..basic import TieredDatastore
+from ..cache import CacheDatastore
+from ..cache import LFUPolicy
+from ..cache import LRUPolicy
+from ..cache import TimerWheel
+from ..key import Key
+from ..query import Query
+from .test_basic import TestDatastore
+
+
+def key(i):
+  return Key('/cache/%d' % i)
+
+
+class TestCacheDatastore(TestDatastore):
+
+  def test_simple(self):
+    self.subtest_simple([CacheDatastore()])
+    self.subtest_simple([CacheDatastore(policy=LFUPolicy)])
+    self.subtest_simple([CacheDatastore(max_entries=5000, max_bytes=10 ** 7)])
+
+  def test_lru(self):
+    cache = CacheDatastore(max_entries=3)
+    for i in range(0, 3):
+      cache.put(key(i), i)
+
+    cache.get(key(0))  # 1 is now least recently used
+    cache.put(key(3), 3)
+    self.assertEqual(cache.get_many(map(key, range(0, 4))), [0, None, 2, 3])
+    self.assertEqual(len(cache), 3)
+    self.assertEqual(cache.evictions, 1)
+
+    cache.put(key(2), 'two')  # overwrites count as use
+    cache.put(key(4), 4)
+    self.assertFalse(cache.contains(key(0)))
+    self.assertEqual(cache.get(key(2)), 'two')
+
+    # evictions drop emptied collections too.
+    for i in range(0, 100):
+      cache.put(Key('/cache/path%d/x' % i), i)
+    self.assertEqual(len(cache._items), 3)
+
+  def test_lfu(self):
+    cache = CacheDatastore(max_entries=3, policy=LFUPolicy)
+    for i in range(0, 3):
+      cache.put(key(i), i)
+
+    for i in range(0, 3):
+      cache.get(key(0))
+      cache.get(key(2))
+
+    cache.put(key(3), 3)  # evicts 1, the least frequently used
+    self.assertFalse(cache.contains(key(1)))
+    cache.put(key(4), 4)  # evicts 3 (4 itself is spared)
+    self.assertFalse(cache.contains(key(3)))
+    self.assertTrue(cache.contains(key(4)))
+
+    cache.delete(key(4))
+    cache.delete(key(0))
+    cache.put(key(5), 5)
+    cache.put(key(6), 6)
+    cache.put(key(7), 7)  # evicts 5, the least recent of the least frequent
+    self.assertEqual(cache.get_many(map(key, [2, 5, 6, 7])), [2, None, 6, 7])
+
+    # a new entry that alone is least frequently used is spared, and its
+    # count left alone.
+    cache = CacheDatastore(max_entries=2, policy=LFUPolicy)
+    cache.put(key(0), 0)
+    cache.put(key(1), 1)
+    for i in range(0, 3):
+      cache.get(key(0))
+      cache.get(key(1))
+    cache.get(key(1))
+    cache.put(key(2), 2)  # evicts 0, the least frequently used of the rest
+    self.assertEqual(cache.get_many(map(key, range(0, 3))), [None, 1, 2])
+    self.assertEqual(cache._policy._counts[key(2)], 2)
+
+  def test_bytes(self):
+    cache = CacheDatastore(max_bytes=100, sizeof=len)
+    cache.put(key(0), 'a' * 40)
+    cache.put(key(1), 'b' * 40)
+    self.assertEqual(cache.size, 80)
+
+    cache.put(key(2), 'c' * 40)
+    self.assertEqual(cache.size, 80)
+    self.assertFalse(cache.contains(key(0)))
+
+    cache.put(key(1), 'b')
+    self.assertEqual(cache.size, 41)
+
+    cache.put(key(3), 'd' * 101)  # too large to ever fit
+    self.assertFalse(cache.contains(key(3)))
+    self.assertEqual(cache.size, 41)
+
+    cache.clear()
+    self.assertEqual((len(cache), cache.size), (0, 0))
+
+  def test_counters(self):
+    cache = CacheDatastore(max_entries=2)
+    cache.put(key(0), 0)
+    cache.get(key(0))
+    cache.get(key(1))
+    cache.get_many([key(0), key(1)])
+    self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 2, 0))
+
+  def test_timer_wheel(self):
+    wheel = TimerWheel(resolution=1.0, slots=8)
+    now = time.time()
+    wheel.schedule('a', now + 0.5)
+    wheel.schedule('b', now + 3)
+    wheel.schedule('c', now + 20)  # a few rotations ahead
+    wheel.schedule('d', now + 4)
+    wheel.unschedule('d', now + 4)
+    self.assertEqual(len(wheel), 3)
+
+    self.assertEqual(wheel.expired(now), [])
+    self.assertEqual(wheel.expired(now + 1), [('a', now + 0.5)])
+    self.assertEqual(wheel.expired(now + 10), [('b', now + 3)])
+    self.assertEqual(wheel.expired(now + 19), [])
+    self.assertEqual(wheel.expired(now + 21), [('c', now + 20)])
+    self.assertEqual(len(wheel), 0)
+
+  def test_ttl(self):
+    cache = CacheDatastore(ttl=0.2)
+    cache.put(key(0), 0)
+    cache.put(key(1), 1, ttl=60)
+    cache.put(key(2), 2, ttl=0)
+    cache.put_many([(key(3), 3)], ttl=0.2)
+    self.assertEqual(cache.get_many(map(key, range(0, 4))), [0, 1, None, 3])
+
+    time.sleep(0.3)
+    self.assertFalse(cache.contains(key(0)))  # expired lazily
+    self.assertEqual(cache.get(key(1)), 1)
+    self.assertEqual(len(list(cache.query(Query(Key('/cache'))))), 1)
+    self.assertEqual(cache.expirations, 2)
+    self.assertEqual(len(cache), 1)
+
+    # re-putting resets the deadline.
+    cache.put(key(4), 4)
+    cache.put(key(4), 4, ttl=60)
+    time.sleep(0.3)
+    self.assertEqual(cache.sweep(), 0)
+    self.assertEqual(cache.get(key(4)), 4)
+
+  def test_sweeper(self):
+    cache = CacheDatastore(ttl=0.05, sweep_interval=0.05)
+    try:
+      for i in range(0, 10):
+        cache.put(key(i), i)
+      cache.put(key(10), 10, ttl=60)
+
+      time.sleep(0.5)
+      self.assertEqual(len(cache), 1)
+      self.assertEqual(cache.expirations, 10)
+    finally:
+      cache.close()
+    self.assertFalse(cache._sweeper.is_alive())
+
+  def test_as_cache(self):
+    child = DictDatastore()
+    cache = CacheDatastore(max_entries=10)
+    for ds in [CacheShimDatastore(child, cache=cache),
+        TieredDatastore([cache, child])]:
+      for i in range(0, 50):
+        ds.put(key(i), i)
+      self.assertEqual(len(cache), 10)
+      self.assertEqual([ds.get(key(i)) for i in range(0, 50)], range(0, 50))
+      self.assertEqual(len(cache), 10)
+      cache.clear()
+
+
+if __name__ == '__main__':
+  unittest.main()
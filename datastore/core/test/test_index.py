@@ -0,0 +1,143 @@
+import random
+import unittest
+
+from ..basic import DictDatastore
+from ..index import HashIndex
+from ..index import SortedIndex
+from ..key import Key
+from ..query import Query
+
+
+class TestIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.collection = Key('/users/user')
+    self.ds = DictDatastore()
+    self.naive = DictDatastore()
+    for i in range(0, 200):
+      self.put(i, {'age': random.randint(0, 50), 'group': i % 7, 'n': i})
+
+  def put(self, i, value):
+    key = self.collection.instance(i)
+    self.ds.put(key, value)
+    self.naive.put(key, value)
+
+  def delete(self, i):
+    key = self.collection.instance(i)
+    self.ds.delete(key)
+    self.naive.delete(key)
+
+  def assertSameResults(self, query, ordered=False):
+    indexed = list(self.ds.query(query.copy()))
+    naive = list(self.naive.query(query.copy()))
+    if not ordered:
+      indexed = sorted(indexed, key=lambda v: v['n'])
+      naive = sorted(naive, key=lambda v: v['n'])
+    self.assertEqual(indexed, naive)
+    return indexed
+
+  def subtest_queries(self):
+    q = lambda: Query(self.collection)
+    for op in ['<', '<=', '=', '!=', '>=', '>']:
+      self.assertSameResults(q().filter('age', op, 25))
+      self.assertSameResults(q().filter('group', op, 3))
+      self.assertSameResults(q().filter('group', op, 3).filter('age', '>', 10))
+
+    # ordered queries, served by the sorted index, come back sorted.
+    for order in ['+age', '-age']:
+      results = self.assertSameResults(q().order(order), ordered=False)
+      query = Query(self.collection, limit=15, offset=3).order(order)
+      ages = [v['age'] for v in self.ds.query(query)]
+      expected = sorted([v['age'] for v in results], reverse=order[0] == '-')
+      self.assertEqual(ages, expected[3:18])
+
+      query = q().filter('age', '>=', 20).order(order)
+      self.assertSameResults(query, ordered=False)
+      ages = [v['age'] for v in self.ds.query(query)]
+      self.assertEqual(ages, sorted(ages, reverse=order[0] == '-'))
+
+  def test_indexed_queries(self):
+    hash_index = self.ds.addIndex(self.collection, 'group')
+    sorted_index = self.ds.addIndex(self.collection, 'age', SortedIndex)
+    self.assertTrue(isinstance(hash_index, HashIndex))
+    self.assertEqual(len(hash_index), 200)
+    self.assertEqual(len(sorted_index), 200)
+    self.subtest_queries()
+
+    # indexes follow puts, overwrites and deletes.
+    for i in range(0, 200, 3):
+      self.put(i, {'age': random.randint(0, 50), 'group': i % 5, 'n': i})
+    for i in range(0, 200, 4):
+      self.delete(i)
+    self.ds.put_many([(self.collection.instance(i), None) for i in [1, 2]])
+    self.naive.delete_many([self.collection.instance(i) for i in [1, 2]])
+    self.ds.delete_many([self.collection.instance(5)])
+    self.naive.delete(self.collection.instance(5))
+    self.assertEqual(len(hash_index), len(self.naive))
+    self.assertEqual(len(sorted_index), len(self.naive))
+    self.subtest_queries()
+
+    self.ds.removeIndex(self.collection, 'group')
+    self.ds.removeIndex(self.collection, 'age')
+    self.assertEqual(self.ds._indexes, {})
+    self.subtest_queries()
+
+  def test_writes_during_iteration(self):
+    self.ds.addIndex(self.collection, 'group')
+    self.ds.addIndex(self.collection, 'age', SortedIndex)
+
+    # cursors iterate a snapshot, skipping objects deleted since the query.
+    q = lambda: Query(self.collection)
+    for query in [q().filter('age', '>', 0).order('age'), q().order('-age'),
+                  q().filter('group', '!=', 3)]:
+      cursor = self.ds.query(query)
+      expected = list(self.naive.query(query.copy()))
+      for value in expected[:10]:
+        self.delete(value['n'])
+      self.put(1000, {'age': 25, 'group': 0, 'n': 1000})
+      remaining = sorted(cursor, key=lambda v: v['n'])
+      self.assertEqual(remaining, sorted(expected[10:], key=lambda v: v['n']))
+      self.delete(1000)
+
+  def test_unusable_indexes(self):
+    hash_index = self.ds.addIndex(self.collection, 'group')
+    sorted_index = self.ds.addIndex(self.collection, 'age', SortedIndex)
+
+    # values coerced to the filter value's type bypass the index.
+    self.put(500, {'age': '7', 'group': '3', 'n': 500})
+    self.assertFalse(hash_index.usableFor(Query(self.collection)
+        .filter('group', '=', 3).filters[0]))
+    self.subtest_queries()
+
+    # int filters on float values would truncate them (2.5 passes '= 2').
+    for i, age in enumerate([1, 2, 2.5, 3]):
+      self.put(600 + i, {'age': age, 'group': age, 'n': 600 + i})
+    for op in ['<', '<=', '=', '!=', '>=', '>']:
+      self.assertSameResults(Query(self.collection).filter('age', op, 2))
+      self.assertSameResults(Query(self.collection).filter('group', op, 2))
+      self.assertSameResults(Query(self.collection).filter('age', op, 2.0))
+    floats = SortedIndex('age')
+    for i, age in enumerate([1, 2, 2.5, 3]):
+      floats.add(Key('/%d' % i), {'age': age})
+    self.assertFalse(floats.usableFor(Query(self.collection)
+        .filter('age', '<=', 2).filters[0]))
+    self.assertTrue(floats.usableFor(Query(self.collection)
+        .filter('age', '<=', 2.0).filters[0]))
+
+    # as do unhashable values, and queries with custom getters.
+    unhashable = HashIndex('group')
+    unhashable.add(Key('/a'), {'group': [3]})
+    self.assertEqual(len(unhashable), 1)
+    self.assertFalse(unhashable.usableFor(Query(self.collection)
+        .filter('group', '=', [3]).filters[0]))
+    unhashable.remove(Key('/a'), {'group': [3]})
+    self.assertEqual(len(unhashable), 0)
+
+    getter = lambda obj, field: obj[field]
+    query = Query(self.collection, object_getattr=getter).filter('age', '<', 5)
+    self.assertFalse(sorted_index.usableFor(query.filters[0]))
+    self.assertSameResults(query)
+
+
+if __name__ == '__main__':
+  unittest.main()
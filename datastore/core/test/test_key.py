@@ -1,8 +1,12 @@
 
+import copy
+import hashlib
+import pickle
 import unittest
 import random
 
 from ..key import Key
+from ..key import KeyPool
 from ..key import Namespace
 
 
@@ -121,6 +125,69 @@ class KeyTests(unittest.TestCase):
       self.assertTrue(hstr in keys)
       self.assertEqual(key, keys[hstr])
 
+    # hashes are cached, and equal keys hash (and digest) equally.
+    key = Key('/herp/derp')
+    self.assertEqual(key._hash, None)
+    self.assertEqual(hash(key), hash(Key('/herp//derp')))
+    self.assertEqual(key._hash, hash(key))
+    self.assertEqual(key.digest, Key('/herp/derp/').digest)
+    self.assertEqual(key.digest, int(hashlib.sha1('/herp/derp').hexdigest(), 16))
+    self.assertNotEqual(key.digest, Key('/herp/derp2').digest)
+
+  def test_cached_components(self):
+    key = Key('/Comedy/MontyPython/Actor:JohnCleese')
+    self.assertTrue(key.parent is key.parent)
+    self.assertTrue(key.path is key.path)
+    self.assertEqual(key.parent, Key('/Comedy/MontyPython'))
+    self.assertEqual(key.path, Key('/Comedy/MontyPython/Actor'))
+    self.assertEqual(key.name, 'JohnCleese')
+    self.assertEqual(Key('/a').parent, Key('/'))
+    self.assertTrue(Key(key) is key)
+
+    canonical = Key.fromCanonical('/Comedy/MontyPython')
+    self.assertEqual(canonical, Key('/Comedy/MontyPython'))
+    self.assertEqual(hash(canonical), hash(Key('/Comedy/MontyPython')))
+
+    self.assertEqual(copy.copy(key), key)
+
+    # pickles carry only the string, not cached hashes or parents.
+    hash(key)
+    for protocol in range(0, pickle.HIGHEST_PROTOCOL + 1):
+      pickled = pickle.dumps(key, protocol)
+      self.assertFalse('_hash' in pickled or '_parent' in pickled)
+      unpickled = pickle.loads(pickled)
+      self.assertEqual(unpickled, key)
+      self.assertEqual(unpickled._hash, None)
+      self.assertEqual(unpickled._parent, None)
+      self.assertEqual(hash(unpickled), hash(key))
+
+  def test_pool(self):
+    self.assertEqual(Key.pool, None)
+    self.assertFalse(Key('/a/b') is Key('/a/b'))
+
+    Key.pool = KeyPool(4)
+    try:
+      key = Key('/a/b')
+      self.assertTrue(Key('/a/b') is key)
+      self.assertTrue(Key('/a//b/') is key)
+      self.assertTrue(Key('/a//b/') is key)
+      self.assertTrue(Key.fromCanonical('/a/b') is key)
+      self.assertTrue(Key('/a/b/c').parent is key)
+
+      # the pool is bounded, keeping recently used keys.
+      for i in range(0, 10):
+        Key('/a/b')
+        Key('/other/%d' % i)
+        self.assertTrue(len(Key.pool) <= 4)
+      self.assertTrue(Key('/a/b') is key)
+
+      Key.pool.clear()
+      self.assertEqual(len(Key.pool), 0)
+      self.assertFalse(Key('/a/b') is key)
+      self.assertEqual(Key('/a/b'), key)
+    finally:
+      Key.pool = None
+
   def test_random(self):
     keys = set()
     for i in range(0, 1000):
@@ -228,6 +228,43 @@ class TestFilter(unittest.TestCase):
     vs = [{'val': 0}, {'val': None}]
     self.assertFilter(feqzero, vs, vs[0:1])
 
+  def test_predicate(self):
+    class Obj(object):
+      def __init__(self, val):
+        self.val = val
+
+    class DictSubclass(dict):
+      val = 7
+
+    objects = [{'val': 1}, {'val': '2'}, {'val': None}, {}, Obj(3), Obj('4'),
+        DictSubclass(val=6)]
+    filters = [Filter('val', '>', 1), Filter('val', '<=', '3'),
+        Filter('val', '=', None), Filter('val', '!=', 2)]
+
+    # compiled predicates agree with calling filters one by one.
+    for filter in filters:
+      predicate = filter.compiled()
+      self.assertEqual(map(predicate, objects), map(filter, objects))
+
+    # dict attributes still win over items, as with the default getter.
+    self.assertTrue(Filter('items', '!=', None).compiled()({'items': None}))
+
+    predicate = Filter.predicate(filters[:2])
+    self.assertEqual(map(predicate, objects),
+        [filters[0](o) and filters[1](o) for o in objects])
+
+    # custom getters and filters are respected.
+    query = Query(Key('/'), object_getattr=lambda obj, field: obj[1])
+    query.filter('val', '>', 1)
+    self.assertEqual(list(query([(0, 1), (0, 2)])), [(0, 2)])
+
+    class AlwaysFilter(Filter):
+      def valuePasses(self, value):
+        return True
+
+    always = AlwaysFilter('val', '=', 'never')
+    self.assertFilter([always], objects, objects)
+
   def test_object(self):
     t1 = nanotime.now()
     t2 = nanotime.now()
@@ -321,6 +358,76 @@ class TestOrder(unittest.TestCase):
     self.assertEqual(Order.sorted([v1, v2, v3], [o3, o2, o1]), [v3, v2, v1])
     self.assertEqual(Order.sorted([v1, v2, v3], [o3, o1, o2]), [v3, v2, v1])
 
+  def test_key_and_smallest(self):
+    import random
+    items = [{'a': random.randint(0, 20), 'b': random.choice('xyz'), 'i': i}
+        for i in range(0, 500)]
+
+    for orders in [['+a'], ['-a'], ['+b', '-a'], ['-b', '+a', '-i']]:
+      orders = map(Order, orders)
+      cmpfn = Order.multipleOrderComparison(orders)
+      expected = sorted(items, cmp=cmpfn)
+      self.assertEqual(Order.sorted(items, orders), expected)
+      self.assertEqual(Order.smallest(25, iter(items), orders), expected[:25])
+
+      # queries with a limit select the top offset + limit with a heap.
+      query = Query(Key('/'), limit=10, offset=5)
+      for order in orders:
+        query.order(order)
+      self.assertEqual(list(query(iter(items))), expected[5:15])
+
+  def test_prefetch(self):
+    import time
+    from multiprocessing.pool import ThreadPool
+    from ..query import prefetch_gen
+
+    def slow_square(x):
+      time.sleep(0.01 * (x % 3))
+      if x == 7:
+        raise ValueError(x)
+      return x * x
+
+    pool = ThreadPool(4)
+    squares = prefetch_gen(slow_square, range(0, 7), pool, window=3)
+    self.assertEqual(list(squares), [x * x for x in range(0, 7)])
+
+    squares = prefetch_gen(slow_square, range(0, 10), pool)
+    self.assertEqual([squares.next() for _ in range(0, 7)],
+        [x * x for x in range(0, 7)])
+    self.assertRaises(ValueError, squares.next)
+    self.assertEqual(list(prefetch_gen(slow_square, [], pool)), [])
+    pool.close()
+
+  def test_ordered_merge(self):
+    from ..query import ordered_merge_gen
+
+    asc = [Order('+a')]
+    desc = [Order('-a')]
+    item = lambda a: {'a': a}
+
+    runs = [[1, 4, 7, 9], [], [2, 3, 8], [0, 5, 6, 10, 11]]
+    merged = ordered_merge_gen(asc, [map(item, run) for run in runs])
+    self.assertEqual([i['a'] for i in merged], range(0, 12))
+
+    runs = [sorted(run, reverse=True) for run in runs]
+    merged = ordered_merge_gen(desc, [map(item, run) for run in runs])
+    self.assertEqual([i['a'] for i in merged], range(11, -1, -1))
+
+    # equal items keep the order of their iterables.
+    first, second = {'a': 1, 'i': 0}, {'a': 1, 'i': 1}
+    merged = list(ordered_merge_gen(asc, [[second], [first]]))
+    self.assertEqual(merged, [second, first])
+
+    # only the head of each iterable is pulled until more is needed.
+    pulled = []
+    def run(values):
+      for value in values:
+        pulled.append(value)
+        yield item(value)
+    merged = ordered_merge_gen(asc, [run([0, 2, 4]), run([1, 3, 5])])
+    self.assertEqual(merged.next(), item(0))
+    self.assertEqual(sorted(pulled), [0, 1])
+
 
   def test_object(self):
     self.assertEqual(Order('key'), eval(repr(Order('key'))))
@@ -105,6 +105,27 @@ class TestSerialize(TestDatastore):
     self.subtest_serializer_shim(Stack([json, map_serializer, bson, pickle]))
 
 
+  def test_buffers(self):
+    self.assertTrue(NonSerializer.accepts_buffers)
+    self.assertFalse(prettyjson.accepts_buffers)
+    self.assertTrue(Stack([json, NonSerializer]).accepts_buffers)
+    self.assertFalse(Stack([NonSerializer, json]).accepts_buffers)
+    self.assertFalse(Stack().accepts_buffers)
+
+    self.assertEqual(buffer_to_string(buffer('abcd', 1)), 'bcd')
+    self.assertEqual(buffer_to_string(memoryview('abcd')), 'abcd')
+    self.assertEqual(buffer_to_string({'a': 1}), {'a': 1})
+
+    # buffers reach serializers accepting them, others get strings.
+    key = Key('/buffer')
+    child = DictDatastore()
+    child.put(key, buffer('{"a": 1}'))
+    self.assertEqual(shim(child).get(key), {'a': 1})
+    self.assertEqual(shim(child).get_many([key]), [{'a': 1}])
+    raw = shim(child, serializer=NonSerializer).get(key)
+    self.assertTrue(isinstance(raw, buffer))
+
+
   def test_has_interface_check(self):
     self.assertTrue(hasattr(Serializer, 'implements_serializer_interface'))
 
@@ -0,0 +1,261 @@
+import unittest
+
+from ..basic import DictDatastore
+from ..basic import ShardedDatastore
+from ..key import Key
+from ..query import Query
+from ..sharding import ConsistentHashRing
+from ..sharding import RendezvousHash
+from ..sharding import ShardMigrator
+from .test_basic import TestDatastore
+
+
+def keys(count):
+  return [Key('/shard/key%d' % i) for i in range(0, count)]
+
+
+class TestShardingFunctions(TestDatastore):
+
+  def subtest_balance(self, fn, weights=None):
+    counts = [0] * len(fn)
+    for key in keys(10000):
+      counts[fn(key)] += 1
+
+    weights = weights or [1] * len(fn)
+    for count, weight in zip(counts, weights):
+      expected = 10000.0 * weight / sum(weights)
+      self.assertTrue(abs(count - expected) < expected * 0.25,
+                      '%s vs %s' % (counts, weights))
+
+  def subtest_growth(self, fn):
+    before = [fn(key) for key in keys(5000)]
+    fn.addNode('new')
+    after = [fn(key) for key in keys(5000)]
+
+    # keys only ever move to the new node, and only about 1/N of them.
+    new_index = len(fn) - 1
+    moved = [a for b, a in zip(before, after) if a != b]
+    self.assertTrue(all(a == new_index for a in moved))
+    self.assertTrue(len(moved) < 5000 * 2.0 / len(fn))
+    self.assertTrue(len(moved) > 5000 * 0.5 / len(fn))
+
+    fn.removeNode('new')
+    self.assertEqual([fn(key) for key in keys(5000)], before)
+
+  def subtest_remove_middle(self, fn):
+    before = [fn.nodes[fn(key)] for key in keys(5000)]
+    removed = fn.nodes[1]
+    fn.removeNode(removed)
+    after = [fn.nodes[fn(key)] for key in keys(5000)]
+
+    # only the removed node's keys move, and node names still line up.
+    for b, a in zip(before, after):
+      if b != removed:
+        self.assertEqual(a, b)
+
+  def test_consistent_hash_ring(self):
+    self.subtest_balance(ConsistentHashRing(5))
+    self.subtest_balance(ConsistentHashRing(['a', ('b', 2), 'c']), [1, 2, 1])
+    self.subtest_growth(ConsistentHashRing(['a', 'b', 'c', 'd']))
+    self.subtest_remove_middle(ConsistentHashRing(['a', 'b', 'c', 'd']))
+
+    ring = ConsistentHashRing(['a', 'b'])
+    self.assertEqual(ring.nodes, ['a', 'b'])
+    self.assertEqual(ring.weight('a'), 1)
+    self.assertRaises(ValueError, ring.addNode, 'a')
+    self.assertRaises(ValueError, ConsistentHashRing, [('a', 0)])
+    self.assertRaises(ValueError, ConsistentHashRing(0), Key('/a'))
+
+  def test_rendezvous_hash(self):
+    self.subtest_balance(RendezvousHash(5))
+    self.subtest_balance(RendezvousHash(['a', ('b', 2), 'c']), [1, 2, 1])
+    self.subtest_growth(RendezvousHash(['a', 'b', 'c', 'd']))
+    self.subtest_remove_middle(RendezvousHash(['a', 'b', 'c', 'd']))
+    self.assertRaises(ValueError, RendezvousHash(0), Key('/a'))
+
+  def test_sharded_datastore(self):
+    for fn in [ConsistentHashRing(3), RendezvousHash(3)]:
+      stores = [DictDatastore() for i in range(0, 3)]
+      sharded = ShardedDatastore(stores, shardingfn=fn)
+      self.subtest_simple([sharded], numelems=300)
+
+      for key in keys(100):
+        sharded.put(key, str(key))
+        self.assertEqual(stores[fn(key)].get(key), str(key))
+
+
+
+class TestShardMigration(unittest.TestCase):
+
+  def setUp(self):
+    self.old_stores = [DictDatastore() for i in range(0, 3)]
+    self.new_stores = self.old_stores + [DictDatastore()]
+    self.sharded = ShardedDatastore(self.old_stores,
+        shardingfn=ConsistentHashRing(3))
+    for key in keys(200):
+      self.sharded.put(key, str(key))
+
+    self.sharded.beginMigration(self.new_stores, ConsistentHashRing(4))
+    self.moving = [k for k in keys(200) if self.sharded.shard(k) == 3]
+    self.assertTrue(len(self.moving) > 0)
+
+  def assertMigrated(self):
+    for key in keys(200):
+      index = self.sharded.shard(key)
+      self.assertEqual(self.new_stores[index].get(key), str(key))
+      for i, store in enumerate(self.new_stores):
+        if i != index:
+          self.assertFalse(store.contains(key))
+
+  def test_reads_and_writes(self):
+    sharded = self.sharded
+    self.assertTrue(sharded.isMigrating())
+    self.assertRaises(RuntimeError, sharded.beginMigration, self.new_stores)
+
+    # reads fall back to the old shard.
+    key = self.moving[0]
+    self.assertFalse(self.new_stores[3].contains(key))
+    self.assertEqual(sharded.get(key), str(key))
+    self.assertTrue(sharded.contains(key))
+    self.assertEqual(sharded.get_many(self.moving),
+        [str(k) for k in self.moving])
+
+    # writes land on the new shard, and leave nothing behind.
+    sharded.put(key, 'updated')
+    self.assertEqual(self.new_stores[3].get(key), 'updated')
+    self.assertFalse(any(s.contains(key) for s in self.old_stores))
+
+    sharded.put_many([(k, 'batch') for k in self.moving[1:3]])
+    for k in self.moving[1:3]:
+      self.assertEqual(self.new_stores[3].get(k), 'batch')
+      self.assertFalse(any(s.contains(k) for s in self.old_stores))
+
+    # deletes remove both copies.
+    sharded.delete(self.moving[3])
+    self.assertFalse(sharded.contains(self.moving[3]))
+    sharded.delete_many(self.moving[4:6])
+    self.assertEqual(sharded.get_many(self.moving[4:6]), [None, None])
+
+    # queries see every object exactly once.
+    results = list(sharded.query(Query(Key('/shard'))))
+    self.assertEqual(len(results), 200 - 3)
+
+    # migrating keeps the newer value.
+    self.assertFalse(sharded.migrateKey(key))
+    for k in self.moving:
+      sharded.migrateKey(k)
+    self.assertEqual(sharded.get(key), 'updated')
+    self.assertEqual(len(self.new_stores[3]._items['/shard']),
+        len(self.moving) - 3)
+
+    sharded.finishMigration()
+    self.assertFalse(sharded.isMigrating())
+    self.assertEqual(sharded.get(self.moving[1]), 'batch')
+
+  def test_reads_racing_moves(self):
+    # keys moved by migrateKey after their new shard was read are found.
+    for method in ['get', 'contains', 'get_many']:
+      self.setUp()
+      sharded = self.sharded
+      def moving_read(store, read):
+        def read_after_move(arg):
+          for key in (arg if isinstance(arg, list) else [arg]):
+            if sharded.shard(key) == 3:
+              store.__dict__.pop(method)
+              sharded.migrateKey(key)
+              setattr(store, method, read_after_move)
+          return read(arg)
+        return read_after_move
+      for store in self.old_stores:
+        setattr(store, method, moving_read(store, getattr(store, method)))
+
+      key = self.moving[0]
+      if method == 'get_many':
+        self.assertEqual(sharded.get_many(self.moving),
+            [str(k) for k in self.moving])
+      else:
+        expected = str(key) if method == 'get' else True
+        self.assertEqual(getattr(sharded, method)(key), expected)
+      self.assertEqual(self.new_stores[3].get(key), str(key))
+
+    # queries return a key in both its old and new shard once.
+    self.setUp()
+    key = self.moving[0]
+    old_store = self.sharded.previousShardDatastore(key)
+    for store in [old_store, self.new_stores[3]]:
+      store.put(key, {'key': key, 'value': 'copy'})
+    results = list(self.sharded.query(Query(Key('/shard'))))
+    self.assertEqual(len(results), 200)
+    self.assertEqual(len(list(self.sharded.query(
+        Query(Key('/shard'), offset=190)))), 10)
+
+  def test_migrator(self):
+    checkpoints = DictDatastore()
+    checkpoint_key = Key('/migrations/grow')
+    migrator = ShardMigrator(self.sharded, keys(200),
+        checkpoint_store=checkpoints, checkpoint_key=checkpoint_key,
+        checkpoint_every=50)
+
+    # stop part way through, once a checkpoint is recorded.
+    migrate = self.sharded.migrateKey
+    def stopping_migrate(key):
+      if migrator.position == 120:
+        migrator._stop.set()
+      return migrate(key)
+    self.sharded.migrateKey = stopping_migrate
+
+    self.assertFalse(migrator.run())
+    progress = checkpoints.get(checkpoint_key)
+    self.assertEqual(progress['position'], 121)
+    self.assertFalse(progress['done'])
+    del self.sharded.migrateKey
+
+    # resume from the checkpoint, in the background.
+    resumed = ShardMigrator(self.sharded, keys(200), rate=10000,
+        checkpoint_store=checkpoints, checkpoint_key=checkpoint_key)
+    self.assertEqual(resumed.position, 121)
+    resumed.start()
+    resumed.join(10)
+
+    progress = checkpoints.get(checkpoint_key)
+    self.assertEqual(progress['position'], 200)
+    self.assertEqual(progress['moved'], len(self.moving))
+    self.assertTrue(progress['done'])
+    self.assertMigrated()
+
+    self.sharded.finishMigration()
+    self.assertTrue(ShardMigrator(self.sharded, keys(200),
+        checkpoint_store=checkpoints, checkpoint_key=checkpoint_key).run())
+    self.assertRaises(RuntimeError,
+        ShardMigrator(self.sharded, keys(200)).run)
+    self.assertRaises(ValueError, ShardMigrator, self.sharded, keys(1),
+        checkpoint_store=checkpoints)
+
+  def test_migrator_restart(self):
+    # the same migrator, stopped and run again over an iterator, carries on
+    # where it stopped.
+    migrator = ShardMigrator(self.sharded, iter(keys(200)))
+    migrate = self.sharded.migrateKey
+    def stopping_migrate(key):
+      if migrator.position in (50, 120):
+        migrator._stop.set()
+      return migrate(key)
+    self.sharded.migrateKey = stopping_migrate
+
+    self.assertFalse(migrator.run())
+    self.assertEqual(migrator.position, 51)
+    migrator._stop.clear()
+    self.assertFalse(migrator.run())
+    self.assertEqual(migrator.position, 121)
+    del self.sharded.migrateKey
+
+    migrator.start()
+    migrator.join(10)
+    self.assertTrue(migrator.done)
+    self.assertEqual(migrator.position, 200)
+    self.assertEqual(migrator.moved, len(self.moving))
+    self.assertMigrated()
+
+
+if __name__ == '__main__':
+  unittest.main()
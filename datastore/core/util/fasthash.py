@@ -1,6 +1,26 @@
 
 import hashlib
+import struct
+
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
+
 
 def hash(tohash):
-  '''fast, deterministic hash function'''
+  '''fast, deterministic 64-bit hash function.
+
+  Uses xxHash (xxh64) when the `xxhash` module is installed, and the first 8
+  bytes of an md5 digest otherwise. Values are stable across runs, but depend
+  on which of the two is available: use `digest` for values that must agree
+  across machines.
+  '''
+  if xxhash is not None:
+    return struct.unpack('>q', xxhash.xxh64(str(tohash)).digest())[0]
+  return struct.unpack('>q', hashlib.md5(str(tohash)).digest()[:8])[0]
+
+
+def digest(tohash):
+  '''stable hash function, equal across runs, platforms and installations.'''
   return int(hashlib.sha1(str(tohash)).hexdigest(), 16)
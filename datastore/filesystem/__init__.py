@@ -9,20 +9,162 @@ Tested with:
 
 '''
 
+import errno
+import itertools
+import logging
+import mmap
 import os
+import stat
+import sys
+import threading
+import time
 import datastore.core
 
+from datastore.core.query import Cursor
+from datastore.core.query import offset_gen
+from datastore.core.query import prefetch_gen
+
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = None
+
+
+logger = logging.getLogger(__name__)
+
+
 
 def ensure_directory_exists(directory):
   '''Ensures `directory` exists. May make `directory` and intermediate dirs.
   Raises RuntimeError if `directory` is a file.
   '''
   if not os.path.exists(directory):
-    os.makedirs(directory)
+    try:
+      os.makedirs(directory)
+    except OSError, e:
+      if e.errno != errno.EEXIST or not os.path.isdir(directory):
+        raise  # unless made concurrently
   elif os.path.isfile(directory):
     raise RuntimeError('Path %s is a file, not a directory.' % directory)
 
 
+def fsync_directory(directory):
+  '''Flushes `directory` entries (e.g. renames into it) to disk.'''
+  fd = os.open(directory, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+
+class GroupCommitter(object):
+  '''Makes written temp files durable in batches, for concurrent writers.
+
+  Writers flush their own temp file (so their fsyncs run concurrently),
+  hand it over, and wait. Every `interval` seconds, a background thread
+  renames the files handed over since the last batch into place, and
+  flushes each of their directories once (so writers to the same directory
+  share a single directory flush), then wakes the writers up.
+
+  Args:
+    interval: seconds to wait for writers to join a batch.
+  '''
+
+  def __init__(self, interval=0.01):
+    self.interval = interval
+    self._batch = []
+    self._batch_ready = threading.Condition(threading.Lock())
+    self._closed = False
+    self._thread = threading.Thread(target=self._commit_loop,
+        name='FileSystemDatastore group committer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def commit(self, tmp, path):
+    '''Renames the temp file `tmp`, already flushed and closed, to `path`,
+    along with others in the same batch. Returns once it is durable.
+    '''
+    entry = [tmp, path, threading.Event(), None]
+    with self._batch_ready:
+      if self._closed:
+        _remove_quietly(tmp)
+        raise RuntimeError('GroupCommitter is closed.')
+      self._batch.append(entry)
+      self._batch_ready.notify()
+
+    entry[2].wait()
+    error = entry[3]
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+  def close(self):
+    '''Commits the pending batch, and stops the committer thread.'''
+    with self._batch_ready:
+      self._closed = True
+      self._batch_ready.notify()
+    self._thread.join()
+
+  def _commit_loop(self):
+    while True:
+      with self._batch_ready:
+        while not self._batch and not self._closed:
+          self._batch_ready.wait()
+        if not self._batch:
+          return  # closed
+
+      time.sleep(self.interval)  # let other writers join the batch
+      with self._batch_ready:
+        batch, self._batch = self._batch, []
+      self._commit(batch)
+
+  def _commit(self, batch):
+    directories = {}  # directory -> entries renamed into it
+    for entry in batch:
+      tmp, path = entry[:2]
+      try:
+        os.rename(tmp, path)
+        directories.setdefault(os.path.dirname(path), []).append(entry)
+      except Exception:
+        entry[3] = sys.exc_info()
+        _remove_quietly(tmp)
+
+    for directory, entries in directories.iteritems():
+      try:
+        fsync_directory(directory)
+      except Exception:
+        for entry in entries:
+          entry[3] = sys.exc_info()
+
+    for entry in batch:
+      entry[2].set()
+
+
+def _remove_quietly(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+def _create_temp_file(directory, prefix, in_use):
+  '''Creates a new, uniquely named file in `directory`, with the permissions
+  open() would give it (unlike tempfile.mkstemp, which creates it 0600).
+  Its path is added to the set `in_use` before the file is created.
+  Returns (fd, path).
+  '''
+  flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+  while True:
+    path = os.path.join(directory, prefix + os.urandom(8).encode('hex'))
+    in_use.add(path)
+    try:
+      return os.open(path, flags, 0666), path
+    except OSError, e:
+      in_use.discard(path)
+      if e.errno != errno.EEXIST:
+        raise
+
+
 
 class FileSystemDatastore(datastore.Datastore):
   '''Simple flat-file datastore.
@@ -83,17 +225,72 @@ class FileSystemDatastore(datastore.Datastore):
       >>> ds.get(hello)
       None
 
+  Writes are atomic: objects are written to a temp file (named with the
+  `temp_prefix`) in the same directory, which is then renamed over the
+  object file, so a crash never leaves a truncated object behind. How
+  durable a ``put`` is once it returns depends on `durability`:
+
+    * 'none': written files are left to the OS to flush (the default).
+    * 'fsync': every put flushes its file and directory before returning.
+    * 'group': puts are flushed in batches every `group_commit_interval`
+      seconds by a GroupCommitter, and return once their batch is durable.
+      Concurrent writers share the wait and the directory flushes, rather
+      than each paying for their own.
+
+  Given an `mmap_threshold`, objects of at least that many bytes are read as
+  read-only memory maps (``mmap.mmap``) rather than strings: their pages are
+  only read from disk as accessed, and slicing copies only the slice. Use a
+  SerializerShimDatastore with a serializer that accepts buffers (e.g.
+  NonSerializer) to get them through unchanged; other serializers get them
+  copied into strings.
+
+  Given `read_threads`, query results and ``get_many`` read files ahead of
+  the consumer, on a pool of that many threads, keeping up to `prefetch`
+  reads in flight (results stay in order). This helps on storage where each
+  read waits on latency (network filesystems, spinning disks). Queries with
+  a limit may read up to `prefetch` files past it.
+
+  Deletes leave directories behind, even once empty. ``compact`` removes
+  empty directories, and temp files left by interrupted writes (once older
+  than `temp_file_age` seconds, and not being written by this datastore).
+  Given a `gc_interval`, a background thread does the same every
+  `gc_interval` seconds, visiting at most `gc_rate` directories per second
+  so as not to compete with other disk I/O.
+
   '''
 
   object_extension = '.obj'
+  temp_prefix = '.tmp-'
   ignore_list = list()
+  durabilities = ['none', 'fsync', 'group']
+  max_cached_directories = 100000
+  temp_file_age = 60
 
-  def __init__(self, root, case_sensitive=True):
+  def __init__(self, root, case_sensitive=True, durability='none',
+      group_commit_interval=0.01, mmap_threshold=None, read_threads=0,
+      prefetch=16, gc_interval=None, gc_rate=100):
     '''Initialize the datastore with given root directory `root`.
 
     Args:
       root: A path at which to mount this filesystem datastore.
+      case_sensitive: whether keys differing in case name different objects.
+      durability: 'none', 'fsync' or 'group' (see above).
+      group_commit_interval: seconds between batches, in 'group' durability.
+      mmap_threshold: size in bytes from which objects are read as memory
+          maps (None, the default, always reads strings).
+      read_threads: number of threads reading files ahead. 0 (the default)
+          reads files one at a time in the calling thread.
+      prefetch: maximum number of reads in flight, with `read_threads`.
+      gc_interval: seconds between background garbage collections (None,
+          the default, only collects through ``compact``).
+      gc_rate: maximum number of directories visited per second, by
+          background garbage collections.
     '''
+    if durability not in self.durabilities:
+      raise ValueError('durability must be one of %s' % self.durabilities)
+    if gc_rate <= 0:
+      raise ValueError('gc_rate must be positive')
+
     root = os.path.normpath(root)
 
     if not root:
@@ -104,6 +301,33 @@ class FileSystemDatastore(datastore.Datastore):
 
     self.root_path = root
     self.case_sensitive = bool(case_sensitive)
+    self.durability = durability
+    self.mmap_threshold = mmap_threshold
+    self.prefetch = prefetch
+
+    self._read_pool = None
+    if read_threads:
+      from multiprocessing.pool import ThreadPool
+      self._read_pool = ThreadPool(int(read_threads))
+
+    # directories known to exist, so writes need not check for them. They
+    # may be removed behind our back; writes then recreate them.
+    self._directories = set([root])
+
+    # temp files being written, which garbage collection must not remove.
+    self._writing = set()
+
+    self._committer = None
+    if durability == 'group':
+      self._committer = GroupCommitter(group_commit_interval)
+
+    self._closed = threading.Event()
+    self._collector = None
+    if gc_interval:
+      self._collector = threading.Thread(target=self._gc_loop,
+          args=(gc_interval, gc_rate), name='FileSystemDatastore collector')
+      self._collector.daemon = True
+      self._collector.start()
 
 
   # object pathing
@@ -133,29 +357,143 @@ class FileSystemDatastore(datastore.Datastore):
   # object IO
 
   def _write_object(self, path, value):
-    '''write out `object` to file at `path`'''
-    ensure_directory_exists(os.path.dirname(path))
-
-    with open(path, 'w') as f:
-      f.write(value)
+    '''write out `object` to file at `path`, through a temp file.'''
+    if isinstance(value, unicode):
+      value = value.encode(sys.getdefaultencoding())  # as file.write does
+    elif not isinstance(value, (str, bytearray, buffer, mmap.mmap)):
+      raise TypeError('values must be strings, not %s' % type(value))
+
+    directory = os.path.dirname(path)
+    if directory not in self._directories:
+      self._ensure_directory(directory)
+
+    for attempt in range(0, 3):
+      try:
+        fd, tmp = _create_temp_file(directory, self.temp_prefix,
+            self._writing)
+        break
+      except OSError, e:
+        if e.errno != errno.ENOENT or attempt == 2:
+          raise
+
+      # removed since cached (e.g. by compact, which may race makedirs).
+      self._directories.discard(directory)
+      try:
+        self._ensure_directory(directory)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+
+    try:
+      self._write_temp_file(fd, tmp, path, value)
+    finally:
+      self._writing.discard(tmp)
+
+  def _write_temp_file(self, fd, tmp, path, value):
+    '''write `value` to the temp file `tmp` (open as `fd`), and rename it to
+    `path`.
+    '''
+    try:
+      try:
+        written = 0
+        while written < len(value):
+          written += os.write(fd, buffer(value, written))
+        if self.durability != 'none':
+          os.fsync(fd)  # concurrently, even when group committing
+      finally:
+        os.close(fd)
+    except:
+      _remove_quietly(tmp)
+      raise
+
+    if self._committer is not None:
+      self._committer.commit(tmp, path)
+      return
+
+    try:
+      os.rename(tmp, path)
+    except:
+      _remove_quietly(tmp)
+      raise
+
+    if self.durability == 'fsync':
+      fsync_directory(os.path.dirname(path))
+
+  def _ensure_directory(self, directory):
+    '''Ensures `directory` exists, and caches that it does.'''
+    ensure_directory_exists(directory)
+    if len(self._directories) >= self.max_cached_directories:
+      self._directories.clear()
+    self._directories.add(directory)
 
   def _read_object(self, path):
     '''read in object from file at `path`'''
-    if not os.path.exists(path):
-      return None
-
-    if os.path.isdir(path):
-      raise RuntimeError('%s is a directory, not a file.' % path)
+    try:
+      f = open(path)
+    except IOError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return None
+      if e.errno == errno.EISDIR:
+        raise RuntimeError('%s is a directory, not a file.' % path)
+      raise
+
+    with f:
+      if self.mmap_threshold is not None:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0 and size >= self.mmap_threshold:
+          return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    with open(path) as f:
       file_contents = f.read()
 
     return file_contents
 
+  def _read_listed_object(self, path):
+    '''read in object from listed file at `path`, or None if not a file.'''
+    try:
+      return self._read_object(path)
+    except RuntimeError:
+      return None  # a directory named like an object file
+
   def _read_object_gen(self, iterable):
-    '''Generator that reads objects in from filenames in `iterable`.'''
-    for filename in iterable:
-      yield self._read_object(filename)
+    '''Generator that reads objects in from filenames in `iterable`, skipping
+    files removed since listed, and directories.
+    '''
+    if self._read_pool is not None:
+      values = prefetch_gen(self._read_listed_object, iterable,
+          self._read_pool, self.prefetch)
+    else:
+      values = itertools.imap(self._read_listed_object, iterable)
+
+    for value in values:
+      if value is not None:
+        yield value
+
+  def _object_filenames(self, path):
+    '''Generator of the paths of the object files in directory `path`.
+
+    Uses ``scandir`` (from the `scandir` module) when installed, which lists
+    entries lazily and knows which are directories without a stat call.
+    Otherwise uses ``os.listdir``.
+    '''
+    extension = self.object_extension
+    ignored = set(self.ignore_list)
+    try:
+      entries = scandir(path) if scandir is not None else os.listdir(path)
+    except OSError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return
+      raise
+
+    if scandir is None:
+      for name in entries:
+        if name.endswith(extension) and name not in ignored:
+          yield os.path.join(path, name)
+      return
+
+    for entry in entries:
+      if entry.name.endswith(extension) and entry.name not in ignored \
+          and not entry.is_dir():
+        yield entry.path
 
 
   # Datastore implementation
@@ -173,6 +511,22 @@ class FileSystemDatastore(datastore.Datastore):
     return self._read_object(path)
 
 
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.
+    With `read_threads`, files are read concurrently.
+
+    Args:
+      keys: iterable of Keys naming the objects to retrieve
+
+    Returns:
+      list of objects (or None), one per key
+    '''
+    paths = itertools.imap(self.object_path, keys)
+    if self._read_pool is None:
+      return map(self._read_object, paths)
+    return list(prefetch_gen(self._read_object, paths, self._read_pool,
+        self.prefetch))
+
   def put(self, key, value):
     '''Stores the object `value` named by `key`.
 
@@ -190,33 +544,40 @@ class FileSystemDatastore(datastore.Datastore):
       key: Key naming the object to remove.
     '''
     path = self.object_path(key)
-    if os.path.exists(path):
+    try:
       os.remove(path)
+    except OSError, e:
+      if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+        raise
 
-    #TODO: delete dirs if empty?
+    # empty directories are left for compact to remove.
 
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
     FSDatastore.query queries all the `.obj` files within the directory
     specified by the query.key.
 
+    Files are listed and read lazily, as the results are iterated. Without
+    filters or orders, the offset skips files without reading them, and no
+    files are read past the limit.
+
     Args:
       query: Query object describing the objects to return.
 
     Raturns:
       Cursor with all objects matching criteria
     '''
-    path = self.path(query.key)
-
-    if os.path.exists(path):
-      filenames = os.listdir(path)
-      filenames = list(set(filenames) - set(self.ignore_list))
-      filenames = map(lambda f: os.path.join(path, f), filenames)
-      iterable = self._read_object_gen(filenames)
-    else:
-      iterable = list()
-
-    return query(iterable) # must apply filters, etc naively.
+    filenames = self._object_filenames(self.path(query.key))
+    if query.filters or query.orders:
+      # must apply filters, etc naively.
+      return query(self._read_object_gen(filenames))
+
+    cursor = Cursor(query, [])
+    if query.offset:
+      filenames = offset_gen(query.offset, filenames, cursor._skipped_inc)
+    cursor._iterable = self._read_object_gen(filenames)
+    cursor.apply_limit()
+    return cursor
 
   def contains(self, key):
     '''Returns whether the object named by `key` exists.
@@ -229,4 +590,90 @@ class FileSystemDatastore(datastore.Datastore):
       boalean whether the object exists
     '''
     path = self.object_path(key)
-    return os.path.exists(path) and os.path.isfile(path)
+    try:
+      return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return False
+      raise
+
+  def close(self):
+    '''Stops the group committer, if any, once pending writes are durable,
+    and the reading threads. Writes fail afterwards in 'group' durability.
+    '''
+    if self._committer is not None:
+      self._committer.close()
+
+    if self._read_pool is not None:
+      self._read_pool.close()
+      self._read_pool = None
+
+    self._closed.set()
+    if self._collector is not None:
+      self._collector.join()
+      self._collector = None
+
+
+  # garbage collection
+
+  def compact(self, temp_file_age=None):
+    '''Removes empty directories under the root, and temp files older than
+    `temp_file_age` seconds (by default, the datastore's `temp_file_age`),
+    left by interrupted writes.
+
+    Returns:
+      (number of directories removed, number of temp files removed)
+    '''
+    removed = [0, 0]
+    for _ in self._gc_gen(temp_file_age, removed):
+      pass
+    return tuple(removed)
+
+  def _gc_gen(self, temp_file_age, removed):
+    '''Generator collecting garbage one directory per step, bottom-up, and
+    counting what it removes in `removed` (directories, temp files).
+    '''
+    if temp_file_age is None:
+      temp_file_age = self.temp_file_age
+    deadline = time.time() - temp_file_age
+
+    for directory, _, filenames in os.walk(self.root_path, topdown=False):
+      remaining = len(filenames)
+      for name in filenames:
+        if not name.startswith(self.temp_prefix):
+          continue
+
+        path = os.path.join(directory, name)
+        if path in self._writing:
+          continue  # a slow write, still in progress
+
+        try:
+          if os.lstat(path).st_mtime < deadline:
+            os.remove(path)
+            removed[1] += 1
+            remaining -= 1
+        except OSError, e:
+          if e.errno != errno.ENOENT:
+            raise
+          remaining -= 1  # committed meanwhile
+
+      # subdirectories may be left too; rmdir only removes empty ones.
+      if remaining == 0 and directory != self.root_path:
+        try:
+          os.rmdir(directory)
+          self._directories.discard(directory)
+          removed[0] += 1
+        except OSError, e:
+          if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+            raise
+
+      yield directory
+
+  def _gc_loop(self, interval, rate):
+    while not self._closed.wait(interval):
+      try:
+        for _ in self._gc_gen(None, [0, 0]):
+          if self._closed.wait(1.0 / rate):
+            return
+      except Exception:
+        logger.exception('garbage collection of %s failed', self.root_path)
@@ -27,6 +27,242 @@ class TestFileSystemDatastore(TestDatastore):
     dses = map(serialize.shim, fses)
     self.subtest_simple(dses, numelems=500)
 
+  def test_atomic_writes(self):
+    import datastore.core
+    from datastore.core.key import Key
+
+    fs = FileSystemDatastore(self.tmp)
+    key = Key('/a/b')
+    fs.put(key, 'value')
+    self.assertEqual(fs.get(key), 'value')
+    self.assertEqual(os.listdir(os.path.dirname(fs.object_path(key))),
+        ['b.obj'])
+
+    # leftover temp files (e.g. after a crash) are not objects.
+    tmp = os.path.join(self.tmp, 'a', fs.temp_prefix + 'crashed')
+    with open(tmp, 'w') as f:
+      f.write('partial')
+    self.assertEqual(list(fs.query(datastore.core.Query(Key('/a')))),
+        ['value'])
+
+    self.assertRaises(ValueError, FileSystemDatastore, self.tmp,
+        durability='sometimes')
+
+    # objects get the permissions open() would give them.
+    umask = os.umask(022)
+    try:
+      fs.put(key, 'value')
+      self.assertEqual(os.stat(fs.object_path(key)).st_mode & 0777, 0644)
+    finally:
+      os.umask(umask)
+
+    # unicode values are encoded as file.write would; others are rejected.
+    fs.put(key, u'text')
+    self.assertEqual(fs.get(key), 'text')
+    self.assertRaises(UnicodeEncodeError, fs.put, key, u'\u00e9')
+    self.assertRaises(TypeError, fs.put, key, 42)
+    self.assertEqual(fs.get(key), 'text')
+
+  def test_directory_cache(self):
+    from datastore.core.key import Key
+
+    fs = FileSystemDatastore(self.tmp)
+    key = Key('/a/b/c')
+    fs.put(key, 'c')
+    self.assertTrue(os.path.dirname(fs.object_path(key)) in fs._directories)
+
+    # directories removed behind the datastore's back are made again.
+    shutil.rmtree(os.path.join(self.tmp, 'a'))
+    self.assertFalse(fs.contains(key))
+    self.assertEqual(fs.get(key), None)
+    fs.delete(key)
+    fs.put(key, 'c')
+    self.assertEqual(fs.get(key), 'c')
+
+    # paths through objects, or naming directories.
+    self.assertEqual(fs.get(Key('/a/b/c.obj/d')), None)
+    self.assertFalse(fs.contains(Key('/a/b/c.obj/d')))
+    os.mkdir(fs.object_path(Key('/a/dir')))
+    self.assertFalse(fs.contains(Key('/a/dir')))
+    self.assertRaises(RuntimeError, fs.get, Key('/a/dir'))
+
+  def test_query_pushdown(self):
+    from datastore.core.key import Key
+    from datastore.core.query import Query
+
+    class ReadCountingDatastore(FileSystemDatastore):
+      reads = 0
+      def _read_object(self, path):
+        self.reads += 1
+        return super(ReadCountingDatastore, self)._read_object(path)
+
+    fs = ReadCountingDatastore(self.tmp)
+    for i in range(0, 100):
+      fs.put(Key('/q/%d' % i), str(i))
+    fs.put(Key('/q/0/child'), 'child')  # makes a subdirectory
+
+    cursor = fs.query(Query(Key('/q'), offset=10, limit=5))
+    self.assertEqual(len(list(cursor)), 5)
+    self.assertEqual(cursor.skipped, 10)
+    self.assertEqual(fs.reads, 5)
+
+    os.mkdir(os.path.join(self.tmp, 'q', 'dir.obj'))
+    fs.reads = 0
+    self.assertEqual(len(list(fs.query(Query(Key('/q'))))), 100)
+    self.assertTrue(fs.reads <= 101)  # dir.obj is skipped, or fails to read
+
+    # orders need every object.
+    fs.reads = 0
+    query = Query(Key('/q'), limit=5, object_getattr=lambda obj, field: obj)
+    self.assertEqual(list(fs.query(query.order('+value'))),
+        ['0', '1', '10', '11', '12'])
+    self.assertTrue(fs.reads >= 100)
+    self.assertEqual(list(fs.query(Query(Key('/missing')))), [])
+
+  def test_mmap_reads(self):
+    import mmap
+    from datastore.core.key import Key
+    from datastore.core.query import Query
+
+    fs = FileSystemDatastore(self.tmp, mmap_threshold=1024)
+    small, large = Key('/m/small'), Key('/m/large')
+    fs.put(small, 'small')
+    fs.put(large, 'x' * 4096)
+
+    self.assertEqual(fs.get(small), 'small')
+    value = fs.get(large)
+    self.assertTrue(isinstance(value, mmap.mmap))
+    self.assertEqual(len(value), 4096)
+    self.assertEqual(value[10:20], 'x' * 10)
+
+    fs.put(Key('/m/copy'), value)  # buffers can be written back
+    self.assertEqual(fs.get(Key('/m/copy'))[:], 'x' * 4096)
+
+    raw = serialize.shim(fs, serializer=serialize.NonSerializer)
+    self.assertTrue(isinstance(raw.get(large), mmap.mmap))
+    json = serialize.shim(fs)
+    json.put(Key('/j/small'), [0])
+    json.put(Key('/j/large'), range(0, 1000))
+    self.assertEqual(json.get(Key('/j/large')), range(0, 1000))
+    self.assertEqual(sorted(map(len, json.query(Query(Key('/j'))))),
+        [1, 1000])
+
+  def test_read_threads(self):
+    from datastore.core.key import Key
+    from datastore.core.query import Query
+
+    fs = FileSystemDatastore(self.tmp, read_threads=4, prefetch=8)
+    self.subtest_simple([serialize.shim(fs)], numelems=100)
+
+    keys = [Key('/r/%d' % i) for i in range(0, 50)]
+    fs.put_many([(key, str(key)) for key in keys])
+    self.assertEqual(fs.get_many(keys + [Key('/r/missing')]),
+        map(str, keys) + [None])
+    os.mkdir(os.path.join(self.tmp, 'r', 'dir.obj'))
+    self.assertEqual(sorted(fs.query(Query(Key('/r')))), sorted(map(str, keys)))
+    self.assertEqual(len(list(fs.query(Query(Key('/r'), limit=10)))), 10)
+    fs.close()
+
+  def test_compact(self):
+    import time
+    from datastore.core.key import Key
+
+    fs = FileSystemDatastore(self.tmp)
+    keys = [Key('/x/%d/y/%d' % (i, i)) for i in range(0, 10)]
+    for key in keys:
+      fs.put(key, 'value')
+    fs.put(Key('/kept/z'), 'value')
+    for key in keys:
+      fs.delete(key)
+
+    x = os.path.join(self.tmp, 'x')
+    old_tmp = os.path.join(self.tmp, 'kept', fs.temp_prefix + 'old')
+    new_tmp = os.path.join(self.tmp, 'kept', fs.temp_prefix + 'new')
+    for path in [old_tmp, new_tmp]:
+      with open(path, 'w') as f:
+        f.write('partial')
+    os.utime(old_tmp, (time.time() - 3600, time.time() - 3600))
+
+    self.assertEqual(fs.compact(), (21, 1))
+    self.assertFalse(os.path.exists(x))
+    self.assertFalse(os.path.exists(old_tmp))
+    self.assertTrue(os.path.exists(new_tmp))
+    self.assertEqual(fs.get(Key('/kept/z')), 'value')
+    self.assertEqual(fs.compact(temp_file_age=0), (0, 1))
+
+    # temp files of writes in progress are kept, however old.
+    write_temp_file = fs._write_temp_file
+    def collecting_write(fd, tmp, path, value):
+      os.utime(tmp, (time.time() - 3600, time.time() - 3600))
+      self.assertEqual(fs.compact(), (0, 0))
+      write_temp_file(fd, tmp, path, value)
+    fs._write_temp_file = collecting_write
+    fs.put(Key('/kept/slow'), 'slow')
+    del fs._write_temp_file
+    self.assertEqual(fs.get(Key('/kept/slow')), 'slow')
+    self.assertEqual(fs._writing, set())
+
+    # pruned directories are made again as needed.
+    fs.put(keys[0], 'again')
+    self.assertEqual(fs.get(keys[0]), 'again')
+    fs.close()
+
+  def test_background_gc(self):
+    import time
+    from datastore.core.key import Key
+
+    fs = FileSystemDatastore(self.tmp, gc_interval=0.01, gc_rate=1000)
+    for i in range(0, 10):
+      key = Key('/gc/%d/child' % i)
+      fs.put(key, 'value')
+      fs.delete(key)
+
+    for i in range(0, 200):
+      if not os.path.exists(os.path.join(self.tmp, 'gc')):
+        break
+      time.sleep(0.01)
+    self.assertFalse(os.path.exists(os.path.join(self.tmp, 'gc')))
+    fs.close()
+
+    self.assertRaises(ValueError, FileSystemDatastore, self.tmp,
+        gc_interval=1, gc_rate=0)
+
+  def test_durability(self):
+    import threading
+    from datastore.core.key import Key
+
+    fses = [FileSystemDatastore(os.path.join(self.tmp, d), durability=d)
+      for d in ['none', 'fsync', 'group']]
+    for fs in fses:
+      self.subtest_simple([serialize.shim(fs)], numelems=50)
+
+    # concurrent writers share group commits, flushing their own files.
+    fs = fses[2]
+    keys = [Key('/group/%d' % i) for i in range(0, 20)]
+    threads = [threading.Thread(target=fs.put, args=(key, str(key)))
+      for key in keys]
+    fsyncs = []
+    fsync = os.fsync
+    def recording_fsync(fd):
+      fsyncs.append(threading.current_thread())
+      fsync(fd)
+    os.fsync = recording_fsync
+    try:
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    finally:
+      os.fsync = fsync
+    self.assertEqual(len([t for t in fsyncs if t in threads]), len(keys))
+    self.assertTrue(len(fsyncs) < 2 * len(keys))
+    self.assertEqual(map(fs.get, keys), map(str, keys))
+    self.assertEqual(len(os.listdir(os.path.join(fs.root_path, 'group'))), 20)
+
+    for fs in fses:
+      fs.close()
+    self.assertRaises(RuntimeError, fs.put, keys[0], 'closed')
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,615 @@
+
+__version__ = '0.1'
+__doc__ = '''
+log-structured (Bitcask-style) datastore implementation.
+
+Objects are appended to segment files instead of being written to one file
+each, and found through an in-memory index.
+
+'''
+
+import errno
+import logging
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+
+import datastore.core
+from datastore.core.key import Key
+from datastore.filesystem import ensure_directory_exists
+
+
+# record: crc32, key size, value size; then key and value. The crc covers
+# everything after it. Deletes are recorded with a value size of _tombstone.
+_record_header = struct.Struct('>III')
+_sizes = struct.Struct('>II')
+
+# hint entry: key size, value size, value offset; then key.
+_hint_entry = struct.Struct('>IIQ')
+
+_tombstone = 0xffffffff
+
+_segment_name = re.compile(r'^(\d{10})-(\d{6})\.data$')
+
+logger = logging.getLogger(__name__)
+
+
+def _remove_quietly(path):
+  try:
+    os.remove(path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+
+def _record_size(key_size, value_size):
+  if value_size is None:
+    value_size = 0
+  return _record_header.size + key_size + value_size
+
+
+def encode_record(key_string, value):
+  '''Returns the record storing `value` (None for a delete) for a key.'''
+  value_size = _tombstone if value is None else len(value)
+  body = _sizes.pack(len(key_string), value_size) + key_string + (value or '')
+  return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+
+
+class Segment(object):
+  '''One append-only data file of a LogStructuredDatastore, and its hint file.
+
+  Segments are identified by (major, minor) pairs, in the order they were
+  written. New segments get the next major number; compaction writes its
+  output under the major number of the last segment it merges, with higher
+  minor numbers, so it sorts between the merged segments and newer ones.
+
+  Args:
+    directory: the directory holding the segment files.
+    id: the (major, minor) pair identifying the segment.
+  '''
+
+  def __init__(self, directory, id):
+    self.id = id
+    self.path = os.path.join(directory, '%010d-%06d.data' % id)
+    self.hint_path = self.path[:-len('.data')] + '.hint'
+    self.size = 0  # bytes of valid records
+    self.dead = 0  # bytes of records overwritten or deleted since
+    self._reader = None
+
+  def __repr__(self):
+    return '<Segment %010d-%06d>' % self.id
+
+  def read(self, offset, size):
+    '''Returns the `size` bytes at `offset`. Not thread-safe.'''
+    if self._reader is None:
+      self._reader = open(self.path, 'rb')
+    self._reader.seek(offset)
+    return self._reader.read(size)
+
+  def records(self):
+    '''Generator of (key string, value offset, value size) entries for the
+    records in the data file, with a value size of None for deletes. Stops
+    at the first truncated or corrupt record (e.g. from a crash), and sets
+    `size` to where valid records end.
+    '''
+    offset = 0
+    with open(self.path, 'rb') as f:
+      while True:
+        header = f.read(_record_header.size)
+        if len(header) < _record_header.size:
+          break
+
+        crc, key_size, value_size = _record_header.unpack(header)
+        stored = 0 if value_size == _tombstone else value_size
+        rest = f.read(key_size + stored)
+        if len(rest) < key_size + stored:
+          break
+        if zlib.crc32(header[4:] + rest) & 0xffffffff != crc:
+          break
+
+        value_offset = offset + _record_header.size + key_size
+        value_size = None if value_size == _tombstone else value_size
+        yield rest[:key_size], value_offset, value_size
+        offset = value_offset + stored
+        self.size = offset
+
+  def hints(self):
+    '''Returns the entries saved in the hint file (as ``records``), or None
+    if there is no valid hint file.
+    '''
+    try:
+      with open(self.hint_path, 'rb') as f:
+        data = f.read()
+    except IOError, e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+
+    if len(data) < 8 or struct.unpack('>Q', data[:8])[0] != len(data):
+      return None  # incomplete
+
+    entries = []
+    offset = 8
+    while offset < len(data):
+      key_size, value_size, value_offset = \
+        _hint_entry.unpack_from(data, offset)
+      offset += _hint_entry.size
+      key_string = data[offset:offset + key_size]
+      offset += key_size
+      value_size = None if value_size == _tombstone else value_size
+      entries.append((key_string, value_offset, value_size))
+
+    self.size = os.path.getsize(self.path)
+    return entries
+
+  def write_hints(self, entries):
+    '''Saves `entries` (as returned by ``records``) to the hint file.'''
+    chunks = []
+    for key_string, value_offset, value_size in entries:
+      value_size = _tombstone if value_size is None else value_size
+      chunks.append(_hint_entry.pack(len(key_string), value_size,
+          value_offset))
+      chunks.append(key_string)
+    data = ''.join(chunks)
+
+    directory = os.path.dirname(self.path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(struct.pack('>Q', len(data) + 8))
+        f.write(data)
+      os.rename(tmp, self.hint_path)
+    except:
+      _remove_quietly(tmp)
+      raise
+
+  def close(self):
+    '''Closes the read handle, if open.'''
+    if self._reader is not None:
+      self._reader.close()
+      self._reader = None
+
+  def remove(self):
+    '''Removes the data and hint files.'''
+    self.close()
+    _remove_quietly(self.path)
+    _remove_quietly(self.hint_path)
+
+
+
+class LogStructuredDatastore(datastore.Datastore):
+  '''Log-structured datastore, appending objects to segment files.
+
+  Instead of one file per object (see FileSystemDatastore), objects are
+  appended as records to the active segment file under `root`, and an
+  in-memory index maps each key to where its latest value is. A ``get`` is
+  one seek and read; a ``put`` or ``delete`` one append (``put_many`` and
+  ``delete_many`` append a whole batch at once). Once the active segment
+  reaches `max_segment_size` bytes, a new one is started.
+
+  Overwritten and deleted records stay in older segments as dead bytes
+  until compaction rewrites the live records of all older segments into new
+  ones, and removes them. Call ``compact`` (e.g. off-peak), or give a
+  `compact_interval` for a background thread to compact whenever at least
+  `compact_ratio` of the older segments' bytes are dead. Reads and writes
+  proceed during compaction.
+
+  When a segment is completed, its index entries are saved to a hint file,
+  so that on startup the index is loaded from hint files rather than by
+  reading every segment. Records carry a checksum: a record torn by a crash
+  ends its segment, and is dropped on startup.
+
+  Values must be strings (use a SerializerShimDatastore for other objects).
+  Queries behave as in FileSystemDatastore: a query for a key returns the
+  objects directly under it (with namespace delimiters taken as slashes).
+
+  Hello World:
+
+      >>> import datastore.logstore
+      >>>
+      >>> ds = datastore.logstore.LogStructuredDatastore('/tmp/.test_log')
+      >>>
+      >>> hello = datastore.Key('hello')
+      >>> ds.put(hello, 'world')
+      >>> ds.get(hello)
+      'world'
+      >>> ds.delete(hello)
+      >>> ds.compact()  # bytes reclaimed
+      41
+      >>> ds.close()
+
+  '''
+
+  durabilities = ['none', 'fsync']
+
+  def __init__(self, root, max_segment_size=64 * 1024 * 1024,
+      durability='none', compact_interval=None, compact_ratio=0.5):
+    '''Initialize the datastore with given root directory `root`, loading
+    the index of the segments in it.
+
+    Args:
+      root: A path at which to mount this datastore.
+      max_segment_size: size in bytes from which to start a new segment.
+      durability: 'none' (leave flushing to the OS) or 'fsync' (flush every
+          write before returning).
+      compact_interval: seconds between checks for background compaction
+          (None, the default, only compacts through ``compact``).
+      compact_ratio: share of dead bytes in older segments from which the
+          background thread compacts them.
+    '''
+    if durability not in self.durabilities:
+      raise ValueError('durability must be one of %s' % self.durabilities)
+
+    root = os.path.normpath(root)
+    if not root:
+      errstr = 'root path must not be empty (\'.\' for current directory)'
+      raise ValueError(errstr)
+
+    ensure_directory_exists(root)
+
+    self.root_path = root
+    self.max_segment_size = max_segment_size
+    self.durability = durability
+    self.compact_ratio = compact_ratio
+
+    self._index = {}  # key -> (segment, value offset, value size)
+    self._directories = {}  # directory -> set of keys directly in it
+    self._segments = []  # in id order; the last one is active
+    self._active_entries = []  # entries of the active segment, for hints
+    self._writer = None
+    self._lock = threading.RLock()
+    self._compact_lock = threading.Lock()
+
+    self._load()
+
+    self._closed = threading.Event()
+    self._compactor = None
+    if compact_interval:
+      self._compactor = threading.Thread(target=self._compact_loop,
+          args=(compact_interval,), name='LogStructuredDatastore compactor')
+      self._compactor.daemon = True
+      self._compactor.start()
+
+
+  # index
+
+  def _load(self):
+    '''Loads the index from the segments under `root_path`.'''
+    ids = []
+    for name in os.listdir(self.root_path):
+      match = _segment_name.match(name)
+      if match:
+        ids.append((int(match.group(1)), int(match.group(2))))
+      elif name.startswith('.tmp-'):
+        _remove_quietly(os.path.join(self.root_path, name))
+
+    ids.sort()
+    for id in ids:
+      segment = Segment(self.root_path, id)
+      self._segments.append(segment)
+      if id == ids[-1]:
+        # the active segment: its hints (if any) go stale with new writes.
+        entries = list(segment.records())
+        _remove_quietly(segment.hint_path)
+        self._active_entries = entries
+      else:
+        entries = segment.hints()
+        if entries is None:
+          entries = list(segment.records())
+          segment.write_hints(entries)
+
+      for key_string, value_offset, value_size in entries:
+        key = Key.fromCanonical(key_string)
+        self._apply(segment, key, value_offset, value_size)
+
+    if not self._segments:
+      self._segments.append(Segment(self.root_path, (1, 0)))
+
+    # resume appending to the last segment, dropping any torn record.
+    active = self._segments[-1]
+    self._writer = open(active.path, 'ab', 0)
+    self._writer.truncate(active.size)
+
+  def _apply(self, segment, key, value_offset, value_size):
+    '''Points the index at the record of `key` in `segment`, noting the
+    record it replaces (if any) as dead.
+    '''
+    key_size = len(str(key))
+    previous = self._index.get(key)
+    if previous is not None:
+      old_segment, _, old_size = previous
+      old_segment.dead += _record_size(key_size, old_size)
+
+    if value_size is None:
+      segment.dead += _record_size(key_size, None)  # dead once written
+      if previous is not None:
+        del self._index[key]
+        directory = self._directories[self._directory(key)]
+        directory.discard(key)
+        if not directory:
+          del self._directories[self._directory(key)]
+      return
+
+    self._index[key] = (segment, value_offset, value_size)
+    if previous is None:
+      self._directories.setdefault(self._directory(key), set()).add(key)
+
+  def _directory(self, key):
+    '''Returns the directory `key` is in, as FileSystemDatastore would
+    store it (namespace delimiters taken as slashes).
+    '''
+    path = str(key).replace(':', '/')
+    return path[:path.rindex('/')] or '/'
+
+
+  # segments
+
+  def _append(self, items):
+    '''Appends records for the (key, value or None) `items` to the active
+    segment, and updates the index.
+    '''
+    with self._lock:
+      active = self._segments[-1]
+      offset = active.size
+      chunks = []
+      entries = []
+      for key, value in items:
+        key_string = str(key)
+        record = encode_record(key_string, value)
+        value_offset = offset + _record_header.size + len(key_string)
+        value_size = None if value is None else len(value)
+        chunks.append(record)
+        entries.append((key, key_string, value_offset, value_size))
+        offset += len(record)
+
+      try:
+        self._writer.write(''.join(chunks))
+        if self.durability == 'fsync':
+          os.fsync(self._writer.fileno())
+      except:
+        self._writer.truncate(active.size)  # drop any partial write
+        raise
+
+      active.size = offset
+      for key, key_string, value_offset, value_size in entries:
+        self._apply(active, key, value_offset, value_size)
+        self._active_entries.append((key_string, value_offset, value_size))
+
+      if active.size >= self.max_segment_size:
+        self._roll()
+
+  def _roll(self):
+    '''Completes the active segment, and starts a new one.'''
+    active = self._segments[-1]
+    active.write_hints(self._active_entries)
+    self._writer.close()
+
+    segment = Segment(self.root_path, (active.id[0] + 1, 0))
+    self._segments.append(segment)
+    self._active_entries = []
+    self._writer = open(segment.path, 'ab', 0)
+
+  def _read(self, key):
+    with self._lock:
+      location = self._index.get(key)
+      if location is None:
+        return None
+      segment, value_offset, value_size = location
+      return segment.read(value_offset, value_size)
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    return self._read(key)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+    '''
+    if value is None:
+      self.delete(key)
+      return
+    self._append([(key, value)])
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    with self._lock:
+      if key in self._index:
+        self._append([(key, None)])
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists (from the index).
+
+    Args:
+      key: Key naming the object to check.
+
+    Returns:
+      boalean whether the object exists
+    '''
+    return key in self._index
+
+  def get_many(self, keys):
+    '''Return the objects named by `keys`, in order, with None for missing.'''
+    with self._lock:
+      return map(self._read, keys)
+
+  def put_many(self, items):
+    '''Stores every `(key, value)` pair in `items`, in a single append.'''
+    with self._lock:
+      items = [(key, value) for key, value in items
+        if value is not None or key in self._index]
+      if items:
+        self._append(items)
+
+  def delete_many(self, keys):
+    '''Removes the objects named by `keys`, in a single append.'''
+    self.put_many([(key, None) for key in keys])
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`.
+    Objects are those directly under query.key, read as the results are
+    iterated.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Raturns:
+      Cursor with all objects matching criteria
+    '''
+    path = str(query.key).replace(':', '/')
+    with self._lock:
+      keys = list(self._directories.get(path, ()))
+
+    def values():
+      for key in keys:
+        value = self._read(key)
+        if value is not None:  # unless deleted since
+          yield value
+
+    return query(values()) # must apply filters, etc naively.
+
+  def __len__(self):
+    return len(self._index)
+
+
+  # compaction
+
+  def garbageRatio(self):
+    '''Returns the share of dead bytes in all but the active segment.'''
+    with self._lock:
+      segments = self._segments[:-1]
+      size = sum(segment.size for segment in segments)
+      dead = sum(segment.dead for segment in segments)
+    return float(dead) / size if size else 0.0
+
+  def compact(self):
+    '''Rewrites the live records of all segments but the active one (which
+    is completed first) into new segments, and removes the old ones. Does
+    nothing, not even completing the active segment, if no segment holds
+    dead records.
+
+    Returns:
+      the number of bytes reclaimed.
+    '''
+    with self._compact_lock:
+      with self._lock:
+        if not sum(segment.dead for segment in self._segments):
+          return 0  # nothing to reclaim: keep appending to the active one
+        if self._segments[-1].size > 0:
+          self._roll()
+        merged = self._segments[:-1]
+
+      major, minor = merged[-1].id
+      outputs = []
+      output = None
+      writer = None
+      entries = []
+      try:
+        for segment in merged:
+          records = segment.hints()
+          if records is None:
+            records = segment.records()
+
+          for key_string, value_offset, value_size in records:
+            if value_size is None:
+              continue  # every older record is being removed too
+
+            key = Key.fromCanonical(key_string)
+            location = (segment, value_offset, value_size)
+            with self._lock:
+              if self._index.get(key) != location:
+                continue
+              value = segment.read(value_offset, value_size)
+
+            if output is None or output.size >= self.max_segment_size:
+              if output is not None:
+                self._complete_output(output, writer, entries)
+              minor += 1
+              output = Segment(self.root_path, (major, minor))
+              writer = open(output.path, 'ab', 0)
+              entries = []
+              outputs.append(output)
+
+            record = encode_record(key_string, value)
+            writer.write(record)
+            new_offset = output.size + _record_header.size + len(key_string)
+            output.size += len(record)
+            entries.append((key_string, new_offset, value_size))
+
+            with self._lock:
+              if self._index.get(key) == location:
+                self._index[key] = (output, new_offset, value_size)
+              else:
+                output.dead += len(record)  # overwritten meanwhile
+
+        if output is not None:
+          self._complete_output(output, writer, entries)
+          writer = None
+        self._fsync_root()
+
+      except:
+        if writer is not None:
+          writer.close()
+        raise  # the merged segments still hold every record
+
+      with self._lock:
+        before = sum(segment.size for segment in self._segments)
+        self._segments = outputs + self._segments[len(merged):]
+        for segment in merged:  # oldest first, in case of a crash
+          segment.remove()
+        after = sum(segment.size for segment in self._segments)
+      return before - after
+
+  def _complete_output(self, output, writer, entries):
+    os.fsync(writer.fileno())
+    writer.close()
+    output.write_hints(entries)
+
+  def _fsync_root(self):
+    fd = os.open(self.root_path, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def _compact_loop(self, interval):
+    while not self._closed.wait(interval):
+      try:
+        if self.garbageRatio() >= self.compact_ratio:
+          self.compact()
+      except Exception:
+        logger.exception('compaction of %s failed', self.root_path)
+
+  def close(self):
+    '''Stops background compaction, and closes the segment files.'''
+    self._closed.set()
+    if self._compactor is not None:
+      self._compactor.join()
+      self._compactor = None
+
+    with self._lock:
+      if self._writer is not None:
+        self._writer.close()
+        self._writer = None
+      for segment in self._segments:
+        segment.close()
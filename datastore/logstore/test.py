@@ -0,0 +1,122 @@
+import os
+import shutil
+import unittest
+
+from datastore import serialize
+from datastore.core.key import Key
+from datastore.core.query import Query
+from datastore.core.test.test_basic import TestDatastore
+
+from . import LogStructuredDatastore
+
+
+class TestLogStructuredDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.log')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def segments(self):
+    return sorted(f for f in os.listdir(self.tmp) if f.endswith('.data'))
+
+  def test_datastore(self):
+    dirs = map(str, range(0, 4))
+    dirs = map(lambda d: os.path.join(self.tmp, d), dirs)
+    logs = map(LogStructuredDatastore, dirs)
+    dses = map(serialize.shim, logs)
+    self.subtest_simple(dses, numelems=500)
+
+    log = LogStructuredDatastore(os.path.join(self.tmp, 'small'),
+        max_segment_size=1024, durability='fsync')
+    self.subtest_simple([serialize.shim(log)], numelems=200)
+
+  def test_reopen(self):
+    keys = [Key('/a/%d' % i) for i in range(0, 100)]
+    log = LogStructuredDatastore(self.tmp, max_segment_size=512)
+    log.put_many([(key, str(key)) for key in keys])
+    log.delete_many(keys[::2])
+    log.put(Key('/a:b/c'), 'namespaced')
+    log.close()
+    self.assertTrue(len(self.segments()) > 1)
+    self.assertTrue(any(f.endswith('.hint') for f in os.listdir(self.tmp)))
+
+    # hint files and segments reload the same index.
+    log = LogStructuredDatastore(self.tmp, max_segment_size=512)
+    expected = [None if i % 2 == 0 else str(key) for i, key in enumerate(keys)]
+    self.assertEqual(log.get_many(keys), expected)
+    self.assertEqual(len(log), 51)
+    self.assertEqual(list(log.query(Query(Key('/a:b')))), ['namespaced'])
+    self.assertEqual(len(list(log.query(Query(Key('/a'))))), 50)
+    log.close()
+
+    # without hint files, segments are read; torn records are dropped.
+    for name in os.listdir(self.tmp):
+      if name.endswith('.hint'):
+        os.remove(os.path.join(self.tmp, name))
+    with open(os.path.join(self.tmp, self.segments()[-1]), 'ab') as f:
+      f.write('\x00\x01torn')
+
+    log = LogStructuredDatastore(self.tmp)
+    self.assertEqual(log.get_many(keys), expected)
+    log.put(Key('/a/new'), 'new')
+    log.close()
+    log = LogStructuredDatastore(self.tmp)
+    self.assertEqual(log.get(Key('/a/new')), 'new')
+    log.close()
+
+  def test_compact(self):
+    keys = [Key('/c/%d' % i) for i in range(0, 100)]
+    log = LogStructuredDatastore(self.tmp, max_segment_size=1024)
+    for round in range(0, 5):
+      log.put_many([(key, '%s-%d' % (key, round)) for key in keys])
+    log.delete_many(keys[50:])
+    self.assertTrue(log.garbageRatio() > 0.5)
+
+    size = sum(os.path.getsize(os.path.join(self.tmp, f))
+      for f in self.segments())
+    reclaimed = log.compact()
+    self.assertTrue(reclaimed > size / 2)
+    self.assertEqual(log.garbageRatio(), 0.0)
+
+    expected = ['%s-4' % key for key in keys[:50]] + [None] * 50
+    self.assertEqual(log.get_many(keys), expected)
+    log.put(keys[0], 'after')
+    log.close()
+
+    log = LogStructuredDatastore(self.tmp)
+    self.assertEqual(log.get_many(keys), ['after'] + expected[1:])
+    self.assertTrue(log.compact() > 0)  # the overwritten value
+    self.assertEqual(log.compact(), 0)  # nothing dead to reclaim
+
+    # without dead records, the active segment is not rolled over either.
+    log.put(Key('/c/new'), 'new')
+    segments = self.segments()
+    self.assertEqual(log.compact(), 0)
+    self.assertEqual(self.segments(), segments)
+    log.close()
+
+  def test_background_compaction(self):
+    import time
+
+    log = LogStructuredDatastore(self.tmp, max_segment_size=256,
+        compact_interval=0.01, compact_ratio=0.5)
+    key = Key('/bg/key')
+    for i in range(0, 100):
+      log.put(key, 'value %d' % i)
+
+    for i in range(0, 100):
+      if len(self.segments()) <= 2:
+        break
+      time.sleep(0.01)
+    self.assertTrue(len(self.segments()) <= 2)
+    self.assertEqual(log.get(key), 'value 99')
+    log.close()
+
+
+if __name__ == '__main__':
+  unittest.main()